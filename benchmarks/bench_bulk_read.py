@@ -0,0 +1,68 @@
+"""Compare per-file tag reads against the bulk directory reader.
+
+Usage: python benchmarks/bench_bulk_read.py [number_of_files]
+
+Creates a temporary directory of tagged files and times three ways of
+collecting their tags: one subprocess per file (the old mdls/getfattr path,
+when the tool is available), one native read per file from a 50-thread pool,
+and a single read_tags_bulk pass.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from imgtagman.discovery import iter_image_paths
+from imgtagman.xattr_tags import read_tags, read_tags_bulk, write_tags
+
+
+def subprocess_reader():
+    if sys.platform == "darwin" and shutil.which("mdls"):
+        return lambda path: subprocess.run(
+            ["mdls", "-name", "kMDItemUserTags", path], capture_output=True, text=True
+        )
+    if shutil.which("getfattr"):
+        return lambda path: subprocess.run(
+            ["getfattr", "-n", "user.xdg.tags", path], capture_output=True, text=True
+        )
+    return None
+
+
+def per_file_threaded(directory, reader):
+    with ThreadPoolExecutor(max_workers=50) as executor:
+        return list(executor.map(reader, iter_image_paths(directory)))
+
+
+def timed(label, func, count):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed:8.3f}s  {count / elapsed:12.0f} files/s")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    directory = tempfile.mkdtemp(prefix="imgtagman-bench-")
+    try:
+        for i in range(count):
+            path = os.path.join(directory, f"image_{i:07d}.jpg")
+            open(path, "wb").close()
+            write_tags(path, ["praia", "sol", f"tag{i % 100}"])
+
+        print(f"{count} files in {directory}")
+        reader = subprocess_reader()
+        if reader:
+            timed("subprocess per file", lambda: per_file_threaded(directory, reader), count)
+        timed("native per file (50 thr)", lambda: per_file_threaded(directory, read_tags), count)
+        timed("read_tags_bulk", lambda: read_tags_bulk(directory), count)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Weigh tag quality against cost for each contact sheet grid size.
+
+Usage: python benchmarks/bench_contact_sheet.py <image_directory> [number_of_images] [detail_level]
+
+Tags the first number_of_images images found (default 48) through the API
+configured by OPENAI_API_KEY / OPENAI_BASE_URL: first one image per request,
+whose tags serve as the reference, then as 2x2, 3x3 and 4x4 contact sheets.
+For each grid it prints requests and tokens per image (cells the sheet left
+unanswered are charged what their single-image request cost, since tag
+--sheet retries them that way), the share of cells answered, and how much
+the answered cells' tags overlap the reference (Jaccard, case-insensitive).
+Needs Pillow. Nothing is written to the images.
+"""
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from imgtagman.discovery import iter_image_paths
+from imgtagman.imgtag import (
+    build_sheet_request,
+    build_tag_request,
+    create_completion,
+    parse_packed_response,
+    parse_tags_response,
+)
+from imgtagman.pipeline import iter_batches
+from imgtagman.preprocess import CONTACT_SHEET_GRIDS, PREPROCESSED_EXTENSIONS, open_preprocessor
+from imgtagman.retry import RetryPolicy
+
+THREADS = 16
+
+
+def used_tokens(response):
+    usage = getattr(response, "usage", None)
+    return usage.total_tokens if usage else 0
+
+
+def overlap(tags, reference):
+    tags = {tag.lower() for tag in tags}
+    reference = {tag.lower() for tag in reference}
+    return len(tags & reference) / len(tags | reference) if tags | reference else 1.0
+
+
+def reference_tags(paths, preprocessor, detail_level, executor, retry):
+    """{path: (tags, tokens)} from one request per image"""
+
+    def tag(path):
+        response = create_completion(build_tag_request(preprocessor.data_url(path), detail_level), retry=retry)
+        return parse_tags_response(response), used_tokens(response)
+
+    return dict(zip(paths, executor.map(tag, paths)))
+
+
+def sheet_tags(paths, columns, preprocessor, detail_level, executor, retry):
+    """[(sheet paths, {index: tags}, tokens)] for the images drawn on columns x columns sheets"""
+
+    def tag(sheet):
+        sheet_url, failed = preprocessor.contact_sheet(sheet, columns)
+        response = create_completion(build_sheet_request(sheet_url, len(sheet), columns, detail_level), retry=retry)
+        answered = parse_packed_response(response, len(sheet))
+        return sheet, {index: tags for index, tags in answered.items() if index not in failed}, used_tokens(response)
+
+    return list(executor.map(tag, iter_batches(paths, columns * columns)))
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    directory = sys.argv[1]
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 48
+    detail_level = sys.argv[3] if len(sys.argv) > 3 else "low"
+
+    paths = [path for path in iter_image_paths(directory)
+             if os.path.splitext(path)[1].lower() in PREPROCESSED_EXTENSIONS][:count]
+    if not paths:
+        print(f"No images found in {directory}")
+        sys.exit(1)
+    preprocessor = open_preprocessor(detail_level)
+    if preprocessor is None:
+        sys.exit(1)
+
+    retry = RetryPolicy()
+    with preprocessor, ThreadPoolExecutor(THREADS) as executor:
+        reference = reference_tags(paths, preprocessor, detail_level, executor, retry)
+        single_tokens = sum(tokens for _, tokens in reference.values())
+        print(f"{len(paths)} images from {directory}, detail {detail_level}")
+        print(f"{'layout':<8} {'req/image':>10} {'tokens/image':>13} {'answered':>9} {'overlap':>8}")
+        print(f"{'single':<8} {1:>10.3f} {single_tokens / len(paths):>13.0f} {1:>9.0%} {1:>8.0%}")
+
+        for columns in CONTACT_SHEET_GRIDS:
+            requests = tokens = answered = 0
+            overlaps = []
+            for sheet, sheet_answers, sheet_tokens in sheet_tags(
+                paths, columns, preprocessor, detail_level, executor, retry
+            ):
+                requests += 1
+                tokens += sheet_tokens
+                for index, path in enumerate(sheet):
+                    if index in sheet_answers:
+                        answered += 1
+                        overlaps.append(overlap(sheet_answers[index], reference[path][0]))
+                    else:
+                        # Retried on its own by tag --sheet
+                        requests += 1
+                        tokens += reference[path][1]
+            mean_overlap = sum(overlaps) / len(overlaps) if overlaps else 0.0
+            print(
+                f"{f'{columns}x{columns}':<8} {requests / len(paths):>10.3f} {tokens / len(paths):>13.0f} "
+                f"{answered / len(paths):>9.0%} {mean_overlap:>8.0%}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Measure peak memory while tagging a directory of very large images.
+
+Usage: python benchmarks/bench_memory.py [size_mb] [count]
+
+Writes count (default 4) images of noise of about size_mb each (default
+200) as uncompressed TIFFs and as PNGs, then runs `imgtagman tag` on them
+against a local stand-in for the chat completions endpoint and prints the
+peak RSS of the largest process: with preprocessing (the TIFFs, decoded and
+downscaled in the preprocessing pool) and with --no-preprocess (the PNGs,
+streamed into the request bodies), on both engines. For comparison it also
+measures one PNG's data URL and request body built in memory, as they were
+before streaming. Needs Pillow to write the images.
+"""
+import os
+import sys
+import json
+import shutil
+import socket
+import asyncio
+import tempfile
+import subprocess
+import multiprocessing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ANSWER = json.dumps({
+    "id": "bench",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "gpt-4o-mini",
+    "choices": [{"index": 0, "finish_reason": "stop",
+                 "message": {"role": "assistant", "content": '{"tags":["ruído"]}'}}],
+    "usage": {"prompt_tokens": 100, "completion_tokens": 10, "total_tokens": 110},
+}).encode()
+
+# Runs a command and prints the peak RSS of the largest process it started
+MEASURE = (
+    "import resource, subprocess, sys\n"
+    "subprocess.run(sys.argv[1:], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)\n"
+    "print(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)\n"
+)
+
+# Builds one image's data URL and serialized request body in memory
+IN_MEMORY = (
+    "import sys, json\n"
+    "from imgtagman.imgtag import build_tag_request\n"
+    "from imgtagman.preprocess import raw_data_url\n"
+    "body = json.dumps(build_tag_request(raw_data_url(sys.argv[1]))).encode()\n"
+)
+
+
+async def serve(port):
+    """Answer every POST with ANSWER, reading and dropping the body as it arrives"""
+    response = (
+        b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+        + f"Content-Length: {len(ANSWER)}\r\n\r\n".encode() + ANSWER
+    )
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":", 1)[1])
+                while length:
+                    length -= len(await reader.readexactly(min(length, 1 << 20)))
+                writer.write(response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", port)
+    async with server:
+        await server.serve_forever()
+
+
+def run_stand_in(port):
+    asyncio.run(serve(port))
+
+
+def write_images(directory, size_mb, count):
+    """count noise images of about size_mb each, in a tiff/ and a png/ subdirectory"""
+    from PIL import Image
+
+    side = int((size_mb * 1e6 / 3) ** 0.5)
+    for subdirectory in ("tiff", "png"):
+        os.makedirs(os.path.join(directory, subdirectory))
+    for n in range(count):
+        image = Image.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+        image.save(os.path.join(directory, "tiff", f"noise{n}.tiff"))
+        image.save(os.path.join(directory, "png", f"noise{n}.png"), compress_level=0)
+
+
+def peak_rss_mb(command, environment):
+    output = subprocess.run(
+        [sys.executable, "-c", MEASURE, *command], capture_output=True, text=True, env=environment, check=True
+    ).stdout
+    # Kilobytes on Linux, bytes on macOS
+    return int(output) / (1024 ** 2 if sys.platform == "darwin" else 1024)
+
+
+def main():
+    size_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 200
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    server = multiprocessing.Process(target=run_stand_in, args=(port,), daemon=True)
+    server.start()
+    environment = dict(
+        os.environ, PYTHONPATH=ROOT, OPENAI_API_KEY="bench", OPENAI_BASE_URL=f"http://127.0.0.1:{port}/v1"
+    )
+
+    directory = tempfile.mkdtemp()
+    try:
+        write_images(directory, size_mb, count)
+        png = os.path.join(directory, "png")
+        tiff = os.path.join(directory, "tiff")
+        first_png = os.path.join(png, "noise0.png")
+        print(f"{count} images of {os.path.getsize(first_png) / 1e6:.0f} MB each")
+
+        def tag(*arguments):
+            # A fresh tag store for every run, so each one finds the images untagged
+            handle, store = tempfile.mkstemp(".sqlite3", dir=directory)
+            os.close(handle)
+            return [
+                sys.executable, "-m", "imgtagman.imgtagman", "tag", "--store", f"sqlite:{store}", "--no-catalog",
+                "--no-cache", *arguments,
+            ]
+
+        runs = [
+            ("TIFFs, preprocessed, threads", tag("--directory", tiff)),
+            ("TIFFs, preprocessed, async", tag("--directory", tiff, "--engine", "async")),
+            ("PNGs, streamed, threads", tag("--directory", png, "--no-preprocess")),
+            ("PNGs, streamed, async", tag("--directory", png, "--no-preprocess", "--engine", "async")),
+            ("one PNG encoded in memory", [sys.executable, "-c", IN_MEMORY, first_png]),
+        ]
+        for label, command in runs:
+            print(f"{label:<30} {peak_rss_mb(command, environment):8.0f} MB peak RSS")
+    finally:
+        shutil.rmtree(directory)
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
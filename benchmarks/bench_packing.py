@@ -0,0 +1,89 @@
+"""Compare one image per request against packed multi-image requests.
+
+Usage: python benchmarks/bench_packing.py <image_directory> [number_of_images] [pack_size] [detail_level]
+
+Sends the same images (the first number_of_images found, default 40) to the
+API configured through OPENAI_API_KEY / OPENAI_BASE_URL twice: one request
+per image, then pack_size images per request (default 4), both from a
+16-thread pool. Prints images per second and tokens per image, both as
+estimated for the rate limiter and as reported in the responses' usage.
+Nothing is written to the images.
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from imgtagman.discovery import iter_image_paths
+from imgtagman.imgtag import (
+    SUPPORTED_EXTENSIONS,
+    build_packed_request,
+    build_tag_request,
+    create_completion,
+    estimate_request_tokens,
+    parse_packed_response,
+)
+from imgtagman.pipeline import iter_batches
+from imgtagman.preprocess import open_preprocessor, raw_data_url
+from imgtagman.retry import RetryPolicy
+
+THREADS = 16
+
+
+def run(requests, retry):
+    """Send (image_count, request) pairs; returns (seconds, estimated tokens, used tokens, images answered)"""
+
+    def send(item):
+        count, request = item
+        response = create_completion(request, retry=retry)
+        usage = getattr(response, "usage", None)
+        answered = len(parse_packed_response(response, count)) if count > 1 else 1
+        return estimate_request_tokens(request), usage.total_tokens if usage else 0, answered
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(THREADS) as executor:
+        results = list(executor.map(send, requests))
+    elapsed = time.perf_counter() - start
+    return elapsed, sum(r[0] for r in results), sum(r[1] for r in results), sum(r[2] for r in results)
+
+
+def report(label, images, elapsed, estimated, used, answered):
+    print(
+        f"{label:<22} {elapsed:7.2f}s  {images / elapsed:7.1f} images/s  "
+        f"{estimated / images:7.0f} est. tokens/image  {used / images:7.0f} used tokens/image  "
+        f"{answered}/{images} answered"
+    )
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    directory = sys.argv[1]
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    pack_size = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    detail_level = sys.argv[4] if len(sys.argv) > 4 else "low"
+
+    paths = [path for path in iter_image_paths(directory)
+             if os.path.splitext(path)[1].lower() in SUPPORTED_EXTENSIONS][:count]
+    if not paths:
+        print(f"No images found in {directory}")
+        sys.exit(1)
+    preprocessor = open_preprocessor(detail_level)
+    try:
+        urls = [preprocessor.data_url(path) if preprocessor else raw_data_url(path) for path in paths]
+    finally:
+        if preprocessor is not None:
+            preprocessor.close()
+
+    print(f"{len(urls)} images from {directory}, detail {detail_level}")
+    single = [(1, build_tag_request(url, detail_level)) for url in urls]
+    report("1 image per request", len(urls), *run(single, RetryPolicy()))
+    packed = [(len(pack), build_packed_request(pack, detail_level)) for pack in iter_batches(urls, pack_size)]
+    report(f"{pack_size} images per request", len(urls), *run(packed, RetryPolicy()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Check that the commands which make no API calls start quickly.
+
+Usage: python benchmarks/bench_startup.py [budget_ms] [runs]
+
+Runs `imgtagman summary` and `imgtagman remove-tags --dry-run` on an empty
+temporary directory under `python -X importtime`, runs times each (default
+5) after a first run that fills the bytecode cache, and takes the fastest
+total import time of each command, leaving out the interpreter's own
+startup. Exits with status 1 if either goes over budget_ms
+(default 100) or loads one of the heavy packages that only tagging needs
+(the OpenAI SDK, httpx, pydantic, NumPy, Pillow).
+"""
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = {
+    "summary": ["summary", "--no-catalog"],
+    "remove-tags": ["remove-tags", "--dry-run", "--no-catalog"],
+}
+
+HEAVY_PACKAGES = ("openai", "httpx", "pydantic", "numpy", "PIL")
+
+# Imported by the interpreter itself before the command starts
+STARTUP_MODULES = {"site", "encodings", "_frozen_importlib_external", "zipimport", "codecs", "io", "abc", "stat"}
+
+
+def import_times(arguments, directory):
+    """(total import microseconds, {top-level module: cumulative microseconds}, every module imported) of one run"""
+    environment = dict(os.environ, PYTHONPATH=ROOT)
+    # No API key: these commands must not need one
+    environment.pop("OPENAI_API_KEY", None)
+    # Measure what an installed copy does: load cached bytecode rather than compile
+    environment.pop("PYTHONDONTWRITEBYTECODE", None)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "imgtagman.imgtagman", *arguments, "--directory", directory],
+        capture_output=True, text=True, env=environment, cwd=directory,
+    )
+    if result.returncode:
+        sys.exit(f"imgtagman {' '.join(arguments)} failed:\n{result.stderr[-2000:]}")
+    modules = {}
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            # Header
+            continue
+        imported.add(name.strip())
+        if not name.startswith("  "):
+            # Modules imported by another one are already in its parent's total
+            modules[name.strip()] = int(cumulative)
+    total = sum(time for name, time in modules.items() if name not in STARTUP_MODULES)
+    return total, modules, imported
+
+
+def main():
+    budget_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 100
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    failed = False
+    directory = tempfile.mkdtemp()
+    try:
+        for command, arguments in COMMANDS.items():
+            # The first run writes the bytecode cache
+            import_times(arguments, directory)
+            best, modules, imported = min(
+                (import_times(arguments, directory) for _ in range(runs)), key=lambda run: run[0]
+            )
+            heavy = sorted({name.split(".")[0] for name in imported} & set(HEAVY_PACKAGES))
+            slowest = sorted(modules.items(), key=lambda item: -item[1])[:5]
+            print(f"{command:<12} {best / 1000:6.1f} ms of imports (budget {budget_ms:g} ms)")
+            print("             slowest: " + ", ".join(f"{name} {time / 1000:.1f} ms" for name, time in slowest))
+            if heavy:
+                print(f"             loads {', '.join(heavy)}, which only tagging needs")
+            if best / 1000 > budget_ms or heavy:
+                failed = True
+    finally:
+        shutil.rmtree(directory)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Compare requests per second and connection reuse across HTTP pool settings.
+
+Usage: python benchmarks/bench_transport.py [number_of_requests] [concurrency] [latency_ms]
+
+Starts a local stand-in for the chat completions endpoint (HTTP/1.1 with
+keep-alive, answering each request after latency_ms, default 200) and sends
+number_of_requests (default 2000) tag requests to it from AsyncOpenAI with
+concurrency in flight (default 256), as --engine async does. Each pool
+setting gets a fresh client; the SDK's own pool is the baseline. Prints
+requests per second, the connections the server accepted and the
+requests that failed (with no retries, as the engines send them). HTTP/2
+needs TLS, so it is not measured here.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openai import AsyncOpenAI
+from imgtagman.transport import Transport
+
+ANSWER = json.dumps({
+    "id": "bench",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "gpt-4o-mini",
+    "choices": [{"index": 0, "finish_reason": "stop",
+                 "message": {"role": "assistant", "content": '{"tags":["praia","sol"]}'}}],
+    "usage": {"prompt_tokens": 100, "completion_tokens": 10, "total_tokens": 110},
+}).encode()
+
+REQUEST = {
+    "model": "gpt-4o-mini",
+    "messages": [{"role": "user", "content": "Forneça as tags."}],
+    "max_tokens": 300,
+}
+
+SETTINGS = [
+    ("SDK default pool", None),
+    ("16 connections", Transport(max_connections=16)),
+    ("64 connections", Transport(max_connections=64)),
+    ("256 connections", Transport(max_connections=256)),
+    ("256, no keep-alive", Transport(max_connections=256, keepalive_expiry=0)),
+]
+
+
+async def serve(port, latency, connections):
+    """Answer every POST with ANSWER after latency seconds, keeping connections open"""
+    response = (
+        b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+        + f"Content-Length: {len(ANSWER)}\r\n\r\n".encode() + ANSWER
+    )
+
+    async def handle(reader, writer):
+        with connections.get_lock():
+            connections.value += 1
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":", 1)[1])
+                await reader.readexactly(length)
+                await asyncio.sleep(latency)
+                writer.write(response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", port, backlog=4096)
+    async with server:
+        await server.serve_forever()
+
+
+def run_stand_in(port, latency, connections):
+    asyncio.run(serve(port, latency, connections))
+
+
+async def run(base_url, transport, requests, concurrency):
+    """Send requests with concurrency in flight; returns (seconds taken, requests failed)"""
+    options = transport.async_client_options() if transport else {}
+    semaphore = asyncio.Semaphore(concurrency)
+    async with AsyncOpenAI(api_key="bench", base_url=base_url, max_retries=0, **options) as client:
+
+        async def send():
+            async with semaphore:
+                await client.chat.completions.create(**REQUEST)
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(send() for _ in range(requests)), return_exceptions=True)
+        return time.perf_counter() - start, sum(isinstance(result, Exception) for result in results)
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    latency = (float(sys.argv[3]) if len(sys.argv) > 3 else 200) / 1000
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    # In its own process, so the server does not compete with the client for the GIL
+    connections = multiprocessing.Value("i", 0)
+    server = multiprocessing.Process(target=run_stand_in, args=(port, latency, connections), daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{port}/v1"
+    time.sleep(1)
+
+    print(f"{requests} requests, {concurrency} in flight, {latency * 1000:.0f} ms server latency")
+    try:
+        for label, transport in SETTINGS:
+            connections.value = 0
+            elapsed, failed = asyncio.run(run(base_url, transport, requests, concurrency))
+            print(
+                f"{label:<20} {requests / elapsed:8.0f} requests/s  {connections.value:6} connections opened  "
+                f"{failed:5} failed"
+            )
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
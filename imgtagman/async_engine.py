@@ -0,0 +1,276 @@
+import asyncio
+import logging
+import time
+from pathlib import Path
+from imgtagman.catalog import hash_file
+from imgtagman.dedupe import DEFAULT_THRESHOLD, open_clusters
+from imgtagman.config import DEFAULT_CONCURRENCY
+from imgtagman.imgtag import (
+    MODEL,
+    PROMPT_VERSION,
+    PACK_MAX_BYTES,
+    build_sheet_request,
+    build_tag_request,
+    estimate_request_tokens,
+    finish_call,
+    get_api_key,
+    iter_packed_requests,
+    iter_untagged_files,
+    log_run_summary,
+    lookup_cached_tags,
+    make_provenance,
+    pack_layout,
+    parse_packed_response,
+    parse_tags_response,
+    propagate_tags,
+    record_results,
+    save_pack_tags,
+    release_failed_call,
+    upload_extensions,
+)
+from imgtagman.preprocess import open_preprocessor, streamed_data_url
+from imgtagman.pipeline import iter_batches
+from imgtagman.rate_limit import RateLimiter
+from imgtagman.retry import RetryPolicy
+from imgtagman.tag_writer import WriteBehindWriter
+from imgtagman.tagstore import XattrTagStore
+from imgtagman.transport import get_transport
+
+# Untagged paths pulled from discovery per hop to a worker thread
+DISCOVERY_BATCH_SIZE = 64
+
+# Where the rate limiter's slow start begins
+INITIAL_CONCURRENCY = 16
+
+
+async def create_completion_async(client, request, limiter, retry):
+    """Async counterpart of create_completion; client must not retry on its own"""
+    estimated_tokens = estimate_request_tokens(request)
+    attempt = 0
+    while True:
+        wait = retry.wait_time()
+        if wait:
+            await asyncio.sleep(wait)
+            continue
+        await limiter.acquire_async(estimated_tokens)
+        attempt += 1
+        try:
+            raw = await client.chat.completions.with_raw_response.create(**request)
+        except BaseException as e:
+            release_failed_call(limiter, e)
+            if not isinstance(e, Exception):
+                raise
+            await asyncio.sleep(retry.on_failure(e, attempt, paced=True))
+            continue
+        return finish_call(raw, limiter, retry, estimated_tokens)
+
+
+async def image_data_url_async(image_path, preprocessor=None):
+    if preprocessor is not None:
+        return await preprocessor.data_url_async(image_path)
+    # Only checks that the file opens; it is read while the request is sent
+    return streamed_data_url(image_path)
+
+
+async def get_tags_async(client, image_path, detail_level="low", limiter=None, retry=None, preprocessor=None):
+    """Async counterpart of get_tags_from_openai; the file is read off the event loop"""
+    try:
+        logging.info(f"Getting tags from OpenAI for: {image_path}")
+        image_url = await image_data_url_async(image_path, preprocessor)
+        response = await create_completion_async(client, build_tag_request(image_url, detail_level), limiter, retry)
+        return parse_tags_response(response)
+    except Exception as e:
+        logging.error(f"Error getting tags from OpenAI for {image_path}: {e}")
+        raise
+
+
+async def process_file_async(client, file_path, detail_level="low", catalog=None, writer=None, limiter=None,
+                             retry=None, preprocessor=None, cache=None):
+    """Tag one untagged file (from the TagCache when it has seen the content), queue the write and return the tags"""
+    content_hash = None
+    if catalog is not None or cache is not None:
+        content_hash = await asyncio.to_thread(hash_file, file_path)
+    new_tags = None
+    if cache is not None:
+        new_tags = await asyncio.to_thread(cache.get, content_hash, MODEL, PROMPT_VERSION, detail_level)
+    cached = new_tags is not None
+    if cached:
+        logging.info(f"Using cached tags for {file_path}")
+    else:
+        new_tags = await get_tags_async(client, file_path, detail_level, limiter, retry, preprocessor)
+        if new_tags and cache is not None:
+            await asyncio.to_thread(cache.put, content_hash, MODEL, PROMPT_VERSION, detail_level, new_tags)
+    if not new_tags:
+        logging.warning(f"No tags were generated for {file_path}")
+        return
+    logging.info(f"Setting new tags for {file_path}: {new_tags}")
+    # submit() only appends to the writer's queue, so it is safe to call from the loop
+    writer.submit(file_path, new_tags, make_provenance(detail_level, cached), content_hash)
+    return new_tags
+
+
+async def get_packed_tags_async(client, image_paths, detail_level="low", limiter=None, retry=None,
+                                preprocessor=None, max_bytes=PACK_MAX_BYTES):
+    """Async counterpart of get_packed_tags"""
+    image_urls = await asyncio.gather(
+        *(image_data_url_async(image_path, preprocessor) for image_path in image_paths), return_exceptions=True
+    )
+    tags = {}
+    for paths, request in iter_packed_requests(image_paths, image_urls, detail_level, max_bytes):
+        logging.info(f"Getting tags from OpenAI for {len(paths)} images in one request")
+        try:
+            response = await create_completion_async(client, request, limiter, retry)
+        except Exception as e:
+            logging.error(f"Packed request for {len(paths)} images failed, tagging them one by one: {e}")
+            continue
+        for index, image_tags in parse_packed_response(response, len(paths)).items():
+            tags[paths[index]] = image_tags
+    return tags
+
+
+async def get_sheet_tags_async(client, image_paths, columns, detail_level="low", limiter=None, retry=None,
+                               preprocessor=None):
+    """Async counterpart of get_sheet_tags"""
+    sheet_url, failed = await preprocessor.contact_sheet_async(image_paths, columns)
+    logging.info(f"Getting tags from OpenAI for a contact sheet of {len(image_paths)} images")
+    request = build_sheet_request(sheet_url, len(image_paths), columns, detail_level)
+    try:
+        response = await create_completion_async(client, request, limiter, retry)
+    except Exception as e:
+        logging.error(f"Contact sheet request failed, tagging its images one by one: {e}")
+        return {}
+    answered = parse_packed_response(response, len(image_paths))
+    return {image_paths[index]: tags for index, tags in answered.items() if index not in failed}
+
+
+async def process_pack_async(client, file_paths, detail_level="low", catalog=None, writer=None, limiter=None,
+                             retry=None, preprocessor=None, cache=None, columns=None):
+    """Async counterpart of process_pack"""
+    hashes, cached, results = await asyncio.to_thread(lookup_cached_tags, file_paths, detail_level, catalog, cache)
+    results.update(cached)
+    pending = [file_path for file_path in hashes if file_path not in cached]
+    packed = {}
+    if len(pending) > 1:
+        if columns:
+            packed = await get_sheet_tags_async(client, pending, columns, detail_level, limiter, retry, preprocessor)
+        else:
+            packed = await get_packed_tags_async(client, pending, detail_level, limiter, retry, preprocessor)
+        if len(packed) < len(pending):
+            logging.warning(
+                f"{len(pending) - len(packed)} of {len(pending)} packed images need a request of their own"
+            )
+    for file_path in pending:
+        try:
+            results[file_path] = packed.get(file_path) or await get_tags_async(
+                client, file_path, detail_level, limiter, retry, preprocessor
+            )
+        except Exception as e:
+            results[file_path] = e
+    await asyncio.to_thread(save_pack_tags, results, hashes, cached, detail_level, None, catalog, writer, cache)
+    return results
+
+
+async def tag_files_async(untagged, detail_level="low", catalog=None, writer=None,
+                          concurrency=DEFAULT_CONCURRENCY, limiter=None, retry=None, counts=None,
+                          preprocessor=None, cache=None, duplicates=None, pack_size=1, sheet_columns=None):
+    """Tag a stream of paths with at most concurrency requests in flight.
+
+    untagged is a blocking iterator (discovery plus tag store reads), so it is
+    advanced in batches on a worker thread. A new path is only pulled once a
+    slot in the semaphore frees up, which keeps the number of pending tasks
+    bounded by concurrency. Within that, the RateLimiter decides how many
+    calls actually go out, and the RetryPolicy's circuit breaker can hold
+    them all back. With pack_size above 1, each task tags a pack of that
+    many images (see process_pack), drawn on one contact sheet when there
+    are sheet_columns, and concurrency counts packs. duplicates maps a path to near-duplicates that get its
+    tags. Images that fail are counted in counts["failed"], and images that
+    got tags from a near-duplicate in counts["propagated"].
+    """
+    limiter = limiter or RateLimiter(None, None, min(INITIAL_CONCURRENCY, concurrency), concurrency)
+    retry = retry or RetryPolicy()
+    counts = {} if counts is None else counts
+    counts.setdefault("failed", 0)
+    counts.setdefault("propagated", 0)
+    duplicates = duplicates or {}
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = set()
+    batches = iter_batches(untagged, DISCOVERY_BATCH_SIZE * pack_size)
+
+    async def tag(pack):
+        try:
+            if pack_size > 1:
+                results = await process_pack_async(
+                    client, pack, detail_level, catalog, writer, limiter, retry, preprocessor, cache, sheet_columns
+                )
+            else:
+                results = {pack[0]: await process_file_async(
+                    client, pack[0], detail_level, catalog, writer, limiter, retry, preprocessor, cache
+                )}
+            for path, tags in results.items():
+                if tags and not isinstance(tags, Exception) and duplicates.get(path):
+                    counts["propagated"] += await asyncio.to_thread(
+                        propagate_tags, path, duplicates[path], tags, detail_level, None, catalog, writer
+                    )
+        except Exception as e:
+            results = dict.fromkeys(pack, e)
+        finally:
+            semaphore.release()
+        record_results(results, duplicates, counts)
+
+    from openai import AsyncOpenAI
+
+    client = AsyncOpenAI(api_key=get_api_key(), max_retries=0, **get_transport().async_client_options())
+    async with client:
+        while True:
+            batch = await asyncio.to_thread(next, batches, None)
+            if batch is None:
+                break
+            for pack in iter_batches(batch, pack_size):
+                await semaphore.acquire()
+                task = asyncio.create_task(tag(pack))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+
+
+def process_images_async(directory_path, detail_level="low", store=None, catalog=None, discovery=None,
+                         concurrency=DEFAULT_CONCURRENCY, rpm=None, tpm=None, preprocess=True,
+                         upload_format="jpeg", cache=None, dedupe=False, dedupe_method="dhash",
+                         dedupe_threshold=DEFAULT_THRESHOLD, pack_size=1, sheet_columns=None):
+    """Like process_images, but with an asyncio engine on AsyncOpenAI instead of a thread pool."""
+    store = store or XattrTagStore()
+    directory = Path(directory_path)
+    if not directory.exists():
+        logging.error(f"Directory does not exist: {directory_path}")
+        raise FileNotFoundError(f"Directory does not exist: {directory_path}")
+
+    logging.info(f"Processing directory: {directory_path} (async engine, concurrency {concurrency})")
+    preprocessor = open_preprocessor(detail_level, upload_format, preprocess)
+    counts = {}
+    untagged = iter_untagged_files(directory, store, catalog, discovery, counts, upload_extensions(preprocessor))
+    clusters = open_clusters(untagged, dedupe_method, dedupe_threshold, dedupe)
+    duplicates = {}
+    if clusters is not None:
+        untagged, duplicates = clusters.representatives, clusters.members
+    pack_size, sheet_columns = pack_layout(pack_size, sheet_columns, preprocessor)
+    limiter = RateLimiter(rpm, tpm, min(INITIAL_CONCURRENCY, concurrency), concurrency)
+    retry = RetryPolicy()
+    started = time.monotonic()
+    with WriteBehindWriter(store, catalog) as writer:
+        try:
+            asyncio.run(
+                tag_files_async(
+                    untagged, detail_level, catalog, writer, concurrency, limiter, retry, counts, preprocessor,
+                    cache, duplicates, pack_size, sheet_columns,
+                )
+            )
+        except KeyboardInterrupt:
+            logging.warning("Interrupted, flushing queued tag writes before exiting")
+            raise
+        finally:
+            if preprocessor is not None:
+                preprocessor.close()
+    elapsed = time.monotonic() - started
+    log_run_summary(directory_path, counts, writer, store, limiter, retry, preprocessor, cache)
+    logging.info(f"Processed {counts['found'] - counts['tagged']} untagged images in {elapsed:.1f}s")
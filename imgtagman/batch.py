@@ -0,0 +1,329 @@
+import os
+import json
+import time
+import shutil
+import logging
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from imgtagman.catalog import hash_file
+from imgtagman.config import DEFAULT_POLL_INTERVAL, MAX_BATCH_REQUESTS
+from imgtagman.dedupe import DEFAULT_THRESHOLD, open_clusters
+from imgtagman.imgtag import (
+    MODEL,
+    PROMPT_VERSION,
+    THREAD_WORKERS,
+    build_tag_request,
+    get_client,
+    image_data_url,
+    iter_untagged_files,
+    make_provenance,
+    parse_tags_content,
+    propagate_tags,
+    upload_extensions,
+)
+from imgtagman.pipeline import iter_bounded
+from imgtagman.preprocess import expand_body, open_preprocessor
+from imgtagman.tag_schema import PARSE_STATS
+from imgtagman.tag_writer import WriteBehindWriter
+from imgtagman.tagstore import XattrTagStore
+from imgtagman.transport import get_transport
+
+# Kept inside the tagged directory; hidden, so discovery never walks into it
+JOB_DIR_NAME = ".imgtagman-batch"
+MANIFEST_NAME = "manifest.json"
+
+# Per-batch limit of the Batch API on input file size (see MAX_BATCH_REQUESTS for requests)
+MAX_BATCH_BYTES = 200 * 1000 * 1000
+
+ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+# Images encoded ahead of the shard writer
+ENCODE_WINDOW = 64
+
+
+class BatchJob:
+    """A tagging job split into Batch API batches, tracked in a manifest so it survives restarts.
+
+    Each shard is one JSONL input file and, once submitted, one batch. Its
+    entry records the uploaded file and batch ids, the last known status and
+    whether its results were applied, and maps each request's custom_id to
+    [path, content hash]. The manifest is rewritten after every step.
+    """
+
+    def __init__(self, job_dir, manifest):
+        self.job_dir = job_dir
+        self.manifest = manifest
+
+    @classmethod
+    def load(cls, job_dir):
+        """The job in job_dir, or None if there is none (or only a half-written one)"""
+        try:
+            with open(os.path.join(job_dir, MANIFEST_NAME), encoding="utf-8") as manifest_file:
+                return cls(job_dir, json.load(manifest_file))
+        except FileNotFoundError:
+            return None
+
+    @property
+    def shards(self):
+        return self.manifest["shards"]
+
+    @property
+    def detail_level(self):
+        return self.manifest["detail_level"]
+
+    def save(self):
+        path = os.path.join(self.job_dir, MANIFEST_NAME)
+        with open(path + ".tmp", "w", encoding="utf-8") as manifest_file:
+            json.dump(self.manifest, manifest_file)
+        os.replace(path + ".tmp", path)
+
+    def summary(self):
+        requests = sum(len(shard["requests"]) for shard in self.shards)
+        statuses = {}
+        for shard in self.shards:
+            statuses[shard["status"]] = statuses.get(shard["status"], 0) + 1
+        described = ", ".join(f"{count} {status}" for status, count in sorted(statuses.items()))
+        return f"{requests} requests in {len(self.shards)} batches ({described})"
+
+
+def _encode_request(image_path, custom_id, detail_level, preprocessor):
+    request = {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": ENDPOINT,
+        "body": build_tag_request(image_data_url(image_path, preprocessor), detail_level),
+    }
+    # An unprocessed image is encoded straight into the line, so it is held once
+    return expand_body((json.dumps(request) + "\n").encode("utf-8"))
+
+
+def prepare_job(job_dir, untagged, detail_level, writer, catalog=None, cache=None, preprocessor=None,
+                duplicates=None, max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_BYTES):
+    """Write the requests for untagged images as JSONL shards within the Batch API limits.
+
+    Images are encoded on a thread pool (and the preprocessing pool) while
+    the shards are written, so no more than a window of encoded images is
+    held in memory. Images the TagCache already knows are tagged right away
+    instead. The manifest is only saved once every shard is complete.
+    """
+    os.makedirs(job_dir)
+    duplicates = duplicates or {}
+    shards = []
+    counts = {"cached": 0, "propagated": 0, "failed": 0}
+    shard_file = None
+
+    def encode(item):
+        custom_id, image_path = item
+        content_hash = hash_file(image_path) if catalog is not None or cache is not None else None
+        if cache is not None:
+            tags = cache.get(content_hash, MODEL, PROMPT_VERSION, detail_level)
+            if tags is not None:
+                return None, tags, content_hash
+        return _encode_request(image_path, custom_id, detail_level, preprocessor), None, content_hash
+
+    items = ((str(n), image_path) for n, image_path in enumerate(untagged))
+    try:
+        with ThreadPoolExecutor(THREAD_WORKERS) as executor:
+            for (custom_id, image_path), future in iter_bounded(executor, encode, items, ENCODE_WINDOW):
+                try:
+                    line, tags, content_hash = future.result()
+                except Exception as e:
+                    counts["failed"] += 1
+                    logging.error(f"Cannot prepare {image_path} for the batch: {e}")
+                    continue
+                if tags is not None:
+                    counts["cached"] += 1
+                    writer.submit(image_path, tags, make_provenance(detail_level, cached=True), content_hash)
+                    counts["propagated"] += propagate_tags(
+                        image_path, duplicates.get(image_path, ()), tags, detail_level, None, catalog, writer
+                    )
+                    continue
+                if len(line) > max_bytes:
+                    counts["failed"] += 1
+                    logging.error(f"{image_path} is too large for a batch input file, skipping it")
+                    continue
+                shard = shards[-1] if shards else None
+                if shard is None or len(shard["requests"]) >= max_requests or shard["bytes"] + len(line) > max_bytes:
+                    if shard_file is not None:
+                        shard_file.close()
+                    name = f"requests-{len(shards):04d}.jsonl"
+                    shard = {"file": name, "bytes": 0, "requests": {}, "status": "prepared"}
+                    shards.append(shard)
+                    shard_file = open(os.path.join(job_dir, name), "wb")
+                shard_file.write(line)
+                shard["bytes"] += len(line)
+                shard["requests"][custom_id] = [str(image_path), content_hash]
+    finally:
+        if shard_file is not None:
+            shard_file.close()
+
+    job = BatchJob(job_dir, {
+        "model": MODEL,
+        "prompt_version": PROMPT_VERSION,
+        "detail_level": detail_level,
+        "created_at": time.time(),
+        "shards": shards,
+        "duplicates": {str(path): [str(member) for member in members]
+                       for path, members in duplicates.items() if members},
+    })
+    job.save()
+    logging.info(
+        f"Prepared {job.summary()}; {counts['cached']} images (and {counts['propagated']} near-duplicates) "
+        f"tagged from the cache, {counts['failed']} skipped"
+    )
+    return job
+
+
+def submit_job(job):
+    """Upload and submit every shard not submitted yet"""
+    for shard in job.shards:
+        if shard.get("input_file_id") is None:
+            with open(os.path.join(job.job_dir, shard["file"]), "rb") as shard_file:
+                shard["input_file_id"] = get_client().files.create(file=shard_file, purpose="batch").id
+            job.save()
+            logging.info(f"Uploaded {shard['file']} ({shard['bytes'] / 1e6:.1f} MB) as {shard['input_file_id']}")
+        if shard.get("batch_id") is None:
+            batch = get_client().batches.create(
+                input_file_id=shard["input_file_id"],
+                endpoint=ENDPOINT,
+                completion_window=COMPLETION_WINDOW,
+                metadata={"source": "imgtagman", "shard": shard["file"]},
+            )
+            shard["batch_id"] = batch.id
+            shard["status"] = batch.status
+            job.save()
+            logging.info(f"Submitted {shard['file']} as batch {batch.id} ({len(shard['requests'])} requests)")
+
+
+def apply_results(job, shard, writer, catalog=None, cache=None):
+    """Write the tags from a finished batch's output file; returns (tagged, failed, propagated)"""
+    tagged = propagated = 0
+    duplicates = job.manifest["duplicates"]
+    provenance = make_provenance(job.detail_level)
+    provenance["batch_id"] = shard["batch_id"]
+    if shard.get("output_file_id"):
+        for line in get_client().files.content(shard["output_file_id"]).iter_lines():
+            if not line:
+                continue
+            result = json.loads(line)
+            image_path, content_hash = shard["requests"].get(result.get("custom_id"), (None, None))
+            response = result.get("response") or {}
+            if image_path is None or result.get("error") or response.get("status_code") != 200:
+                logging.error(f"Batch request for {image_path} failed: {result.get('error') or response}")
+                continue
+            try:
+                content = response["body"]["choices"][0]["message"]["content"]
+            except (KeyError, IndexError, TypeError) as e:
+                logging.error(f"Unexpected batch response for {image_path}: {e}")
+                continue
+            tags = parse_tags_content(content)
+            if not tags:
+                logging.warning(f"No tags were generated for {image_path}")
+                continue
+            writer.submit(image_path, tags, provenance, content_hash)
+            if cache is not None and content_hash is not None:
+                cache.put(content_hash, job.manifest["model"], job.manifest["prompt_version"], job.detail_level,
+                          tags)
+            propagated += propagate_tags(image_path, duplicates.get(image_path, ()), tags, job.detail_level, None,
+                                         catalog, writer)
+            tagged += 1
+    failed = len(shard["requests"]) - tagged
+    shard["applied"] = True
+    job.save()
+    logging.info(f"Applied batch {shard['batch_id']} ({shard['status']}): {tagged} tagged, {failed} failed")
+    return tagged, failed, propagated
+
+
+def wait_for_job(job, writer, catalog=None, cache=None, poll_interval=DEFAULT_POLL_INTERVAL):
+    """Poll the job's batches until all are finished, applying each one's results as it completes"""
+    totals = {"tagged": 0, "failed": 0, "propagated": 0}
+    while True:
+        pending = [shard for shard in job.shards if not shard.get("applied")]
+        if not pending:
+            return totals
+        for shard in pending:
+            batch = get_client().batches.retrieve(shard["batch_id"])
+            if batch.status != shard["status"]:
+                logging.info(f"Batch {batch.id} is {batch.status}")
+            shard["status"] = batch.status
+            shard["output_file_id"] = batch.output_file_id
+            shard["error_file_id"] = batch.error_file_id
+            job.save()
+            if batch.status in TERMINAL_STATUSES:
+                for total, value in zip(("tagged", "failed", "propagated"),
+                                        apply_results(job, shard, writer, catalog, cache)):
+                    totals[total] += value
+            elif batch.request_counts is not None:
+                counts = batch.request_counts
+                logging.info(f"Batch {batch.id}: {counts.completed + counts.failed} of {counts.total} done")
+        if any(not shard.get("applied") for shard in job.shards):
+            time.sleep(poll_interval)
+
+
+def process_images_batch(directory_path, detail_level="low", store=None, catalog=None, discovery=None,
+                         preprocess=True, upload_format="jpeg", cache=None, dedupe=False, dedupe_method="dhash",
+                         dedupe_threshold=DEFAULT_THRESHOLD, poll_interval=DEFAULT_POLL_INTERVAL, wait=True,
+                         max_requests=MAX_BATCH_REQUESTS):
+    """Tag a directory's untagged images through the Batch API instead of live calls.
+
+    Batches cost half as much and are not held to the live rate limits, but
+    may take up to 24 hours. The job is tracked in a manifest under the
+    directory: running again resumes it (uploading, submitting, polling or
+    applying whatever is left) instead of starting a new one, so the process
+    can be stopped at any point. With wait=False the call returns once the
+    batches are submitted.
+    """
+    store = store or XattrTagStore()
+    directory = Path(directory_path)
+    if not directory.exists():
+        logging.error(f"Directory does not exist: {directory_path}")
+        raise FileNotFoundError(f"Directory does not exist: {directory_path}")
+
+    job_dir = os.path.join(directory, JOB_DIR_NAME)
+    with WriteBehindWriter(store, catalog) as writer:
+        job = BatchJob.load(job_dir)
+        if job is not None:
+            logging.info(f"Resuming batch job: {job.summary()}")
+            if job.detail_level != detail_level:
+                logging.warning(f"The job was started with detail level {job.detail_level}, keeping it")
+        else:
+            if os.path.isdir(job_dir):
+                # Left behind by an interrupted prepare_job
+                shutil.rmtree(job_dir)
+            preprocessor = open_preprocessor(detail_level, upload_format, preprocess)
+            try:
+                untagged = iter_untagged_files(
+                    directory, store, catalog, discovery, None, upload_extensions(preprocessor)
+                )
+                clusters = open_clusters(untagged, dedupe_method, dedupe_threshold, dedupe)
+                duplicates = {}
+                if clusters is not None:
+                    untagged, duplicates = clusters.representatives, clusters.members
+                job = prepare_job(job_dir, untagged, detail_level, writer, catalog, cache, preprocessor,
+                                  duplicates, max_requests)
+            finally:
+                if preprocessor is not None:
+                    preprocessor.close()
+
+        try:
+            submit_job(job)
+            if not wait:
+                logging.info(f"Batches submitted; run tag --batch again on {directory_path} to collect the results")
+                return
+            totals = wait_for_job(job, writer, catalog, cache, poll_interval)
+        except KeyboardInterrupt:
+            logging.warning(f"Interrupted; run tag --batch again on {directory_path} to resume the batch job")
+            raise
+
+    shutil.rmtree(job_dir)
+    logging.info(f"Batch job finished: {job.summary()}")
+    logging.info(f"Tag writes: {writer.summary()}; store: {store.summary()}")
+    if PARSE_STATS.total:
+        logging.info(f"Responses: {PARSE_STATS.summary()}")
+    logging.info(f"Connections: {get_transport().summary()}")
+    if totals["propagated"]:
+        logging.info(f"Copied tags to {totals['propagated']} near-duplicates instead of calling the API for them")
+    if totals["failed"]:
+        logging.warning(f"{totals['failed']} images failed and are still untagged; run tag again to retry them")
@@ -0,0 +1,426 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import Counter
+from itertools import count
+from contextlib import contextmanager
+from imgtagman.discovery import Discovery
+from imgtagman.pipeline import iter_batches
+from imgtagman.tagstore import SQLITE_CHUNK_SIZE
+
+CATALOG_NAME = ".imgtagman-catalog.sqlite3"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ctime_ns INTEGER NOT NULL,
+    content_hash TEXT,
+    tags TEXT NOT NULL DEFAULT '[]',
+    provenance TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+CREATE TABLE IF NOT EXISTS tag_stats (
+    tag TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tag_samples (
+    tag TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (tag, path)
+) WITHOUT ROWID;
+"""
+
+# Example files remembered per tag for summaries
+SAMPLE_SIZE = 5
+
+# Discovered files looked up, and new or changed ones read from the tag
+# store, per catalog transaction during a refresh
+REFRESH_BATCH_SIZE = 256
+
+# Names the temporary table of each refresh, since refreshes may share a connection
+_refresh_ids = count()
+
+# Bumped in the same transaction as every change to files, so derived data
+# (the tag index) can tell whether it is stale.
+BUMP_GENERATION = (
+    "INSERT INTO meta (key, value) VALUES ('generation', 1) "
+    "ON CONFLICT(key) DO UPDATE SET value = value + 1"
+)
+
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stat_key(stat):
+    """The part of a stat result that tells us whether a file changed"""
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns)
+
+
+class Catalog:
+    """Persistent record of every image we have seen and the tags it carries.
+
+    Rows are keyed on absolute path and remember the (inode, size, mtime,
+    ctime) tuple observed when the tags were last read or written. With
+    tags in extended attributes, a refresh only goes back to the tag store
+    for files whose stat changed: writing an attribute bumps ctime, which
+    means tags edited outside imgtagman are picked up too. Other stores
+    leave the image untouched, so their tags are re-read on every refresh.
+
+    A catalog mirrors one tag store (see TagStore.spec); opened with a
+    different one, it is cleared and rebuilt by the next refresh.
+    """
+
+    def __init__(self, db_path, store=None):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+        with self._lock, self._conn:
+            if self._conn.execute("SELECT 1 FROM meta WHERE key = 'stats_built'").fetchone() is None:
+                # Catalogs created before tag statistics existed: build them once
+                self._rebuild_stats()
+        if store is not None:
+            self._bind_store(store.spec)
+
+    def _bind_store(self, spec):
+        """Tie the catalog to the tag store it mirrors, clearing it if it was built from another one"""
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'store'").fetchone()
+            if row is not None and row[0] == spec:
+                return
+            if self._conn.execute("SELECT 1 FROM files LIMIT 1").fetchone() is not None:
+                logging.warning(
+                    f"Catalog {self.db_path} was built from {row[0] if row else 'an unknown'} tag store, "
+                    f"rebuilding it for {spec}"
+                )
+                self._conn.execute("DELETE FROM files")
+                self._conn.execute("DELETE FROM tag_stats")
+                self._conn.execute("DELETE FROM tag_samples")
+                self._conn.execute(BUMP_GENERATION)
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('store', ?)", (spec,))
+
+    @contextmanager
+    def transaction(self):
+        """Hold the catalog lock and yield the connection inside a transaction"""
+        with self._lock, self._conn:
+            yield self._conn
+
+    def generation(self):
+        """A counter that changes whenever any file's tags change"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return row[0] if row else 0
+
+    def _load_rows(self, paths):
+        """Return {path: (stat_key, content_hash, tags)} for the rows of the given absolute paths"""
+        found = {}
+        for start in range(0, len(paths), SQLITE_CHUNK_SIZE):
+            chunk = paths[start:start + SQLITE_CHUNK_SIZE]
+            rows = self._conn.execute(
+                "SELECT path, inode, size, mtime_ns, ctime_ns, content_hash, tags FROM files "
+                f"WHERE path IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            found.update(
+                (path, ((inode, size, mtime_ns, ctime_ns), content_hash, tags))
+                for path, inode, size, mtime_ns, ctime_ns, content_hash, tags in rows
+            )
+        return found
+
+    def refresh(self, directory, store, discovery=None):
+        """Bring the catalog up to date for the images a Discovery finds under directory.
+
+        Returns a path -> tags map keyed like the discovered paths; see iter_refresh.
+        """
+        return dict(self.iter_refresh(directory, store, discovery))
+
+    def iter_refresh(self, directory, store, discovery=None, batch_size=REFRESH_BATCH_SIZE):
+        """Refresh the catalog while yielding (path, tags) as files are discovered.
+
+        Discovered files are handled batch_size at a time, looking up only
+        their own rows, so memory stays bounded however large the catalog.
+        Tags of unchanged files come from the catalog; new or changed files,
+        and every file when the store keeps its tags outside the image, are
+        read from the store. Once discovery is exhausted, rows it would have
+        found but did not (deleted files) are dropped; rows outside its scope
+        are left alone. Abandoning the generator early skips that pruning.
+        """
+        discovery = discovery or Discovery()
+        root = os.path.abspath(directory)
+        # The paths discovered so far, kept in SQLite rather than in memory
+        seen = f"temp.seen_{next(_refresh_ids)}"
+        with self._lock, self._conn:
+            self._conn.execute(f"CREATE TEMP TABLE {seen} (path TEXT PRIMARY KEY) WITHOUT ROWID")
+        try:
+            unchanged = 0
+            changed = 0
+            for entries in iter_batches(discovery.iter_entries(directory), batch_size):
+                found = []
+                for entry in entries:
+                    try:
+                        found.append((entry, os.path.abspath(entry.path), entry.stat()))
+                    except FileNotFoundError:
+                        # Deleted since it was listed: left out of seen, so its row is pruned
+                        continue
+                with self._lock, self._conn:
+                    known = self._load_rows([abs_path for _, abs_path, _ in found])
+                    self._conn.executemany(
+                        f"INSERT OR IGNORE INTO {seen} (path) VALUES (?)", [(abs_path,) for _, abs_path, _ in found]
+                    )
+                batch = {}
+                for entry, abs_path, stat in found:
+                    row = known.get(abs_path)
+                    if store.tags_in_file and row is not None and row[0] == stat_key(stat):
+                        unchanged += 1
+                        yield entry.path, json.loads(row[2])
+                    else:
+                        batch[entry.path] = (abs_path, stat, row)
+                if batch:
+                    batch_changed = yield from self._refresh_batch(batch, store)
+                    changed += batch_changed
+                    unchanged += len(batch) - batch_changed
+
+            removed = self._prune(root, seen, discovery, batch_size)
+        finally:
+            with self._lock, self._conn:
+                self._conn.execute(f"DROP TABLE IF EXISTS {seen}")
+
+        logging.info(
+            f"Catalog refresh of {root}: {unchanged} unchanged, "
+            f"{changed} new or changed, {removed} removed"
+        )
+
+    def _prune(self, root, seen, discovery, batch_size):
+        """Drop rows under root that discovery would consider but did not find, returning how many"""
+        prefix = os.path.join(root, "")
+        end = prefix[:-1] + chr(ord(os.sep) + 1)
+        removed = 0
+        after = prefix
+        while True:
+            with self._lock, self._conn:
+                rows = self._conn.execute(
+                    "SELECT path, tags FROM files WHERE path > ? AND path < ? "
+                    f"AND path NOT IN (SELECT path FROM {seen}) ORDER BY path LIMIT ?",
+                    (after, end, batch_size),
+                ).fetchall()
+                stale = [(path, tags) for path, tags in rows if discovery.in_scope(root, path)]
+                if stale:
+                    self._update_stats((path, json.loads(tags), []) for path, tags in stale)
+                    self._conn.executemany("DELETE FROM files WHERE path = ?", [(path,) for path, _ in stale])
+                    self._conn.execute(BUMP_GENERATION)
+            removed += len(stale)
+            if len(rows) < batch_size:
+                return removed
+            # Rows left out of scope are kept, so continue after the last one looked at
+            after = rows[-1][0]
+
+    def _refresh_batch(self, batch, store):
+        """Read the tags of new or changed files from the store and upsert the rows that differ, returning how many"""
+        read_tags = store.get_many(batch)
+        now = time.time()
+        upserts = []
+        changes = []
+        for path, (abs_path, stat, row) in batch.items():
+            old_tags = json.loads(row[2]) if row is not None else []
+            if row is not None and row[0] == stat_key(stat) and old_tags == read_tags[path]:
+                # Re-read from a store that keeps tags outside the file, and unchanged
+                continue
+            # A ctime-only change (e.g. a tag edit) leaves the content hash valid
+            content_hash = row[1] if row is not None and row[0][:3] == stat_key(stat)[:3] else None
+            upserts.append(
+                (abs_path, *stat_key(stat), content_hash, json.dumps(read_tags[path], ensure_ascii=False), now)
+            )
+            changes.append((abs_path, old_tags, read_tags[path]))
+        if upserts:
+            with self._lock, self._conn:
+                self._update_stats(changes)
+                self._conn.executemany(
+                    "INSERT INTO files (path, inode, size, mtime_ns, ctime_ns, content_hash, tags, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(path) DO UPDATE SET inode=excluded.inode, size=excluded.size, "
+                    "mtime_ns=excluded.mtime_ns, ctime_ns=excluded.ctime_ns, "
+                    "content_hash=excluded.content_hash, tags=excluded.tags, updated_at=excluded.updated_at",
+                    upserts,
+                )
+                self._conn.execute(BUMP_GENERATION)
+        for path in batch:
+            yield path, read_tags[path]
+        return len(upserts)
+
+    def record_tags(self, file_path, tags, provenance=None, content_hash=None):
+        """Record tags we just wrote, with the file's post-write stat"""
+        self.record_many([(file_path, tags, provenance, content_hash)])
+
+    def record_many(self, records):
+        """Record many (path, tags, provenance, content_hash) writes in one transaction"""
+        now = time.time()
+        rows = []
+        vanished = []
+        for file_path, tags, provenance, content_hash in records:
+            abs_path = os.path.abspath(file_path)
+            try:
+                stat = os.stat(abs_path)
+            except FileNotFoundError:
+                # Deleted since its tags were written: drop its row instead
+                vanished.append(abs_path)
+                continue
+            rows.append(
+                (
+                    abs_path,
+                    *stat_key(stat),
+                    content_hash,
+                    json.dumps(list(tags), ensure_ascii=False),
+                    json.dumps(provenance) if provenance else None,
+                    now,
+                )
+            )
+        with self._lock, self._conn:
+            old_tags = self._tags_of([row[0] for row in rows] + vanished)
+            self._update_stats((row[0], old_tags.get(row[0], []), json.loads(row[6])) for row in rows)
+            self._update_stats((path, old_tags[path], []) for path in vanished if path in old_tags)
+            self._conn.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in vanished])
+            self._conn.executemany(
+                "INSERT INTO files (path, inode, size, mtime_ns, ctime_ns, content_hash, tags, provenance, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET inode=excluded.inode, size=excluded.size, "
+                "mtime_ns=excluded.mtime_ns, ctime_ns=excluded.ctime_ns, "
+                "content_hash=COALESCE(excluded.content_hash, files.content_hash), tags=excluded.tags, "
+                "provenance=excluded.provenance, updated_at=excluded.updated_at",
+                rows,
+            )
+            self._conn.execute(BUMP_GENERATION)
+
+    def _tags_of(self, abs_paths):
+        """Return {path: tags} for the given catalog paths; caller holds the lock"""
+        found = {}
+        for start in range(0, len(abs_paths), SQLITE_CHUNK_SIZE):
+            chunk = abs_paths[start:start + SQLITE_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self._conn.execute(f"SELECT path, tags FROM files WHERE path IN ({placeholders})", chunk)
+            found.update((path, json.loads(tags)) for path, tags in rows)
+        return found
+
+    def _update_stats(self, changes):
+        """Apply (path, old_tags, new_tags) changes to the tag statistics; caller holds the transaction"""
+        deltas = Counter()
+        added_samples = []
+        removed_samples = []
+        for path, old_tags, new_tags in changes:
+            old = {tag.strip() for tag in old_tags if tag.strip()}
+            new = {tag.strip() for tag in new_tags if tag.strip()}
+            for tag in old - new:
+                deltas[tag] -= 1
+                removed_samples.append((tag, path))
+            for tag in new - old:
+                deltas[tag] += 1
+                added_samples.append((tag, path, tag, SAMPLE_SIZE))
+        if not deltas and not removed_samples:
+            return
+        self._conn.executemany(
+            "INSERT INTO tag_stats (tag, count) VALUES (?, ?) "
+            "ON CONFLICT(tag) DO UPDATE SET count = count + excluded.count",
+            [(tag, delta) for tag, delta in deltas.items() if delta],
+        )
+        self._conn.execute("DELETE FROM tag_stats WHERE count <= 0")
+        self._conn.executemany("DELETE FROM tag_samples WHERE tag = ? AND path = ?", removed_samples)
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO tag_samples (tag, path) "
+            "SELECT ?, ? WHERE (SELECT COUNT(*) FROM tag_samples WHERE tag = ?) < ?",
+            added_samples,
+        )
+
+    def _rebuild_stats(self):
+        """Recompute the tag statistics from scratch; caller holds the transaction"""
+        self._conn.execute("DELETE FROM tag_stats")
+        self._conn.execute("DELETE FROM tag_samples")
+        self._update_stats(
+            (path, [], json.loads(tags)) for path, tags in self._conn.execute("SELECT path, tags FROM files")
+        )
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('stats_built', 1)")
+
+    def tag_stats(self, top=None):
+        """Return [(tag, count, sample_paths)] ordered by count, from the materialized statistics"""
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                "SELECT tag, count FROM tag_stats ORDER BY count DESC, tag LIMIT ?",
+                (top if top is not None else -1,),
+            ).fetchall()
+            stats = []
+            for tag, count in rows:
+                samples = [
+                    path for (path,) in self._conn.execute(
+                        "SELECT path FROM tag_samples WHERE tag = ? ORDER BY path", (tag,)
+                    )
+                ]
+                if len(samples) < min(count, SAMPLE_SIZE):
+                    # Samples are dropped when files lose the tag; top them up from the files table
+                    samples = [
+                        path for (path,) in self._conn.execute(
+                            "SELECT DISTINCT files.path FROM files, json_each(files.tags) "
+                            "WHERE trim(json_each.value) = ? ORDER BY files.path LIMIT ?",
+                            (tag, SAMPLE_SIZE),
+                        )
+                    ]
+                    self._conn.executemany(
+                        "INSERT OR IGNORE INTO tag_samples (tag, path) VALUES (?, ?)",
+                        [(tag, path) for path in samples],
+                    )
+                stats.append((tag, count, samples))
+        return stats
+
+    def get(self, file_path):
+        """Return the catalog row of a file as a dict, or None"""
+        with self._lock:
+            cursor = self._conn.execute("SELECT * FROM files WHERE path = ?", (os.path.abspath(file_path),))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        record = dict(zip([column[0] for column in cursor.description], row))
+        record["tags"] = json.loads(record["tags"])
+        record["provenance"] = json.loads(record["provenance"]) if record["provenance"] else None
+        return record
+
+    def paths_for_ids(self, ids):
+        """Map catalog row ids back to paths, preserving order"""
+        ids = list(ids)
+        found = {}
+        with self._lock:
+            for start in range(0, len(ids), SQLITE_CHUNK_SIZE):
+                chunk = ids[start:start + SQLITE_CHUNK_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                found.update(self._conn.execute(f"SELECT id, path FROM files WHERE id IN ({placeholders})", chunk))
+        return [found[row_id] for row_id in ids if row_id in found]
+
+    def close(self):
+        self._conn.close()
+
+
+def open_catalog(catalog_path, directory=".", store=None):
+    """Open the catalog for a directory and tag store; returns None if it cannot be created (e.g. read-only media)."""
+    catalog_path = catalog_path or os.path.join(directory, CATALOG_NAME)
+    try:
+        return Catalog(catalog_path, store)
+    except sqlite3.Error as e:
+        logging.warning(f"Catalog disabled, cannot open {catalog_path}: {e}")
+        return None
@@ -0,0 +1,23 @@
+import logging
+
+# Settings the command line shows as defaults, kept apart from the modules
+# that use them so that commands making no API calls never import those
+
+# Images per packed request (tag --pack)
+DEFAULT_PACK_SIZE = 4
+
+# Vision calls in flight at once with --engine async; they are almost entirely network wait
+DEFAULT_CONCURRENCY = 256
+
+# Requests per input file the Batch API accepts
+MAX_BATCH_REQUESTS = 50_000
+
+# How often tag --batch checks on submitted batches
+DEFAULT_POLL_INTERVAL = 60.0
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+def setup_logging(level=logging.INFO):
+    """Log to stderr in the format the Electron app reads; called by the entry points, not on import"""
+    logging.basicConfig(level=level, format=LOG_FORMAT)
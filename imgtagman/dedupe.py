@@ -0,0 +1,225 @@
+import os
+import logging
+from functools import partial
+from imgtagman.pipeline import iter_batches, iter_bounded
+
+# NumPy and Pillow are optional (pip install imgtagman[dedupe]) and only
+# imported by _load_dependencies once hashing is asked for
+np = None
+Image = None
+ImageOps = None
+
+HASH_SIZE = 8
+
+# pHash looks at the low frequencies of a 32x32 thumbnail
+PHASH_SIZE = 32
+
+HASH_METHODS = ("dhash", "phash")
+
+# Bits (of 64) two hashes may differ by and still count as the same picture.
+# Kept low on purpose: a wrong match copies tags onto an unrelated image.
+DEFAULT_THRESHOLD = 6
+
+# Files per task sent to the hashing pool
+HASH_CHUNK_SIZE = 16
+
+# Tasks queued per hashing worker, enough to keep them busy without reading ahead of the hashing
+HASH_TASKS_PER_WORKER = 2
+
+# Thumbnails hashed per vectorized pass
+HASH_BATCH_SIZE = 4096
+
+
+def _load_dependencies():
+    """Import NumPy and Pillow on first use, returning False if either is missing"""
+    global np, Image, ImageOps
+    if np is None:
+        try:
+            import numpy
+            from PIL import Image as PILImage, ImageOps as PILImageOps
+        except ImportError:
+            return False
+        np, Image, ImageOps = numpy, PILImage, PILImageOps
+    return True
+
+
+def _thumbnail_size(method):
+    if method == "dhash":
+        # One extra column so every row has HASH_SIZE horizontal gradients
+        return HASH_SIZE + 1, HASH_SIZE
+    return PHASH_SIZE, PHASH_SIZE
+
+
+def load_grayscale(image_path, size):
+    """(pixel count, grayscale thumbnail bytes) of an image, or None if it cannot be decoded.
+
+    Runs in the hashing pool. EXIF orientation is applied so a rotated
+    re-save still matches its original.
+    """
+    _load_dependencies()
+    try:
+        with Image.open(image_path) as image:
+            image.draft("L", size)
+            image = ImageOps.exif_transpose(image)
+            pixels = image.size[0] * image.size[1]
+            return pixels, image.convert("L").resize(size, Image.LANCZOS).tobytes()
+    except Exception as e:
+        logging.warning(f"Cannot hash {image_path}, it will be tagged on its own: {e}")
+        return None
+
+
+def load_grayscale_chunk(image_paths, size):
+    """[(path, load_grayscale result)] for one pool task's worth of images"""
+    return [(image_path, load_grayscale(image_path, size)) for image_path in image_paths]
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    return np.cos(np.pi * (2 * k.T + 1) * k / (2 * n))
+
+
+def _pack(bits):
+    """(N, 64) booleans -> N Python ints"""
+    return np.packbits(bits.reshape(len(bits), -1), axis=1).view(">u8").ravel().tolist()
+
+
+def dhash(thumbnails):
+    """Difference hashes of an (N, 8, 9) stack of grayscale thumbnails"""
+    return _pack(thumbnails[:, :, 1:] > thumbnails[:, :, :-1])
+
+
+def phash(thumbnails):
+    """DCT hashes of an (N, 32, 32) stack: bits of the 8x8 lowest frequencies above their median"""
+    dct = _dct_matrix(PHASH_SIZE)
+    low = (dct @ thumbnails @ dct.T)[:, :HASH_SIZE, :HASH_SIZE].reshape(len(thumbnails), -1)
+    return _pack(low > np.median(low, axis=1, keepdims=True))
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """Metric tree over 64-bit hashes answering "everything within r bits" without a full scan"""
+
+    def __init__(self):
+        self._root = None
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+        node = [value, item, {}]
+        if self._root is None:
+            self._root = node
+            return
+        current = self._root
+        while True:
+            distance = hamming(value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def find(self, value, radius):
+        """(distance, item) pairs within radius of value"""
+        found = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node_value, item, children = stack.pop()
+            distance = hamming(value, node_value)
+            if distance <= radius:
+                found.append((distance, item))
+            # Triangle inequality: only subtrees at distance - r .. distance + r can hold matches
+            for child_distance, child in children.items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return found
+
+
+class DuplicateClusters:
+    """Near-duplicate groups among a set of images, each with a representative to tag.
+
+    members maps each representative to the other paths in its cluster.
+    The representative is the cluster's largest image, so the API sees the
+    most detailed copy.
+    """
+
+    def __init__(self, representatives, members):
+        self.representatives = representatives
+        self.members = members
+        self.images = len(representatives) + sum(len(paths) for paths in members.values())
+
+    def summary(self):
+        clustered = [paths for paths in self.members.values() if paths]
+        largest = max((len(paths) + 1 for paths in clustered), default=0)
+        return (
+            f"{self.images} images in {len(self.representatives)} clusters, {len(clustered)} with near-duplicates "
+            f"(largest {largest}), {self.images - len(self.representatives)} API calls saved"
+        )
+
+
+def cluster_images(paths, method="dhash", threshold=DEFAULT_THRESHOLD, workers=None):
+    """Group near-duplicate images by perceptual hash.
+
+    Images are decoded to small grayscale thumbnails in a process pool and
+    hashed with NumPy a batch at a time. Then, largest first, each image joins the
+    nearest representative within threshold bits (found through a BK-tree)
+    or becomes a representative itself; comparing against representatives
+    only keeps clusters from drifting through chains of small differences.
+    Images that cannot be decoded form clusters of their own.
+    """
+    _load_dependencies()
+    workers = workers or os.cpu_count() or 1
+    size = _thumbnail_size(method)
+    hash_batch = dhash if method == "dhash" else phash
+    hashed = []
+    representatives = []
+    # Imported here, like NumPy, so that importing the module stays cheap
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        # Paths are fed to the pool through a bounded window and thumbnails are
+        # hashed as they arrive, so at most one batch of them (plus the tasks in
+        # flight) is held at a time
+        tasks = iter_bounded(
+            pool, partial(load_grayscale_chunk, size=size), iter_batches(paths, HASH_CHUNK_SIZE),
+            workers * HASH_TASKS_PER_WORKER,
+        )
+        loaded = (result for _, task in tasks for result in task.result())
+        for batch in iter_batches(loaded, HASH_BATCH_SIZE):
+            decoded = [(path, result) for path, result in batch if result is not None]
+            representatives.extend(path for path, result in batch if result is None)
+            if not decoded:
+                continue
+            thumbnails = np.stack(
+                [np.frombuffer(data, np.uint8).reshape(size[1], size[0]) for _, (_, data) in decoded]
+            ).astype(np.float32)
+            hashed.extend(
+                (pixels, path, value) for (path, (pixels, _)), value in zip(decoded, hash_batch(thumbnails))
+            )
+
+    members = {path: [] for path in representatives}
+    tree = BKTree()
+    for _, path, value in sorted(hashed, key=lambda entry: -entry[0]):
+        matches = tree.find(value, threshold)
+        if matches:
+            members[min(matches)[1]].append(path)
+        else:
+            tree.add(value, path)
+            representatives.append(path)
+            members[path] = []
+    return DuplicateClusters(representatives, members)
+
+
+def open_clusters(paths, method="dhash", threshold=DEFAULT_THRESHOLD, enabled=True):
+    """DuplicateClusters for paths, or None (every image tagged on its own) when disabled or unavailable"""
+    if not enabled:
+        return None
+    if not _load_dependencies():
+        logging.warning("NumPy and Pillow are needed to find near-duplicates (pip install imgtagman[dedupe])")
+        return None
+    clusters = cluster_images(paths, method, threshold)
+    logging.info(f"Near-duplicates: {clusters.summary()}")
+    return clusters
@@ -0,0 +1,138 @@
+import os
+import copy
+import fnmatch
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tif", ".tiff", ".webp"}
+
+
+class Discovery:
+    """Finds the images under a directory.
+
+    Every directory is read with a single os.scandir call and subtrees are
+    scanned in parallel on a small thread pool, which keeps many metadata
+    requests in flight on network filesystems. File stats are fetched by the
+    workers through DirEntry.stat(), so later entry.stat() calls (e.g. from
+    the catalog) are free.
+
+    max_depth limits recursion (0 = only the directory itself, None = no
+    limit). exclude holds glob patterns matched against both the name and
+    the path relative to the root. Hidden files and directories are skipped
+    unless include_hidden is set, and symlinks are only followed with
+    follow_symlinks (directory loops are detected). A directory or file that
+    cannot be read (permissions, I/O errors, stale NFS handles, symlink
+    loops) is logged and skipped rather than ending the walk.
+    """
+
+    def __init__(self, extensions=IMAGE_EXTENSIONS, max_depth=None, exclude=(), include_hidden=False,
+                 follow_symlinks=False, workers=8):
+        self.extensions = {extension.lower() for extension in extensions}
+        self.max_depth = max_depth
+        self.exclude = list(exclude)
+        self.include_hidden = include_hidden
+        self.follow_symlinks = follow_symlinks
+        self.workers = workers
+
+    def replace(self, **changes):
+        """Return a copy with some options changed"""
+        discovery = copy.copy(self)
+        for name, value in changes.items():
+            setattr(discovery, name, value)
+        return discovery
+
+    def _skipped(self, name, relative_path):
+        if not self.include_hidden and name.startswith("."):
+            return True
+        return any(
+            fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relative_path, pattern) for pattern in self.exclude
+        )
+
+    def _is_image(self, name):
+        return os.path.splitext(name)[1].lower() in self.extensions
+
+    def _scan(self, root, directory, depth):
+        """Read one directory, returning its image entries and the subdirectories to descend into"""
+        files = []
+        subdirectories = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    relative_path = os.path.relpath(entry.path, root)
+                    if self._skipped(entry.name, relative_path):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=self.follow_symlinks):
+                            if self.max_depth is None or depth < self.max_depth:
+                                key = None
+                                if self.follow_symlinks:
+                                    stat = entry.stat()
+                                    key = (stat.st_dev, stat.st_ino)
+                                subdirectories.append((entry.path, key))
+                        elif self._is_image(entry.name) and entry.is_file(follow_symlinks=self.follow_symlinks):
+                            entry.stat(follow_symlinks=self.follow_symlinks)
+                            files.append(entry)
+                    except FileNotFoundError:
+                        # Removed while we were scanning
+                        continue
+                    except OSError as e:
+                        logging.warning(f"Skipping {entry.path}: {e}")
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # Also raised part way through a listing; keep what was read before the error
+            logging.warning(f"Cannot read directory {directory}: {e}")
+        return files, subdirectories
+
+    def iter_entries(self, root):
+        """Yield the os.DirEntry of every image under root, in no particular order"""
+        root = os.fspath(root)
+        visited = set()
+        if self.follow_symlinks:
+            stat = os.stat(root)
+            visited.add((stat.st_dev, stat.st_ino))
+
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            pending = {executor.submit(self._scan, root, root, 0): 0}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    depth = pending.pop(future)
+                    files, subdirectories = future.result()
+                    for subdirectory, key in subdirectories:
+                        if key is not None:
+                            if key in visited:
+                                continue
+                            visited.add(key)
+                        pending[executor.submit(self._scan, root, subdirectory, depth + 1)] = depth + 1
+                    yield from files
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def iter_paths(self, root):
+        """Yield the path of every image under root"""
+        for entry in self.iter_entries(root):
+            yield entry.path
+
+    def in_scope(self, root, path):
+        """Whether a discovery from root would consider path (used to prune stale catalog rows)"""
+        relative_path = os.path.relpath(path, root)
+        parts = relative_path.split(os.sep)
+        if parts[0] == os.pardir or not self._is_image(parts[-1]):
+            return False
+        if self.max_depth is not None and len(parts) - 1 > self.max_depth:
+            return False
+        return not any(
+            self._skipped(part, os.path.join(*parts[:index + 1])) for index, part in enumerate(parts)
+        )
+
+
+def iter_image_entries(directory, extensions=IMAGE_EXTENSIONS, recursive=False):
+    """Yield the os.DirEntry of each image file in a directory (and its subdirectories when recursive)"""
+    return Discovery(extensions, max_depth=None if recursive else 0).iter_entries(directory)
+
+
+def iter_image_paths(directory, extensions=IMAGE_EXTENSIONS, recursive=False):
+    """Yield the image files of a directory (and its subdirectories when recursive)"""
+    return Discovery(extensions, max_depth=None if recursive else 0).iter_paths(directory)
@@ -1,27 +1,34 @@
 import os
 import sys
-import base64
-import subprocess
-import json
+import time
 import logging
+import threading
 from pathlib import Path
-from openai import OpenAI
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# Set up logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+if not __package__:
+    # Running as a plain script (the Electron app does this); make the package
+    # importable so the sibling modules below resolve.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from imgtagman.catalog import hash_file
+from imgtagman.config import DEFAULT_CONCURRENCY, DEFAULT_PACK_SIZE, setup_logging  # noqa: F401
+from imgtagman.dedupe import DEFAULT_THRESHOLD, open_clusters
+from imgtagman.discovery import Discovery
+from imgtagman.pipeline import iter_batches, iter_bounded
+from imgtagman.preprocess import data_url_size, open_preprocessor, streamed_data_url
+from imgtagman.tag_cache import open_cache
+from imgtagman.tag_schema import PARSE_STATS, packed_response_format, parse_packed_tags, parse_tags, tag_response_format
+from imgtagman.tag_writer import WriteBehindWriter
+from imgtagman.tagstore import XattrTagStore
+from imgtagman.transport import get_transport
+# Tag I/O lives in xattr_tags; these two are still importable from here
+from imgtagman.xattr_tags import get_file_tags, set_file_tags
+from imgtagman.rate_limit import RateLimiter
+from imgtagman.retry import THROTTLED, RetryPolicy, classify
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
-# Log environment for debugging
-logger.debug("Environment variables:")
-logger.debug("PYTHONPATH: %s", os.environ.get('PYTHONPATH'))
-logger.debug("Python path: %s", sys.path)
-logger.debug("Current directory: %s", os.getcwd())
-
 def get_resource_path():
     """Get the correct resource path whether running in development or production"""
     if getattr(sys, 'frozen', False):
@@ -79,159 +86,406 @@ def get_api_key():
     # If still not found, raise error
     if not api_key:
         logger.error("No API key found in environment variables or .env files")
-        logger.error("Environment variables: %s", dict(os.environ))
         raise ValueError("No OpenAI API key found. Please set OPENAI_API_KEY environment variable or add it to .env file.")
     
     return api_key
 
-# Set up resource path
+MODEL = "gpt-4o-mini"
+
+# Part of the response cache key; bump whenever build_tag_request's prompt changes
+PROMPT_VERSION = 2
+
+# Image formats accepted by the OpenAI Vision API
+SUPPORTED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
+
+# Files handed to the worker pool ahead of the results being consumed
+SUBMIT_WINDOW = 64
+
+# The most image data a packed request (tag --pack) may carry
+PACK_MAX_BYTES = 4 * 1024 * 1024
+
+# Same as ThreadPoolExecutor's default, spelled out so the rate limiter knows the ceiling
+THREAD_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+# Rate-limit budget per image part, from OpenAI's vision pricing: a flat 85
+# tokens at low detail, and up to six 512px tiles at 170 tokens plus the base at high
+LOW_DETAIL_IMAGE_TOKENS = 85
+HIGH_DETAIL_IMAGE_TOKENS = 85 + 6 * 170
+
+# Set up resource path (and, frozen, the bundled python_modules) before the SDK is first imported
 resource_path = get_resource_path()
-logging.debug(f"Resource path: {resource_path}")
-logging.debug(f"Python path: {sys.path}")
 
-# Get API key
-api_key = get_api_key()
+_clients = None
+_clients_lock = threading.Lock()
 
-# Now import OpenAI after setting up the path
-client = OpenAI(api_key=api_key)
 
-def get_file_tags(file_path):
-    """Get existing tags from a file using mdls"""
-    try:
-        logging.info(f"Getting existing tags for: {file_path}")
-        # Run mdls command to get tags
-        result = subprocess.run(
-            ["mdls", "-name", "kMDItemUserTags", str(file_path)],
-            capture_output=True,
-            text=True,
-        )
+def get_client(retries=True):
+    """The process's OpenAI client, created on first use over get_transport()'s connection pool.
 
-        # Parse the output
-        output = result.stdout.strip()
-        if "null" in output or "(" not in output:
-            logging.info(f"No existing tags found for: {file_path}")
-            return []
-
-        # Extract tags from the output
-        tags = output.split("kMDItemUserTags = (")[-1].strip(")\n").strip()
-        tags_list = [tag.strip(' "') for tag in tags.split(",") if tag.strip()]
-        logging.info(f"Found existing tags for {file_path}: {tags_list}")
-        return tags_list
-    except Exception as e:
-        logging.error(f"Error getting tags for {file_path}: {e}")
+    With retries=False the SDK does not retry on its own: calls made with a
+    RetryPolicy retry themselves, so the limiter sees every 429.
+    """
+    global _clients
+    with _clients_lock:
+        if _clients is None:
+            from openai import OpenAI
+
+            client = OpenAI(api_key=get_api_key(), **get_transport().client_options())
+            _clients = (client, client.with_options(max_retries=0))
+    return _clients[0] if retries else _clients[1]
+
+
+def upload_extensions(preprocessor=None):
+    """Extensions we can send: anything Pillow converts when preprocessing, else what the API accepts"""
+    return preprocessor.extensions if preprocessor is not None else SUPPORTED_EXTENSIONS
+
+
+def image_data_url(image_path, preprocessor=None):
+    """The image as a data URL, downscaled and re-encoded by the Preprocessor when there is one.
+
+    Without one the file goes as it is, streamed into the request body as
+    it is sent (see streamed_data_url).
+    """
+    if preprocessor is not None:
+        return preprocessor.data_url(image_path)
+    return streamed_data_url(image_path)
+
+
+TAG_INSTRUCTIONS = (
+    "Forneça no máximo dez tags em português para esta imagem, preferindo tags de uma única palavra quando possível. "
+    "Se a imagem for complexa, você pode fornecer tags mais detalhadas. "
+    "Se a imagem contiver texto, você pode incluir o conteúdo do texto simplificado (máximo três palavras) como tags. "
+    "Ao simplificar texto nas imagens, prefira o conteúdo principal e ignore qualquer texto decorativo. "
+)
+
+# Completion budget per image
+MAX_TAG_TOKENS = 300
+
+
+def image_part(image_url, detail_level="low"):
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": image_url,
+            "detail": "low" if detail_level == "low" else "high"
+        },
+    }
+
+
+def build_tag_request(image_url, detail_level="low"):
+    """Keyword arguments for chat.completions.create asking for an image's tags"""
+    # Prepare the prompt based on detail level
+    prompt = (
+        TAG_INSTRUCTIONS
+        + f"Use nível de detalhe {detail_level}. "
+        "Responda com um objeto JSON com as tags no campo \"tags\"."
+    )
+    return {
+        "model": MODEL,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    image_part(image_url, detail_level),
+                ],
+            }
+        ],
+        "max_tokens": MAX_TAG_TOKENS,
+        "response_format": tag_response_format(),
+    }
+
+
+def build_packed_request(image_urls, detail_level="low"):
+    """Like build_tag_request for several images at once, answered as a JSON object keyed by image index"""
+    prompt = (
+        f"A seguir há {len(image_urls)} imagens, numeradas de 0 a {len(image_urls) - 1}. "
+        "Para cada imagem: " + TAG_INSTRUCTIONS
+        + f"Use nível de detalhe {detail_level}. "
+        "Responda apenas com um objeto JSON cujas chaves são os números das imagens (\"0\", \"1\", ...) "
+        "e cujos valores são arrays JSON de strings com as tags de cada imagem."
+    )
+    content = [{"type": "text", "text": prompt}]
+    for index, image_url in enumerate(image_urls):
+        content.append({"type": "text", "text": f"Imagem {index}:"})
+        content.append(image_part(image_url, detail_level))
+    return {
+        "model": MODEL,
+        "messages": [{"role": "user", "content": content}],
+        "max_tokens": MAX_TAG_TOKENS * len(image_urls),
+        "response_format": packed_response_format(len(image_urls)),
+    }
+
+
+def build_sheet_request(sheet_url, count, columns, detail_level="low"):
+    """Ask for the tags of each numbered cell of a contact sheet, as a JSON object keyed by cell number"""
+    rows = -(-count // columns)
+    prompt = (
+        f"Esta imagem é uma folha de contato com {count} fotos em uma grade de {rows} linhas e {columns} colunas, "
+        f"cada uma com seu número (0 a {count - 1}) no canto superior esquerdo. "
+        "Para cada foto: " + TAG_INSTRUCTIONS
+        + "Responda apenas com um objeto JSON cujas chaves são os números das fotos (\"0\", \"1\", ...) "
+        "e cujos valores são arrays JSON de strings com as tags de cada foto. "
+        "Se não conseguir distinguir bem uma foto, use um array vazio para ela."
+    )
+    return {
+        "model": MODEL,
+        "messages": [
+            {
+                "role": "user",
+                "content": [{"type": "text", "text": prompt}, image_part(sheet_url, detail_level)],
+            }
+        ],
+        "max_tokens": MAX_TAG_TOKENS * count,
+        "response_format": packed_response_format(count),
+    }
+
+
+def estimate_request_tokens(request):
+    """Upper estimate of what a chat request counts against the tokens-per-minute limit"""
+    tokens = request.get("max_tokens") or 0
+    for message in request["messages"]:
+        content = message["content"]
+        for part in content if isinstance(content, list) else [{"type": "text", "text": content}]:
+            if part["type"] == "text":
+                # Roughly four characters per token
+                tokens += len(part["text"]) // 4 + 1
+            elif part["image_url"].get("detail") == "low":
+                tokens += LOW_DETAIL_IMAGE_TOKENS
+            else:
+                tokens += HIGH_DETAIL_IMAGE_TOKENS
+    return tokens
+
+
+def release_failed_call(limiter, error):
+    """Return a failed call's slot to the RateLimiter, reporting 429s as throttles"""
+    if limiter is None:
+        return
+    if isinstance(error, Exception) and classify(error) == THROTTLED:
+        limiter.release(error.response.headers, throttled=True)
+    else:
+        limiter.cancel()
+
+
+def finish_call(raw, limiter, retry, estimated_tokens):
+    """Parse a raw completion, settling its limiter slot and the circuit breaker whether or not that works"""
+    response = None
+    try:
+        response = raw.parse()
+    except BaseException:
+        # An answer we cannot read says nothing about the API's health, but it must still end a half-open probe
+        retry.on_neutral()
+        raise
+    finally:
+        if limiter is not None:
+            usage = getattr(response, "usage", None)
+            limiter.release(raw.headers, False, estimated_tokens, usage.total_tokens if usage else None)
+    retry.on_success()
+    return response
+
+
+def create_completion(request, limiter=None, retry=None):
+    """Send a chat request, paced by a RateLimiter and retried by a RetryPolicy when given.
+
+    Each attempt first waits for the circuit breaker and reserves its budget
+    with the limiter; response headers feed back into the limiter. Failures
+    are retried or re-raised as the policy decides. Without either, the
+    SDK's own retries apply.
+    """
+    if limiter is None and retry is None:
+        return get_client().chat.completions.create(**request)
+
+    retry = retry or RetryPolicy()
+    estimated_tokens = estimate_request_tokens(request)
+    attempt = 0
+    while True:
+        wait = retry.wait_time()
+        if wait:
+            time.sleep(wait)
+            continue
+        if limiter is not None:
+            limiter.acquire(estimated_tokens)
+        attempt += 1
+        try:
+            raw = get_client(retries=False).chat.completions.with_raw_response.create(**request)
+        except BaseException as e:
+            release_failed_call(limiter, e)
+            if not isinstance(e, Exception):
+                raise
+            time.sleep(retry.on_failure(e, attempt, paced=limiter is not None))
+            continue
+        return finish_call(raw, limiter, retry, estimated_tokens)
+
+
+def parse_tags_content(content):
+    """Parse the model's answer ({"tags": [...]}), returning [] when it cannot be parsed"""
+    tags = parse_tags(content)
+    if tags is None:
         return []
+    logging.info(f"Parsed tags: {tags}")
+    return tags
 
 
-def set_file_tags(file_path, tags):
-    """Set tags for a file using xattr"""
+def parse_tags_response(response):
+    """Extract the tag list from a chat completion, returning [] when it cannot be parsed"""
     try:
-        logging.info(f"Setting tags for {file_path}: {tags}")
-        
-        # Convert tags list to XML plist string
-        tags_xml = "\n".join([f"\t\t<string>{tag}</string>" for tag in tags])
-        tags_str = f"""<?xml version="1.0" encoding="UTF-8"?>
-<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
-<plist version="1.0">
-<array>
-{tags_xml}
-</array>
-</plist>"""
-        
-        # Use xattr to set tags
-        subprocess.run(
-            [
-                "xattr",
-                "-w",
-                "com.apple.metadata:_kMDItemUserTags",
-                tags_str,
-                str(file_path),
-            ],
-            check=True,
-        )
-        logging.info(f"Successfully set tags for: {file_path}")
+        content = response.choices[0].message.content
     except Exception as e:
-        logging.error(f"Error setting tags for {file_path}: {e}")
-        raise
+        logging.error(f"Error processing OpenAI response: {e}")
+        return []
+    logging.info(f"OpenAI response: {content}")
+    return parse_tags_content(content)
+
 
+def get_tags_from_openai(image_path, detail_level="low", limiter=None, retry=None, preprocessor=None):
+    """Get tags from OpenAI Vision API.
 
-def get_tags_from_openai(image_path, detail_level="low"):
-    """Get tags from OpenAI Vision API"""
+    Returns [] when the answer cannot be parsed; API errors that survive the
+    retries are raised so the image is counted as failed, not as untaggable.
+    """
     try:
         logging.info(f"Getting tags from OpenAI for: {image_path}")
         # Read and encode image
-        with open(image_path, "rb") as image_file:
-            base64_image = base64.b64encode(image_file.read()).decode("utf-8")
-
-        # Prepare the prompt based on detail level
-        prompt = (
-            "Forneça no máximo dez tags em português para esta imagem, preferindo tags de uma única palavra quando possível. "
-            "Se a imagem for complexa, você pode fornecer tags mais detalhadas. "
-            "Se a imagem contiver texto, você pode incluir o conteúdo do texto simplificado (máximo três palavras) como tags. "
-            "Ao simplificar texto nas imagens, prefira o conteúdo principal e ignore qualquer texto decorativo. "
-            f"Use nível de detalhe {detail_level}. "
-            "Responda apenas com as tags como um array JSON de strings."
-        )
+        image_url = image_data_url(image_path, preprocessor)
 
         logging.info("Making API request to OpenAI...")
-        # Make API request
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}",
-                                "detail": "low" if detail_level == "low" else "high"
-                            },
-                        },
-                    ],
-                }
-            ],
-            max_tokens=300,
-        )
+        response = create_completion(build_tag_request(image_url, detail_level), limiter, retry)
+        return parse_tags_response(response)
+
+    except Exception as e:
+        logging.error(f"Error getting tags from OpenAI for {image_path}: {e}")
+        raise
+
 
-        # Parse response
+def parse_packed_response(response, count):
+    """{image index: tags} from a packed completion, leaving out indices that are missing or malformed"""
+    try:
+        content = response.choices[0].message.content
+    except Exception as e:
+        logging.error(f"Error processing OpenAI response: {e}")
+        return {}
+    logging.info(f"OpenAI response: {content}")
+    return parse_packed_tags(content, count)
+
+
+def iter_packed_requests(image_paths, image_urls, detail_level="low", max_bytes=PACK_MAX_BYTES):
+    """Yield (paths, request) packing the encoded images into requests of at most max_bytes of image data.
+
+    Images whose encoding failed (an exception in image_urls) are left out;
+    an image larger than max_bytes still gets a request of its own.
+    """
+    pack = []
+    size = 0
+    for image_path, image_url in zip(image_paths, image_urls):
+        if isinstance(image_url, Exception):
+            logging.error(f"Cannot encode {image_path}: {image_url}")
+            continue
+        if pack and size + data_url_size(image_url) > max_bytes:
+            yield [path for path, _ in pack], build_packed_request([url for _, url in pack], detail_level)
+            pack, size = [], 0
+        pack.append((image_path, image_url))
+        size += data_url_size(image_url)
+    if pack:
+        yield [path for path, _ in pack], build_packed_request([url for _, url in pack], detail_level)
+
+
+def get_packed_tags(image_paths, detail_level="low", limiter=None, retry=None, preprocessor=None,
+                    max_bytes=PACK_MAX_BYTES):
+    """{path: tags} for the images a packed request answered properly; the caller retries the rest alone"""
+    image_urls = []
+    for image_path in image_paths:
         try:
-            content = response.choices[0].message.content
-            logging.info(f"OpenAI response: {content}")
-            
-            # Remove markdown code block if present
-            if content.startswith("```"):
-                content = content.split("\n", 1)[1]  # Remove first line with ```json
-                content = content.rsplit("\n", 1)[0]  # Remove last line with ```
-            
-            tags = json.loads(content)
-            logging.info(f"Parsed tags: {tags}")
-            return tags
-        except json.JSONDecodeError as e:
-            logging.error(f"Failed to parse OpenAI response as JSON: {content}")
-            logging.error(f"JSON parse error: {e}")
-            return []
+            image_urls.append(image_data_url(image_path, preprocessor))
         except Exception as e:
-            logging.error(f"Error processing OpenAI response: {e}")
-            return []
+            image_urls.append(e)
+    tags = {}
+    for paths, request in iter_packed_requests(image_paths, image_urls, detail_level, max_bytes):
+        logging.info(f"Getting tags from OpenAI for {len(paths)} images in one request")
+        try:
+            response = create_completion(request, limiter, retry)
+        except Exception as e:
+            logging.error(f"Packed request for {len(paths)} images failed, tagging them one by one: {e}")
+            continue
+        for index, image_tags in parse_packed_response(response, len(paths)).items():
+            tags[paths[index]] = image_tags
+    return tags
+
+
+def get_sheet_tags(image_paths, columns, detail_level="low", limiter=None, retry=None, preprocessor=None):
+    """{path: tags} for the cells of a contact sheet the answer tagged; the caller retries the rest alone.
 
+    Cells the model left empty (it could not make them out) count as
+    unanswered, as do images that could not be drawn on the sheet.
+    """
+    sheet_url, failed = preprocessor.contact_sheet(image_paths, columns)
+    logging.info(f"Getting tags from OpenAI for a contact sheet of {len(image_paths)} images")
+    try:
+        response = create_completion(
+            build_sheet_request(sheet_url, len(image_paths), columns, detail_level), limiter, retry
+        )
     except Exception as e:
-        logging.error(f"Error getting tags from OpenAI for {image_path}: {e}")
-        return []
+        logging.error(f"Contact sheet request failed, tagging its images one by one: {e}")
+        return {}
+    answered = parse_packed_response(response, len(image_paths))
+    return {image_paths[index]: tags for index, tags in answered.items() if index not in failed}
+
+
+def make_provenance(detail_level, cached=False, duplicate_of=None):
+    """How a set of generated tags was produced, as stored in the catalog"""
+    provenance = {
+        "source": "openai",
+        "model": MODEL,
+        "detail_level": detail_level,
+        "tagged_at": time.time(),
+    }
+    if cached:
+        provenance["cached"] = True
+    if duplicate_of is not None:
+        provenance["duplicate_of"] = str(duplicate_of)
+    return provenance
+
+
+def save_tags(file_path, tags, provenance, content_hash, store, catalog=None, writer=None):
+    """Queue new tags on the WriteBehindWriter, or write them to the store and catalog right away"""
+    if writer is not None:
+        writer.submit(file_path, tags, provenance, content_hash)
+    else:
+        store.set(file_path, tags)
+        if catalog is not None:
+            catalog.record_tags(file_path, tags, provenance, content_hash)
+
 
+def process_file(file_path, detail_level="low", existing_tags=None, store=None, catalog=None, writer=None,
+                 limiter=None, retry=None, preprocessor=None, cache=None):
+    """Process a single file: get tags and set new tags if none exist.
 
-def process_file(file_path, detail_level="low"):
-    """Process a single file: get tags and set new tags if none exist."""
+    With a TagCache, an image whose content was tagged before (under the
+    same model, prompt and detail level) reuses those tags instead of
+    calling the API. With a WriteBehindWriter the new tags are queued
+    instead of written here. Returns the new tags, if any.
+    """
     try:
         logging.info(f"Processing file: {file_path}")
-        existing_tags = get_file_tags(file_path)
+        store = store or XattrTagStore()
+        if existing_tags is None:
+            existing_tags = store.get(file_path)
         
         if not existing_tags:
-            logging.info(f"No existing tags found for {file_path}, getting new tags from OpenAI")
-            new_tags = get_tags_from_openai(file_path, detail_level)
+            content_hash = hash_file(file_path) if catalog is not None or cache is not None else None
+            new_tags = cache.get(content_hash, MODEL, PROMPT_VERSION, detail_level) if cache is not None else None
+            cached = new_tags is not None
+            if cached:
+                logging.info(f"Using cached tags for {file_path}")
+            else:
+                logging.info(f"No existing tags found for {file_path}, getting new tags from OpenAI")
+                new_tags = get_tags_from_openai(file_path, detail_level, limiter, retry, preprocessor)
+                if new_tags and cache is not None:
+                    cache.put(content_hash, MODEL, PROMPT_VERSION, detail_level, new_tags)
             if new_tags:
                 logging.info(f"Setting new tags for {file_path}: {new_tags}")
-                set_file_tags(file_path, new_tags)
+                save_tags(file_path, new_tags, make_provenance(detail_level, cached), content_hash, store, catalog,
+                          writer)
+                return new_tags
             else:
                 logging.warning(f"No tags were generated for {file_path}")
         else:
@@ -241,39 +495,245 @@ def process_file(file_path, detail_level="low"):
         raise
 
 
-def process_images(directory_path, detail_level="low"):
-    """Process all images in a directory."""
+def propagate_tags(representative, duplicates, tags, detail_level, store, catalog=None, writer=None):
+    """Give a cluster representative's new tags to its near-duplicates; returns how many were tagged"""
+    for file_path in duplicates:
+        logging.info(f"Copying tags of {representative} to near-duplicate {file_path}")
+        provenance = make_provenance(detail_level, duplicate_of=representative)
+        content_hash = hash_file(file_path) if catalog is not None else None
+        save_tags(file_path, tags, provenance, content_hash, store, catalog, writer)
+    return len(duplicates)
+
+
+def lookup_cached_tags(file_paths, detail_level="low", catalog=None, cache=None):
+    """Hash files as the catalog and TagCache need them and look them up in the cache.
+
+    Returns ({path: content hash}, {path: cached tags}, {path: exception}).
+    """
+    hashes, cached, failed = {}, {}, {}
+    for file_path in file_paths:
+        try:
+            content_hash = hash_file(file_path) if catalog is not None or cache is not None else None
+            tags = cache.get(content_hash, MODEL, PROMPT_VERSION, detail_level) if cache is not None else None
+        except Exception as e:
+            failed[file_path] = e
+            continue
+        hashes[file_path] = content_hash
+        if tags is not None:
+            cached[file_path] = tags
+    return hashes, cached, failed
+
+
+def save_pack_tags(results, hashes, cached, detail_level, store, catalog=None, writer=None, cache=None):
+    """Cache and save the tags a pack produced ({path: tags or exception}); cached ones are only saved"""
+    for file_path, tags in results.items():
+        if isinstance(tags, Exception):
+            continue
+        if not tags:
+            logging.warning(f"No tags were generated for {file_path}")
+            continue
+        if file_path in cached:
+            logging.info(f"Using cached tags for {file_path}")
+        elif cache is not None:
+            cache.put(hashes[file_path], MODEL, PROMPT_VERSION, detail_level, tags)
+        logging.info(f"Setting new tags for {file_path}: {tags}")
+        provenance = make_provenance(detail_level, file_path in cached)
+        save_tags(file_path, tags, provenance, hashes[file_path], store, catalog, writer)
+
+
+def process_pack(file_paths, detail_level="low", store=None, catalog=None, writer=None, limiter=None, retry=None,
+                 preprocessor=None, cache=None, columns=None):
+    """Tag several untagged files with as few API calls as possible.
+
+    Files the TagCache knows are served from it; the rest are sent together
+    in packed requests (see build_packed_request), or drawn on one contact
+    sheet of the given columns when there are columns. Any image the answer
+    left out or got wrong is then tagged on its own. Returns {path: tags, or
+    the exception that failed it}.
+    """
+    store = store or XattrTagStore()
+    hashes, cached, results = lookup_cached_tags(file_paths, detail_level, catalog, cache)
+    results.update(cached)
+    pending = [file_path for file_path in hashes if file_path not in cached]
+    packed = {}
+    if len(pending) > 1 and columns:
+        packed = get_sheet_tags(pending, columns, detail_level, limiter, retry, preprocessor)
+    elif len(pending) > 1:
+        packed = get_packed_tags(pending, detail_level, limiter, retry, preprocessor)
+    if len(pending) > 1 and len(packed) < len(pending):
+        logging.warning(f"{len(pending) - len(packed)} of {len(pending)} packed images need a request of their own")
+    for file_path in pending:
+        try:
+            results[file_path] = packed.get(file_path) or get_tags_from_openai(
+                file_path, detail_level, limiter, retry, preprocessor
+            )
+        except Exception as e:
+            results[file_path] = e
+    save_pack_tags(results, hashes, cached, detail_level, store, catalog, writer, cache)
+    return results
+
+
+def record_results(results, duplicates, counts):
+    """Log and count the outcome of a tagged file or pack ({path: tags, or the exception that failed it})"""
+    for image_path, result in results.items():
+        if isinstance(result, Exception):
+            counts["failed"] += 1 + len(duplicates.get(image_path, ()))
+            logging.error(f"Failed to process {image_path}: {result}")
+        else:
+            logging.info(f"Successfully processed {image_path}")
+
+
+def iter_untagged_files(directory, store, catalog=None, discovery=None, counts=None,
+                        extensions=SUPPORTED_EXTENSIONS):
+    """Yield the images under directory that have no tags yet, as discovery finds them.
+
+    Only files with one of the given extensions (those we can upload) are
+    considered. Uses the catalog when there is one, so unchanged files are
+    not re-read. counts, if given, is a dict whose "found" and "tagged"
+    entries are kept up to date.
+    """
+    discovery = discovery or Discovery()
+    discovery = discovery.replace(extensions=discovery.extensions & extensions)
+    counts = {} if counts is None else counts
+    counts.update(found=0, tagged=0)
+    if catalog is not None:
+        existing_tags = catalog.iter_refresh(directory, store, discovery)
+    else:
+        existing_tags = store.iter_many(discovery.iter_paths(directory))
+
+    started = time.monotonic()
+    for path, tags in existing_tags:
+        counts["found"] += 1
+        if tags:
+            counts["tagged"] += 1
+            continue
+        if counts["found"] == counts["tagged"] + 1:
+            logging.debug(f"First untagged image found after {time.monotonic() - started:.3f}s")
+        yield path
+
+
+def pack_layout(pack_size=1, sheet_columns=None, preprocessor=None):
+    """(images per request, contact sheet columns or None) for the requested packing"""
+    if not sheet_columns:
+        return pack_size, None
+    if preprocessor is None:
+        logging.warning("Contact sheets need preprocessing with Pillow; sending images one per request")
+        return 1, None
+    return sheet_columns * sheet_columns, sheet_columns
+
+
+def log_run_summary(directory_path, counts, writer, store, limiter=None, retry=None, preprocessor=None,
+                    cache=None):
+    """Log what a tagging run found and wrote"""
+    if not counts["found"]:
+        logging.warning(f"No image files found in directory: {directory_path}")
+        return
+    logging.info(f"Found {counts['found']} image files, {counts['tagged']} already tagged")
+    logging.info(f"Tag writes: {writer.summary()}; store: {store.summary()}")
+    if limiter is not None:
+        logging.info(f"Rate limiter: {limiter.summary()}")
+    if retry is not None:
+        logging.info(f"Retries: {retry.summary()}")
+    if preprocessor is not None:
+        logging.info(f"Preprocessing: {preprocessor.summary()}")
+    if cache is not None:
+        logging.info(f"Response cache: {cache.summary()}")
+    if PARSE_STATS.total:
+        logging.info(f"Responses: {PARSE_STATS.summary()}")
+    logging.info(f"Connections: {get_transport().summary()}")
+    if counts.get("propagated"):
+        logging.info(f"Copied tags to {counts['propagated']} near-duplicates instead of calling the API for them")
+    if counts.get("failed"):
+        logging.warning(f"{counts['failed']} images failed and are still untagged; run tag again to retry them")
+
+
+def process_images(directory_path, detail_level="low", store=None, catalog=None, discovery=None,
+                   window=SUBMIT_WINDOW, rpm=None, tpm=None, preprocess=True, upload_format="jpeg",
+                   cache=None, dedupe=False, dedupe_method="dhash", dedupe_threshold=DEFAULT_THRESHOLD,
+                   pack_size=1, sheet_columns=None):
+    """Process all images under a directory, keeping tags in the given TagStore (xattr by default).
+
+    The Discovery decides which files are considered (recursive by default).
+    Files stream from discovery straight into the worker pool with at most
+    window of them in flight, so tagging starts as soon as the first untagged
+    image is found and memory does not grow with the size of the tree. With a
+    Catalog, files whose stat is unchanged since the last run are skipped
+    without reading their tags again. API calls are paced by a RateLimiter
+    (rpm/tpm seed it; otherwise it learns the limits from response headers).
+    With preprocess (and Pillow installed) images are downscaled to what the
+    detail level can use and re-encoded as upload_format in a process pool.
+    cache is a TagCache consulted before every API call (see open_cache).
+    With dedupe, the untagged images are first grouped into near-duplicate
+    clusters by perceptual hash (see dedupe.cluster_images); only one image
+    per cluster is sent to the API and its tags are copied to the rest. This
+    lists every untagged image before tagging starts. With pack_size above 1,
+    that many images share each request (see process_pack) and window counts
+    packs instead of images. With sheet_columns (2 to 4, Pillow needed) each
+    request instead carries one contact sheet of up to sheet_columns squared
+    thumbnails.
+    """
     try:
+        store = store or XattrTagStore()
         directory = Path(directory_path)
         if not directory.exists():
             logging.error(f"Directory does not exist: {directory_path}")
             raise FileNotFoundError(f"Directory does not exist: {directory_path}")
 
         logging.info(f"Processing directory: {directory_path}")
-        image_files = []
-        for ext in [".jpg", ".jpeg", ".png", ".gif", ".webp"]:
-            image_files.extend(directory.glob(f"*{ext}"))
-            image_files.extend(directory.glob(f"*{ext.upper()}"))
-
-        if not image_files:
-            logging.warning(f"No image files found in directory: {directory_path}")
-            return
+        preprocessor = open_preprocessor(detail_level, upload_format, preprocess)
+        counts = {}
+        untagged = iter_untagged_files(
+            directory, store, catalog, discovery, counts, upload_extensions(preprocessor)
+        )
 
-        logging.info(f"Found {len(image_files)} image files")
-        
-        with ThreadPoolExecutor() as executor:
-            futures = {
-                executor.submit(process_file, str(image_path), detail_level): image_path
-                for image_path in image_files
-            }
-            
-            for future in as_completed(futures):
-                image_path = futures[future]
-                try:
-                    future.result()
-                    logging.info(f"Successfully processed {image_path}")
-                except Exception as e:
-                    logging.error(f"Failed to process {image_path}: {e}")
+        clusters = open_clusters(untagged, dedupe_method, dedupe_threshold, dedupe)
+        duplicates = {}
+        if clusters is not None:
+            untagged, duplicates = clusters.representatives, clusters.members
+
+        pack_size, sheet_columns = pack_layout(pack_size, sheet_columns, preprocessor)
+        limiter = RateLimiter(rpm, tpm, THREAD_WORKERS, THREAD_WORKERS)
+        retry = RetryPolicy()
+        counts["failed"] = 0
+        counts["propagated"] = 0
+
+        def tag(pack):
+            if pack_size > 1:
+                results = process_pack(
+                    pack, detail_level, store, catalog, writer, limiter, retry, preprocessor, cache, sheet_columns
+                )
+            else:
+                results = {pack[0]: process_file(
+                    pack[0], detail_level, [], store, catalog, writer, limiter, retry, preprocessor, cache
+                )}
+            propagated = 0
+            for image_path, tags in results.items():
+                if tags and not isinstance(tags, Exception) and duplicates.get(image_path):
+                    propagated += propagate_tags(
+                        image_path, duplicates[image_path], tags, detail_level, store, catalog, writer
+                    )
+            return results, propagated
+
+        with WriteBehindWriter(store, catalog) as writer:
+            executor = ThreadPoolExecutor(THREAD_WORKERS)
+            try:
+                for pack, future in iter_bounded(executor, tag, iter_batches(untagged, pack_size), window):
+                    try:
+                        results, propagated = future.result()
+                        counts["propagated"] += propagated
+                    except Exception as e:
+                        results = dict.fromkeys(pack, e)
+                    record_results(results, duplicates, counts)
+            except KeyboardInterrupt:
+                logging.warning("Interrupted, flushing queued tag writes before exiting")
+                raise
+            finally:
+                # On Ctrl-C drop the queued API calls; tags already generated are still flushed
+                executor.shutdown(wait=True, cancel_futures=True)
+                if preprocessor is not None:
+                    preprocessor.close()
+
+        log_run_summary(directory_path, counts, writer, store, limiter, retry, preprocessor, cache)
 
     except Exception as e:
         logging.error(f"Error processing directory {directory_path}: {e}")
@@ -282,8 +742,8 @@ def process_images(directory_path, detail_level="low"):
 
 def main():
     """Main function to process command line arguments and start processing."""
+    setup_logging(logging.DEBUG)
     try:
-        import sys
         if len(sys.argv) < 2:
             logging.error("No directory path provided")
             print("Usage: python imgtag.py <directory_path> [detail_level]")
@@ -293,7 +753,12 @@ def main():
         detail_level = sys.argv[2] if len(sys.argv) > 2 else "low"
         
         logging.info(f"Starting image processing with directory: {directory_path}, detail_level: {detail_level}")
-        process_images(directory_path, detail_level)
+        cache = open_cache()
+        try:
+            process_images(directory_path, detail_level, cache=cache)
+        finally:
+            if cache is not None:
+                cache.close()
         logging.info("Processing completed successfully")
         
     except Exception as e:
@@ -1,7 +1,179 @@
+import os
+import sys
 import argparse
-from imgtagman.imgtag import process_images  # Updated import
+from imgtagman.config import (
+    DEFAULT_CONCURRENCY,
+    DEFAULT_PACK_SIZE,
+    DEFAULT_POLL_INTERVAL,
+    MAX_BATCH_REQUESTS,
+    setup_logging,
+)
 from imgtagman.remove_tags import main as remove_tags_main
-from imgtagman.tag_summary import main as summarize_tags_main
+from imgtagman.search import main as search_main
+from imgtagman.tag_summary import FORMATS, main as summarize_tags_main
+from imgtagman.catalog import open_catalog
+from imgtagman.dedupe import DEFAULT_THRESHOLD, HASH_METHODS
+from imgtagman.discovery import Discovery
+from imgtagman.preprocess import CONTACT_SHEET_GRIDS
+from imgtagman.tag_cache import DEFAULT_MAX_SIZE_MB, DEFAULT_TTL_DAYS, open_cache
+from imgtagman.tagstore import STORE_CHOICES, open_store
+from imgtagman.transport import (
+    DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_KEEPALIVE_EXPIRY,
+    DEFAULT_MAX_CONNECTIONS,
+    DEFAULT_READ_TIMEOUT,
+    ENVIRONMENT,
+    Transport,
+    configure_transport,
+)
+
+
+def add_storage_arguments(subparser):
+    subparser.add_argument(
+        "--store",
+        default="xattr",
+        help=f"Where tags are kept: {STORE_CHOICES} (default: xattr)",
+    )
+    subparser.add_argument(
+        "--catalog",
+        help="Path of the catalog database (default: .imgtagman-catalog.sqlite3 in the directory)",
+    )
+    subparser.add_argument(
+        "--no-catalog",
+        action="store_true",
+        help="Re-read every file's tags instead of using the catalog",
+    )
+
+
+def add_discovery_arguments(subparser):
+    subparser.add_argument(
+        "--max-depth",
+        type=int,
+        metavar="N",
+        help="Descend at most N directory levels (0 = only the directory itself; default: no limit)",
+    )
+    subparser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="Skip files and directories matching this glob, by name or relative path (repeatable)",
+    )
+    subparser.add_argument(
+        "--include-hidden",
+        action="store_true",
+        help="Also look inside hidden files and directories",
+    )
+    subparser.add_argument(
+        "--follow-symlinks",
+        action="store_true",
+        help="Follow symbolic links to files and directories",
+    )
+    subparser.add_argument(
+        "--scan-workers",
+        type=int,
+        default=8,
+        metavar="N",
+        help="Directories scanned in parallel (default: 8)",
+    )
+
+
+def add_upload_arguments(subparser):
+    subparser.add_argument(
+        "--upload-format",
+        choices=["jpeg", "webp"],
+        default="jpeg",
+        help="Format images are re-encoded to before upload (default: jpeg)",
+    )
+    subparser.add_argument(
+        "--no-preprocess",
+        action="store_true",
+        help="Upload the original files instead of downscaled copies without metadata",
+    )
+
+
+def add_cache_arguments(subparser):
+    subparser.add_argument(
+        "--cache",
+        metavar="PATH",
+        help="Path of the response cache shared across directories (default: ~/.cache/imgtagman/tag-cache.sqlite3)",
+    )
+    subparser.add_argument(
+        "--cache-size",
+        type=float,
+        default=DEFAULT_MAX_SIZE_MB,
+        metavar="MB",
+        help=f"Evict least recently used cache entries beyond this size (default: {DEFAULT_MAX_SIZE_MB})",
+    )
+    subparser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=DEFAULT_TTL_DAYS,
+        metavar="DAYS",
+        help=f"Ignore cache entries older than this (default: {DEFAULT_TTL_DAYS})",
+    )
+    subparser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always call the API, even for images tagged before",
+    )
+
+
+def add_transport_arguments(subparser):
+    subparser.add_argument(
+        "--max-connections",
+        type=int,
+        metavar="N",
+        help=f"Most HTTP connections to the API, all kept alive for reuse "
+             f"(default: ${ENVIRONMENT['max_connections']} or {DEFAULT_MAX_CONNECTIONS})",
+    )
+    subparser.add_argument(
+        "--keepalive-expiry",
+        type=float,
+        metavar="SECONDS",
+        help=f"Close connections idle for this long "
+             f"(default: ${ENVIRONMENT['keepalive_expiry']} or {DEFAULT_KEEPALIVE_EXPIRY:g})",
+    )
+    subparser.add_argument(
+        "--http2",
+        action=argparse.BooleanOptionalAction,
+        help=f"Multiplex requests over HTTP/2 connections; needs the h2 package "
+             f"(default: ${ENVIRONMENT['http2']} or off)",
+    )
+    subparser.add_argument(
+        "--connect-timeout",
+        type=float,
+        metavar="SECONDS",
+        help=f"Give up connecting after this long "
+             f"(default: ${ENVIRONMENT['connect_timeout']} or {DEFAULT_CONNECT_TIMEOUT:g})",
+    )
+    subparser.add_argument(
+        "--read-timeout",
+        type=float,
+        metavar="SECONDS",
+        help=f"Give up on a response silent for this long "
+             f"(default: ${ENVIRONMENT['read_timeout']} or {DEFAULT_READ_TIMEOUT:g})",
+    )
+
+
+def transport_from_args(args):
+    return Transport.from_env(
+        max_connections=args.max_connections,
+        keepalive_expiry=args.keepalive_expiry,
+        http2=args.http2,
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+    )
+
+
+def discovery_from_args(args):
+    return Discovery(
+        max_depth=args.max_depth,
+        exclude=args.exclude,
+        include_hidden=args.include_hidden,
+        follow_symlinks=args.follow_symlinks,
+        workers=args.scan_workers,
+    )
 
 
 def main():
@@ -21,33 +193,302 @@ def main():
         default=".",
         help="Directory containing images (default: current directory)",
     )
+    parser_tag.add_argument(
+        "--engine",
+        choices=["threads", "async"],
+        default="threads",
+        help="Run API calls on a thread pool or on an asyncio event loop (default: threads)",
+    )
+    parser_tag.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        metavar="N",
+        help=f"Requests in flight with --engine async (default: {DEFAULT_CONCURRENCY})",
+    )
+    parser_tag.add_argument(
+        "--rpm",
+        type=int,
+        help="Requests per minute allowed on the account (default: learned from API responses)",
+    )
+    parser_tag.add_argument(
+        "--tpm",
+        type=int,
+        help="Tokens per minute allowed on the account (default: learned from API responses)",
+    )
+    parser_tag.add_argument(
+        "--pack",
+        type=int,
+        nargs="?",
+        const=DEFAULT_PACK_SIZE,
+        default=1,
+        metavar="N",
+        help=f"Send N images per request to share the prompt and round trip (N defaults to {DEFAULT_PACK_SIZE})",
+    )
+    parser_tag.add_argument(
+        "--sheet",
+        type=int,
+        choices=CONTACT_SHEET_GRIDS,
+        metavar="N",
+        help="Send images as labelled N x N contact sheets (N from 2 to 4), one sheet per request",
+    )
+    parser_tag.add_argument(
+        "--dedupe",
+        action="store_true",
+        help="Tag one image per group of near-duplicates (bursts, resized copies) and copy its tags to the rest",
+    )
+    parser_tag.add_argument(
+        "--dedupe-hash",
+        choices=HASH_METHODS,
+        default="dhash",
+        help="Perceptual hash used by --dedupe (default: dhash)",
+    )
+    parser_tag.add_argument(
+        "--dedupe-threshold",
+        type=int,
+        default=DEFAULT_THRESHOLD,
+        metavar="BITS",
+        help=f"Most hash bits (of 64) near-duplicates may differ in (default: {DEFAULT_THRESHOLD})",
+    )
+    parser_tag.add_argument(
+        "--batch",
+        action="store_true",
+        help="Submit the images as Batch API jobs (half the cost, results within 24h); run again to resume",
+    )
+    parser_tag.add_argument(
+        "--batch-size",
+        type=int,
+        default=MAX_BATCH_REQUESTS,
+        metavar="N",
+        help=f"Most requests per batch with --batch (default: {MAX_BATCH_REQUESTS})",
+    )
+    parser_tag.add_argument(
+        "--poll-interval",
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+        metavar="SECONDS",
+        help=f"How often --batch checks on submitted batches (default: {DEFAULT_POLL_INTERVAL:.0f})",
+    )
+    parser_tag.add_argument(
+        "--no-wait",
+        action="store_true",
+        help="With --batch, exit once the batches are submitted instead of waiting for the results",
+    )
+    add_upload_arguments(parser_tag)
+    add_cache_arguments(parser_tag)
+    add_transport_arguments(parser_tag)
+    add_discovery_arguments(parser_tag)
+    add_storage_arguments(parser_tag)
 
     # --remove-tags command
     parser_remove = subparsers.add_parser("remove-tags", help="Remove tags from images")
     parser_remove.add_argument(
         "--directory",
-        default=".",
-        help="Directory containing images (default: current directory)",
+        default=os.getenv("IMAGE_DIRECTORY", "."),
+        help="Directory containing images (default: $IMAGE_DIRECTORY or current directory)",
     )
+    parser_remove.add_argument(
+        "--tag",
+        action="append",
+        dest="patterns",
+        metavar="PATTERN",
+        help="Only remove tags matching this wildcard, e.g. 'texto*' (repeatable; default: all tags)",
+    )
+    parser_remove.add_argument(
+        "--query",
+        help='Only touch images matching this tag query, e.g. "praia AND NOT sol"',
+    )
+    parser_remove.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Report what would be removed without changing anything",
+    )
+    add_discovery_arguments(parser_remove)
+    add_storage_arguments(parser_remove)
 
     # --summary command
     parser_summary = subparsers.add_parser("summary", help="Summarize image tags")
     parser_summary.add_argument(
         "--directory",
-        default=".",
-        help="Directory containing images (default: current directory)",
+        default=os.getenv("IMAGE_DIRECTORY", "."),
+        help="Directory containing images (default: $IMAGE_DIRECTORY or current directory)",
+    )
+    parser_summary.add_argument(
+        "--format",
+        choices=FORMATS,
+        default="table",
+        help="Output format (default: table)",
+    )
+    parser_summary.add_argument(
+        "--top",
+        type=int,
+        help="Only show the N most used tags",
     )
+    parser_summary.add_argument(
+        "--no-refresh",
+        action="store_true",
+        help="Report the catalog's statistics as they are, for every image in it, without checking the "
+             "directory for changes",
+    )
+    add_discovery_arguments(parser_summary)
+    add_storage_arguments(parser_summary)
+
+    # --search command
+    parser_search = subparsers.add_parser("search", help="Find images by tag")
+    parser_search.add_argument(
+        "query",
+        help='Boolean tag query, e.g. "praia AND (sol OR mar) AND NOT noite"; * and ? are wildcards',
+    )
+    parser_search.add_argument(
+        "--directory",
+        default=os.getenv("IMAGE_DIRECTORY", "."),
+        help="Directory containing images (default: $IMAGE_DIRECTORY or current directory)",
+    )
+    parser_search.add_argument(
+        "--no-refresh",
+        action="store_true",
+        help="Query the catalog as it is, without checking the directory for changes",
+    )
+    parser_search.add_argument(
+        "--limit",
+        type=int,
+        help="Print at most this many matches",
+    )
+    add_discovery_arguments(parser_search)
+    add_storage_arguments(parser_search)
+
+    # --watch command
+    parser_watch = subparsers.add_parser("watch", help="Tag new images as they are added to a directory")
+    parser_watch.add_argument(
+        "directory",
+        nargs="?",
+        default=os.getenv("IMAGE_DIRECTORY", "."),
+        help="Directory to watch (default: $IMAGE_DIRECTORY or current directory)",
+    )
+    parser_watch.add_argument(
+        "--detail-level",
+        choices=["low", "high"],
+        default="low",
+        help="Detail level for tagging (default: low)",
+    )
+    parser_watch.add_argument(
+        "--settle",
+        type=float,
+        default=2.0,
+        help="Seconds a file must stay unchanged before it is tagged (default: 2)",
+    )
+    parser_watch.add_argument(
+        "--poll",
+        action="store_true",
+        help="Poll the directory instead of using inotify (e.g. on network mounts)",
+    )
+    parser_watch.add_argument(
+        "--poll-interval",
+        type=float,
+        default=5.0,
+        help="Seconds between polls when polling (default: 5)",
+    )
+    parser_watch.add_argument(
+        "--no-recursive",
+        action="store_true",
+        help="Do not watch subdirectories",
+    )
+    add_upload_arguments(parser_watch)
+    add_cache_arguments(parser_watch)
+    add_transport_arguments(parser_watch)
+    add_storage_arguments(parser_watch)
 
     args = parser.parse_args()
 
-    if args.command == "tag":
-        process_images(args.directory, args.detail_level)
-    elif args.command == "remove-tags":
-        remove_tags_main()
-    elif args.command == "summary":
-        summarize_tags_main()
-    else:
+    if args.command is None:
         parser.print_help()
+        return
+
+    setup_logging()
+
+    try:
+        store = open_store(args.store, args.directory)
+    except ValueError as e:
+        parser.error(str(e))
+    catalog = None if args.no_catalog else open_catalog(args.catalog, args.directory, store)
+    cache = None
+    if args.command in ("tag", "watch"):
+        cache = open_cache(args.cache, not args.no_cache, args.cache_size, args.cache_ttl)
+        configure_transport(transport_from_args(args))
+    try:
+        if args.command == "tag":
+            if args.pack < 1:
+                parser.error("--pack needs at least 1 image per request")
+            if args.sheet and args.pack > 1:
+                parser.error("--pack and --sheet are alternatives; pick one")
+            # The tagging modules (and through them the SDK) are only imported by the commands that call the API
+            if args.batch:
+                from imgtagman.batch import process_images_batch
+
+                process_images_batch(
+                    args.directory, args.detail_level, store, catalog, discovery_from_args(args),
+                    not args.no_preprocess, args.upload_format, cache, args.dedupe, args.dedupe_hash,
+                    args.dedupe_threshold, args.poll_interval, not args.no_wait, args.batch_size,
+                )
+            elif args.engine == "async":
+                from imgtagman.async_engine import process_images_async
+
+                process_images_async(
+                    args.directory, args.detail_level, store, catalog, discovery_from_args(args), args.concurrency,
+                    args.rpm, args.tpm, not args.no_preprocess, args.upload_format, cache,
+                    args.dedupe, args.dedupe_hash, args.dedupe_threshold, args.pack, args.sheet,
+                )
+            else:
+                from imgtagman.imgtag import process_images
+
+                process_images(
+                    args.directory, args.detail_level, store, catalog, discovery_from_args(args),
+                    rpm=args.rpm, tpm=args.tpm, preprocess=not args.no_preprocess, upload_format=args.upload_format,
+                    cache=cache, dedupe=args.dedupe, dedupe_method=args.dedupe_hash,
+                    dedupe_threshold=args.dedupe_threshold, pack_size=args.pack, sheet_columns=args.sheet,
+                )
+        elif args.command == "remove-tags":
+            remove_tags_main(
+                store, catalog, args.directory, args.patterns, args.query, discovery_from_args(args), args.dry_run
+            )
+        elif args.command == "summary":
+            if args.no_refresh and (args.max_depth is not None or args.exclude or args.include_hidden):
+                # The catalog's statistics cover every image in it, so they cannot honour a narrower scope
+                parser.error("--no-refresh cannot be combined with --max-depth, --exclude or --include-hidden")
+            summarize_tags_main(
+                store, catalog, args.directory, args.format, args.top, not args.no_refresh, discovery_from_args(args)
+            )
+        elif args.command == "search":
+            if catalog is None:
+                parser.error("search needs the catalog; drop --no-catalog or pass a writable --catalog")
+            sys.exit(
+                search_main(
+                    args.query, catalog, store, not args.no_refresh, args.limit, args.directory,
+                    discovery_from_args(args),
+                )
+            )
+        elif args.command == "watch":
+            from imgtagman.watch import watch_directory
+
+            watch_directory(
+                args.directory,
+                args.detail_level,
+                store,
+                catalog,
+                args.settle,
+                not args.no_recursive,
+                args.poll,
+                args.poll_interval,
+                preprocess=not args.no_preprocess,
+                upload_format=args.upload_format,
+                cache=cache,
+            )
+    finally:
+        if cache is not None:
+            cache.close()
+        if catalog is not None:
+            catalog.close()
+        store.close()
 
 
 if __name__ == "__main__":
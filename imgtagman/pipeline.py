@@ -0,0 +1,33 @@
+from concurrent.futures import FIRST_COMPLETED, wait
+from itertools import islice
+
+
+def iter_batches(items, size):
+    """Yield lists of up to size items from any iterable, without materializing it"""
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def iter_bounded(executor, fn, items, window):
+    """Run fn(item) on an executor for a stream of items, with at most window calls in flight.
+
+    Items are pulled from the iterable only when there is room in the window,
+    so work starts as soon as the first item is produced and neither the
+    items nor their futures pile up in memory. Yields (item, future) pairs in
+    completion order.
+    """
+    pending = {}
+    for item in items:
+        if len(pending) >= window:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future
+        pending[executor.submit(fn, item)] = item
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield pending.pop(future), future
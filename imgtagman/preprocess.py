@@ -0,0 +1,348 @@
+import io
+import os
+import re
+import base64
+import logging
+import threading
+
+# Pillow is optional (pip install imgtagman[preprocess]) and only imported
+# by _load_pillow once an image is actually processed
+Image = None
+ImageDraw = None
+ImageFont = None
+ImageOps = None
+
+# What the model actually looks at: low detail is a single 512px view; high
+# detail fits the image in 2048x2048 and then scales its short side to 768
+LOW_DETAIL_SIZE = 512
+HIGH_DETAIL_LONG_SIDE = 2048
+HIGH_DETAIL_SHORT_SIDE = 768
+
+JPEG_QUALITY = 85
+
+# Side of a contact sheet: the whole of a low-detail view, or a square that
+# high detail covers with four 512px tiles
+CONTACT_SHEET_SIZE = {"low": 512, "high": 768}
+CONTACT_SHEET_GRIDS = (2, 3, 4)
+CELL_GAP = 4
+
+UPLOAD_FORMATS = {"jpeg": ("JPEG", "image/jpeg"), "webp": ("WEBP", "image/webp")}
+
+# Formats the API accepts as they are, for when images are sent unprocessed
+MIME_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+}
+
+# Everything Pillow can turn into an upload, including formats the API rejects
+PREPROCESSED_EXTENSIONS = set(MIME_TYPES) | {".bmp", ".tiff", ".tif"}
+
+# Raw bytes read per chunk when a file is base64-encoded on its way out; a
+# multiple of 3, so that the chunks' encodings join without padding between them
+ENCODE_CHUNK_SIZE = 3 * 256 * 1024
+
+# Stands in for a file's base64 in a data URL until the request body is sent,
+# followed by the path in hex; neither ":" nor "-" occurs in base64
+STREAM_MARKER = "imgtagman-file:"
+STREAM_PATTERN = re.compile(rb"(?<=;base64,)" + STREAM_MARKER.encode("ascii") + rb"([0-9a-f]+)")
+
+
+def _load_pillow():
+    """Import Pillow on first use, returning False if it is missing"""
+    global Image, ImageDraw, ImageFont, ImageOps
+    if Image is None:
+        try:
+            from PIL import Image as PILImage, ImageDraw as PILImageDraw, ImageFont as PILImageFont
+            from PIL import ImageOps as PILImageOps
+        except ImportError:
+            return False
+        Image, ImageDraw, ImageFont, ImageOps = PILImage, PILImageDraw, PILImageFont, PILImageOps
+    return True
+
+
+def target_size(width, height, detail_level="low"):
+    """Largest size worth uploading for an image at the given detail level"""
+    if detail_level == "low":
+        scale = min(1.0, LOW_DETAIL_SIZE / max(width, height))
+    else:
+        scale = min(1.0, HIGH_DETAIL_LONG_SIDE / max(width, height))
+        scale *= min(1.0, HIGH_DETAIL_SHORT_SIDE / (min(width, height) * scale))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def data_url(data, mime):
+    return f"data:{mime};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+def base64_size(size):
+    return (size + 2) // 3 * 4
+
+
+def raw_mime_type(image_path):
+    """The MIME type of an image sent as it is, or ValueError when the API does not accept its format"""
+    extension = os.path.splitext(image_path)[1].lower()
+    mime = MIME_TYPES.get(extension)
+    if mime is None:
+        raise ValueError(
+            f"{extension} images are not accepted by the API; install Pillow "
+            "(pip install imgtagman[preprocess]) to have them converted"
+        )
+    return mime
+
+
+def streamed_data_url(image_path):
+    """A stand-in for raw_data_url(image_path) that only names the file.
+
+    The clients of a Transport replace it with the file's base64 while the
+    request body is sent (see streamed_parts), so the encoded image is
+    never held in memory, however many requests are in flight. Anything
+    else that needs the real body runs it through expand_body.
+    """
+    mime = raw_mime_type(image_path)
+    # A file we cannot read fails here rather than halfway through a request
+    with open(image_path, "rb"):
+        pass
+    return f"data:{mime};base64,{STREAM_MARKER}{os.fsencode(image_path).hex()}"
+
+
+def data_url_size(image_url):
+    """Length of the data URL, or of the one a streamed_data_url stands for"""
+    head, marker, path = image_url.partition(STREAM_MARKER)
+    if not marker:
+        return len(image_url)
+    return len(head) + base64_size(os.path.getsize(os.fsdecode(bytes.fromhex(path))))
+
+
+def streamed_parts(body):
+    """A serialized request body split around its streamed files, or None when it has none.
+
+    Pieces of the body (bytes) alternate with (path, size) pairs; the
+    size is taken now, so the length of the final body is known up front.
+    """
+    parts = STREAM_PATTERN.split(body)
+    if len(parts) == 1:
+        return None
+    for index in range(1, len(parts), 2):
+        path = os.fsdecode(bytes.fromhex(parts[index].decode("ascii")))
+        parts[index] = (path, os.path.getsize(path))
+    return parts
+
+
+def streamed_length(parts):
+    return sum(base64_size(part[1]) if isinstance(part, tuple) else len(part) for part in parts)
+
+
+def iter_base64(image_path, size, chunk_size=ENCODE_CHUNK_SIZE):
+    """The base64 of the first size bytes of the file, read and encoded a chunk at a time"""
+    buffer = memoryview(bytearray(chunk_size))
+    with open(image_path, "rb") as image_file:
+        while size:
+            read = image_file.readinto(buffer[:min(chunk_size, size)])
+            if read < min(chunk_size, size):
+                raise OSError(f"{image_path} shrank while it was being sent")
+            size -= read
+            yield base64.b64encode(buffer[:read])
+
+
+def iter_streamed(parts):
+    """The chunks of the body streamed_parts split"""
+    for part in parts:
+        if isinstance(part, tuple):
+            yield from iter_base64(*part)
+        else:
+            yield part
+
+
+def expand_body(body):
+    """The body with its streamed files' base64 written in, filled into a single buffer of its final size"""
+    parts = streamed_parts(body)
+    if parts is None:
+        return body
+    expanded = bytearray(streamed_length(parts))
+    position = 0
+    for chunk in iter_streamed(parts):
+        expanded[position:position + len(chunk)] = chunk
+        position += len(chunk)
+    return expanded
+
+
+def raw_data_url(image_path):
+    """The file's own bytes as a data URL with the MIME type of its extension"""
+    return expand_body(streamed_data_url(image_path).encode("ascii")).decode("ascii")
+
+
+def _flatten(image, keep_alpha):
+    """Convert to RGB (or RGBA when the target format keeps transparency)"""
+    if image.mode in ("RGB", "L"):
+        return image
+    if "A" in image.getbands() or image.info.get("transparency") is not None:
+        image = image.convert("RGBA")
+        if keep_alpha:
+            return image
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+
+def preprocess_image(image_path, detail_level="low", upload_format="jpeg"):
+    """Decode, orient, downscale and re-encode an image without metadata; returns a data URL.
+
+    Runs in the preprocessing pool. JPEGs are decoded straight at a reduced
+    scale when possible (draft mode), EXIF orientation is applied before
+    the EXIF block is dropped, and neither EXIF nor the ICC profile is
+    written to the output.
+    """
+    _load_pillow()
+    pil_format, mime = UPLOAD_FORMATS[upload_format]
+    with Image.open(image_path) as image:
+        size = target_size(*image.size, detail_level)
+        image.draft("RGB", size)
+        image = ImageOps.exif_transpose(image)
+        image = _flatten(image, keep_alpha=pil_format == "WEBP")
+        image.thumbnail(target_size(*image.size, detail_level), Image.LANCZOS)
+        image.info.clear()
+        output = io.BytesIO()
+        image.save(output, pil_format, quality=JPEG_QUALITY)
+    return data_url(output.getvalue(), mime)
+
+
+def _cell_label(draw, index, x, y, cell_size):
+    font_size = max(10, cell_size // 8)
+    try:
+        font = ImageFont.load_default(size=font_size)
+    except TypeError:  # Pillow < 10.1 has a single bitmap size
+        font = ImageFont.load_default()
+    text = str(index)
+    left, top, right, bottom = draw.textbbox((x, y), text, font=font)
+    pad = max(2, font_size // 5)
+    draw.rectangle((x, y, right + 2 * pad, bottom + 2 * pad), fill=(0, 0, 0))
+    draw.text((x + pad, y + pad), text, fill=(255, 255, 255), font=font)
+
+
+def render_contact_sheet(image_paths, columns, detail_level="low", upload_format="jpeg"):
+    """Tile up to columns x columns images into one labelled grid; returns (data URL, indices that failed).
+
+    Runs in the preprocessing pool. Cells are numbered from 0, left to right
+    and top to bottom, with the number drawn in each cell's top-left corner.
+    Images that cannot be decoded leave their cell blank.
+    """
+    _load_pillow()
+    pil_format, mime = UPLOAD_FORMATS[upload_format]
+    sheet_size = CONTACT_SHEET_SIZE["low" if detail_level == "low" else "high"]
+    cell_size = (sheet_size - CELL_GAP * (columns - 1)) // columns
+    rows = -(-len(image_paths) // columns)
+    sheet = Image.new("RGB", (sheet_size, rows * cell_size + CELL_GAP * (rows - 1)), (128, 128, 128))
+    draw = ImageDraw.Draw(sheet)
+    failed = []
+    for index, image_path in enumerate(image_paths):
+        x = (index % columns) * (cell_size + CELL_GAP)
+        y = (index // columns) * (cell_size + CELL_GAP)
+        try:
+            with Image.open(image_path) as image:
+                image.draft("RGB", (cell_size, cell_size))
+                image = _flatten(ImageOps.exif_transpose(image), keep_alpha=False)
+                image.thumbnail((cell_size, cell_size), Image.LANCZOS)
+                sheet.paste(image, (x + (cell_size - image.width) // 2, y + (cell_size - image.height) // 2))
+        except Exception:
+            failed.append(index)
+            continue
+        _cell_label(draw, index, x, y, cell_size)
+    output = io.BytesIO()
+    sheet.save(output, pil_format, quality=JPEG_QUALITY)
+    return data_url(output.getvalue(), mime), failed
+
+
+class Preprocessor:
+    """Prepares uploads in a process pool so image decoding never holds our GIL.
+
+    Workers are started with "spawn" because the parent already runs
+    threads (discovery, the tag writer) that fork would copy mid-flight.
+    """
+
+    extensions = PREPROCESSED_EXTENSIONS
+
+    def __init__(self, detail_level="low", upload_format="jpeg", workers=None):
+        # Imported here, like Pillow, so that importing the module stays cheap
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.detail_level = detail_level
+        self.upload_format = upload_format
+        self.images = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._lock = threading.Lock()
+        self._pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _record(self, image_path, url):
+        with self._lock:
+            self.images += 1
+            # What the original would have cost as base64
+            self.bytes_in += (os.path.getsize(image_path) + 2) // 3 * 4
+            self.bytes_out += len(url)
+
+    def data_url(self, image_path):
+        url = self._pool.submit(preprocess_image, image_path, self.detail_level, self.upload_format).result()
+        self._record(image_path, url)
+        return url
+
+    async def data_url_async(self, image_path):
+        import asyncio
+
+        future = self._pool.submit(preprocess_image, image_path, self.detail_level, self.upload_format)
+        url = await asyncio.wrap_future(future)
+        self._record(image_path, url)
+        return url
+
+    def _record_sheet(self, image_paths, url):
+        with self._lock:
+            self.images += len(image_paths)
+            self.bytes_in += sum((os.path.getsize(path) + 2) // 3 * 4 for path in image_paths)
+            self.bytes_out += len(url)
+
+    def contact_sheet(self, image_paths, columns):
+        url, failed = self._pool.submit(
+            render_contact_sheet, image_paths, columns, self.detail_level, self.upload_format
+        ).result()
+        self._record_sheet(image_paths, url)
+        return url, failed
+
+    async def contact_sheet_async(self, image_paths, columns):
+        import asyncio
+
+        future = self._pool.submit(render_contact_sheet, image_paths, columns, self.detail_level, self.upload_format)
+        url, failed = await asyncio.wrap_future(future)
+        self._record_sheet(image_paths, url)
+        return url, failed
+
+    def summary(self):
+        with self._lock:
+            return (
+                f"{self.images} images uploaded as {self.bytes_out / 1e6:.1f} MB of {self.upload_format} "
+                f"instead of {self.bytes_in / 1e6:.1f} MB unprocessed"
+            )
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_preprocessor(detail_level="low", upload_format="jpeg", enabled=True):
+    """A Preprocessor, or None (images sent as they are) when disabled or Pillow is missing"""
+    if not enabled:
+        return None
+    if not _load_pillow():
+        logging.warning(
+            "Pillow is not installed, uploading images unprocessed (pip install imgtagman[preprocess])"
+        )
+        return None
+    return Preprocessor(detail_level, upload_format)
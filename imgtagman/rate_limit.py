@@ -0,0 +1,229 @@
+import re
+import time
+import logging
+import threading
+
+# Seconds a caller waits before checking again for a free concurrency slot
+SLOT_POLL_INTERVAL = 0.05
+
+# Never halve the concurrency limit more than once per this many seconds;
+# a burst of 429s from one window is one congestion signal, not many
+DECREASE_COOLDOWN = 1.0
+
+RESET_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+RESET_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_reset(value):
+    """Parse an x-ratelimit-reset-* value such as "120ms", "1s" or "6m0.5s" into seconds"""
+    if not value:
+        return None
+    parts = RESET_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * RESET_UNITS[unit] for number, unit in parts)
+
+
+def _header_int(headers, name):
+    try:
+        return int(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Per-minute budget (requests or tokens) refilled continuously.
+
+    An unseeded bucket (limit None) admits everything until the API tells
+    us the account's limit through the rate-limit headers.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.tokens = float(limit) if limit else 0.0
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.limit:
+            self.tokens = min(float(self.limit), self.tokens + (now - self._updated) * self.limit / 60.0)
+        self._updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until amount is available (0 if it is available now)"""
+        if not self.limit:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.limit)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) * 60.0 / self.limit
+
+    def take(self, amount, now):
+        self._refill(now)
+        if self.limit:
+            self.tokens -= amount
+
+    def seed(self, limit, remaining, now):
+        """Adopt the server's view: its limit, and never more headroom than it says remains"""
+        self._refill(now)
+        if limit:
+            if not self.limit:
+                self.tokens = float(limit)
+            self.limit = limit
+        if remaining is not None and self.limit:
+            self.tokens = min(self.tokens, float(remaining))
+
+    def describe(self):
+        if not self.limit:
+            return "unlimited"
+        return f"{max(self.tokens, 0):.0f}/{self.limit}"
+
+
+class AIMDController:
+    """Additive-increase / multiplicative-decrease concurrency limit.
+
+    Like TCP congestion control, the limit doubles every round trip until
+    the first throttle, then grows by one per round trip and halves on each
+    throttle, so it settles just under what the account can sustain.
+    """
+
+    def __init__(self, initial=8, minimum=1, maximum=256):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.peak = self.limit
+        self.decreases = 0
+        self._last_decrease = float("-inf")
+
+    def on_success(self):
+        if self.decreases:
+            self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+        else:
+            # Slow start: double every round trip until the first throttle
+            self.limit = min(float(self.maximum), self.limit + 1.0)
+        self.peak = max(self.peak, self.limit)
+
+    def on_throttle(self, now):
+        if now - self._last_decrease < DECREASE_COOLDOWN:
+            return
+        self._last_decrease = now
+        self.limit = max(float(self.minimum), self.limit / 2)
+        self.decreases += 1
+
+    @property
+    def slots(self):
+        return int(self.limit)
+
+
+class RateLimiter:
+    """Keeps vision calls within the account's requests- and tokens-per-minute limits.
+
+    Callers reserve a slot with try_acquire (or the blocking acquire) and
+    report the outcome with release. Buckets are seeded from the
+    x-ratelimit-* headers of every response, and an AIMD controller adapts
+    how many calls may be in flight. Works for both the thread pool and the
+    asyncio engine: try_acquire never blocks and returns how long to wait.
+    """
+
+    def __init__(self, rpm=None, tpm=None, initial_concurrency=8, max_concurrency=256):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.concurrency = AIMDController(initial_concurrency, 1, max_concurrency)
+        self.in_flight = 0
+        self.throttled = 0
+        self.waited = 0.0
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, estimated_tokens):
+        """Reserve a call if possible; return 0 when reserved, otherwise the seconds to wait"""
+        now = time.monotonic()
+        with self._lock:
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self.in_flight >= self.concurrency.slots:
+                return SLOT_POLL_INTERVAL
+            wait = max(self.requests.wait_time(1, now), self.tokens.wait_time(estimated_tokens, now))
+            if wait > 0:
+                return wait
+            self.requests.take(1, now)
+            self.tokens.take(estimated_tokens, now)
+            self.in_flight += 1
+            return 0.0
+
+    def acquire(self, estimated_tokens):
+        """Block until a call may be made"""
+        while True:
+            wait = self.try_acquire(estimated_tokens)
+            if not wait:
+                return
+            self._add_wait(wait)
+            time.sleep(wait)
+
+    async def acquire_async(self, estimated_tokens):
+        """Wait without blocking the event loop until a call may be made"""
+        # Only the async engine gets here; the threaded paths never pay for importing asyncio
+        import asyncio
+
+        while True:
+            wait = self.try_acquire(estimated_tokens)
+            if not wait:
+                return
+            self._add_wait(wait)
+            await asyncio.sleep(wait)
+
+    def cancel(self):
+        """Give back a slot whose call failed for reasons unrelated to rate limits"""
+        with self._lock:
+            self.in_flight -= 1
+
+    def _add_wait(self, seconds):
+        with self._lock:
+            self.waited += seconds
+
+    def release(self, headers=None, throttled=False, estimated_tokens=0, used_tokens=None):
+        """Report a finished call with its response headers and actual token usage"""
+        now = time.monotonic()
+        with self._lock:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                self.concurrency.on_throttle(now)
+            else:
+                self.concurrency.on_success()
+            if used_tokens is not None and self.tokens.limit:
+                # Settle the estimate against what the call really cost
+                self.tokens.tokens += estimated_tokens - used_tokens
+            if headers is not None:
+                self._observe(headers, now, throttled)
+
+    def _observe(self, headers, now, throttled):
+        self.requests.seed(
+            _header_int(headers, "x-ratelimit-limit-requests"),
+            _header_int(headers, "x-ratelimit-remaining-requests"),
+            now,
+        )
+        self.tokens.seed(
+            _header_int(headers, "x-ratelimit-limit-tokens"),
+            _header_int(headers, "x-ratelimit-remaining-tokens"),
+            now,
+        )
+        if throttled:
+            # Hold every caller back until the exhausted window resets
+            resets = [
+                parse_reset(headers.get("x-ratelimit-reset-requests")) if self.requests.tokens < 1 else None,
+                parse_reset(headers.get("x-ratelimit-reset-tokens")) if self.tokens.tokens < 1 else None,
+            ]
+            pause = max((reset for reset in resets if reset is not None), default=None)
+            if pause:
+                self._paused_until = max(self._paused_until, now + pause)
+                logging.warning(f"Rate limited, pausing new requests for {pause:.1f}s")
+
+    def summary(self):
+        with self._lock:
+            return (
+                f"concurrency limit {self.concurrency.slots} (peak {self.concurrency.peak:.0f}, "
+                f"halved {self.concurrency.decreases} times), requests {self.requests.describe()}/min, "
+                f"tokens {self.tokens.describe()}/min, {self.throttled} throttled, "
+                f"{self.waited:.1f}s spent waiting across all callers"
+            )
@@ -1,57 +1,123 @@
 import os
-import subprocess
-from pathlib import Path
-from imgtagman.imgtag import get_file_tags
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import fnmatch
+from imgtagman.tag_index import matches, normalize_tag, parse_query
+from imgtagman.tagstore import XattrTagStore
+from imgtagman.discovery import Discovery
 
 
-def remove_tags(file_path):
-    """Remove tags from a file using xattr"""
+def remove_tags(file_path, store=None):
+    """Remove tags from a file"""
+    store = store or XattrTagStore()
     try:
-        subprocess.run(
-            ["xattr", "-d", "com.apple.metadata:_kMDItemUserTags", str(file_path)],
-            check=True,
-        )
-        print(f"Removed tags from {file_path}")
-    except subprocess.CalledProcessError:
-        print(f"No tags to remove for {file_path}")
+        if store.delete(file_path):
+            print(f"Removed tags from {file_path}")
+        else:
+            print(f"No tags to remove for {file_path}")
     except Exception as e:
         print(f"Error removing tags for {file_path}: {e}")
 
 
-def process_file(file_path):
-    """Process a single file: remove tags if they exist."""
-    print(f"\nProcessing: {file_path}")
-    tags = get_file_tags(file_path)
-    if tags:
-        remove_tags(file_path)
-    else:
-        print(f"No tags found for {file_path}")
+def plan_removals(tags_by_path, patterns=None, query=None):
+    """Work out which tags to remove from which files.
 
+    patterns are case-insensitive wildcards (e.g. "texto*") selecting the tags
+    to remove; without them every tag goes. query is a boolean tag query (see
+    imgtagman search) selecting the files to touch. Returns
+    {path: (current_tags, remaining_tags)} for files that would change.
+    """
+    tree = parse_query(query) if query else None
+    patterns = [normalize_tag(pattern) for pattern in patterns or []]
+    plan = {}
+    for path, tags in tags_by_path.items():
+        if not tags or (tree is not None and not matches(tree, tags)):
+            continue
+        if patterns:
+            remaining = [
+                tag for tag in tags
+                if not any(fnmatch.fnmatchcase(normalize_tag(tag), pattern) for pattern in patterns)
+            ]
+        else:
+            remaining = []
+        if len(remaining) != len(tags):
+            plan[path] = (tags, remaining)
+    return plan
 
-def remove_tags_from_images(directory_path):
-    """Remove tags from all images in a directory."""
-    # Get directory path from environment variable or use current directory
-    directory = os.getenv("IMAGE_DIRECTORY", directory_path)
-    image_extensions = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff", ".webp"}
-    dir_path = Path(directory)
 
-    with ThreadPoolExecutor(max_workers=50) as executor:
-        futures = [
-            executor.submit(process_file, file_path)
-            for file_path in dir_path.glob("*")
-            if file_path.suffix.lower() in image_extensions
-        ]
+def apply_removals(store, plan):
+    """Write a plan from plan_removals, returning {path: error} for the files that could not be changed.
 
-        for future in as_completed(futures):
+    Files are written in two batches (those left with no tags and the
+    rest); when a batch fails, its files are retried one by one so a single
+    unreadable or read-only file does not sink the others.
+    """
+    cleared = [path for path, (_, remaining) in plan.items() if not remaining]
+    updated = {path: remaining for path, (_, remaining) in plan.items() if remaining}
+    failed = {}
+    try:
+        store.delete_many(cleared)
+    except Exception:
+        for path in cleared:
             try:
-                future.result()
+                store.delete(path)
             except Exception as e:
-                print(f"Error processing file: {e}")
+                failed[path] = e
+    try:
+        store.set_many(updated)
+    except Exception:
+        for path, remaining in updated.items():
+            try:
+                store.set(path, remaining)
+            except Exception as e:
+                failed[path] = e
+    return failed
+
+
+def remove_tags_from_images(directory_path, store=None, catalog=None, patterns=None, query=None,
+                            discovery=None, dry_run=False):
+    """Remove tags from the images in a directory tree in one batched pass.
+
+    Returns (files_changed, tags_removed).
+    """
+    store = store or XattrTagStore()
+    discovery = discovery or Discovery()
+    if catalog is not None:
+        tags_by_path = catalog.refresh(directory_path, store, discovery)
+    else:
+        tags_by_path = store.get_many(discovery.iter_paths(directory_path))
+
+    plan = plan_removals(tags_by_path, patterns, query)
+    tags_removed = sum(len(tags) - len(remaining) for tags, remaining in plan.values())
+
+    if dry_run:
+        for file_path, (tags, remaining) in plan.items():
+            print(f"Would remove {[tag for tag in tags if tag not in remaining]} from {file_path}")
+        print(
+            f"Dry run: {tags_removed} tags would be removed from {len(plan)} of "
+            f"{len(tags_by_path)} images"
+        )
+        return len(plan), tags_removed
+
+    failed = apply_removals(store, plan)
+    for file_path, error in failed.items():
+        print(f"Error removing tags for {file_path}: {error}")
+    changed = {path: change for path, change in plan.items() if path not in failed}
+    tags_removed = sum(len(tags) - len(remaining) for tags, remaining in changed.values())
+
+    for file_path in changed:
+        print(f"Removed tags from {file_path}")
+    if catalog is not None and changed:
+        catalog.record_many((path, remaining, None, None) for path, (_, remaining) in changed.items())
+
+    print(f"Removed {tags_removed} tags from {len(changed)} of {len(tags_by_path)} images")
+    if failed:
+        print(f"Could not remove tags from {len(failed)} images")
+    return len(changed), tags_removed
 
 
-def main():
-    remove_tags_from_images(".")
+def main(store=None, catalog=None, directory=None, patterns=None, query=None, discovery=None, dry_run=False):
+    # Get directory path from the command line, the environment or use the current directory
+    directory = directory or os.getenv("IMAGE_DIRECTORY", ".")
+    remove_tags_from_images(directory, store, catalog, patterns, query, discovery, dry_run)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,188 @@
+import time
+import random
+import logging
+import threading
+
+THROTTLED = "throttled"
+TRANSIENT = "transient"
+FATAL = "fatal"
+
+# How often callers re-check while a half-open breaker's probe is in flight
+PROBE_POLL_INTERVAL = 0.5
+
+
+def classify(error):
+    """Sort an API error into THROTTLED (429), TRANSIENT (worth retrying) or FATAL"""
+    # Imported here so that commands making no API calls never load the SDK
+    from openai import APIConnectionError, APIStatusError
+
+    if isinstance(error, APIConnectionError):
+        # Includes timeouts and connection resets
+        return TRANSIENT
+    if isinstance(error, APIStatusError):
+        if error.status_code == 429:
+            # An exhausted quota does not come back by waiting
+            return FATAL if getattr(error, "code", None) == "insufficient_quota" else THROTTLED
+        if error.status_code in (408, 409) or error.status_code >= 500:
+            return TRANSIENT
+    # 400 (e.g. an invalid or unsupported image), auth errors and anything unexpected
+    return FATAL
+
+
+def retry_after(headers):
+    """Seconds the server asked us to wait through retry-after-ms / retry-after, if any"""
+    if headers is None:
+        return None
+    try:
+        return float(headers["retry-after-ms"]) / 1000
+    except (KeyError, TypeError, ValueError):
+        pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """Stops every caller while the API is down instead of burning through the queue.
+
+    After failure_threshold consecutive transient failures the breaker opens
+    and all callers wait reset_timeout seconds. It then lets a single probe
+    call through (half-open): success closes it, failure reopens it with the
+    timeout doubled, up to max_timeout.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=15.0, max_timeout=300.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_timeout = max_timeout
+        self.state = "closed"
+        self.opened = 0
+        self._timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def wait_time(self):
+        """0 if a call may go out now, otherwise how long to wait before asking again"""
+        with self._lock:
+            if self.state == "closed":
+                return 0.0
+            if self.state == "open":
+                remaining = self._opened_at + self._timeout - time.monotonic()
+                if remaining > 0:
+                    return remaining
+                self.state = "half-open"
+                logging.info("Circuit breaker half-open, sending a probe request")
+            if self._probing:
+                return PROBE_POLL_INTERVAL
+            self._probing = True
+            return 0.0
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logging.info("Circuit breaker closed, API is answering again")
+            self.state = "closed"
+            self._failures = 0
+            self._probing = False
+            self._timeout = self.reset_timeout
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == "half-open":
+                self._probing = False
+                self._timeout = min(self.max_timeout, self._timeout * 2)
+                self._open()
+            elif self.state == "closed" and self._failures >= self.failure_threshold:
+                self._open()
+
+    def _open(self):
+        self.state = "open"
+        self.opened += 1
+        self._opened_at = time.monotonic()
+        logging.warning(
+            f"Circuit breaker open after {self._failures} consecutive failures, "
+            f"pausing all requests for {self._timeout:.0f}s"
+        )
+
+    def record_neutral(self):
+        """A call that says nothing about API health (e.g. a bad image) finished"""
+        with self._lock:
+            if self.state == "half-open":
+                self._probing = False
+
+
+class RetryPolicy:
+    """Decides whether and when a failed vision call is tried again.
+
+    429s and transient failures (timeouts, connection errors, 408/409/5xx)
+    are retried up to max_attempts times with exponential backoff and full
+    jitter, or after the server's Retry-After when it sends one. Fatal
+    errors such as an invalid image are raised at once. Transient failures
+    also feed the CircuitBreaker.
+    """
+
+    def __init__(self, max_attempts=8, base_delay=0.5, max_delay=60.0, breaker=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker()
+        self.retries = {THROTTLED: 0, TRANSIENT: 0}
+        self.gave_up = 0
+        self._lock = threading.Lock()
+
+    def wait_time(self):
+        return self.breaker.wait_time()
+
+    def on_success(self):
+        self.breaker.record_success()
+
+    def on_neutral(self):
+        """A call finished in a way that says nothing about API health"""
+        self.breaker.record_neutral()
+
+    def on_failure(self, error, attempt, paced=False):
+        """Return the seconds to sleep before retrying, or re-raise error when it should not be retried.
+
+        attempt counts from 1. paced means a RateLimiter already holds
+        callers back after a 429, so no extra backoff is added for it.
+        """
+        kind = classify(error)
+        if kind == TRANSIENT:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_neutral()
+        if kind == FATAL or attempt >= self.max_attempts:
+            if kind != FATAL:
+                with self._lock:
+                    self.gave_up += 1
+            raise error
+
+        with self._lock:
+            self.retries[kind] += 1
+        delay = retry_after(getattr(getattr(error, "response", None), "headers", None))
+        if delay is None:
+            if kind == THROTTLED and paced:
+                return 0.0
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        delay = min(delay, self.max_delay)
+        logging.info(f"Retrying after {type(error).__name__} in {delay:.1f}s (attempt {attempt})")
+        return delay
+
+    def summary(self):
+        return (
+            f"{self.retries[THROTTLED]} throttled and {self.retries[TRANSIENT]} transient retries, "
+            f"{self.gave_up} calls given up, circuit breaker opened {self.breaker.opened} times"
+        )
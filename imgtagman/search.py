@@ -0,0 +1,37 @@
+import os
+import time
+import logging
+from imgtagman.discovery import Discovery
+from imgtagman.tag_index import TagIndex
+from imgtagman.tagstore import XattrTagStore
+
+
+def search_images(directory_path, query, catalog, store=None, refresh=True, discovery=None):
+    """Return the images the Discovery would find under directory_path whose tags match a boolean query."""
+    discovery = discovery or Discovery()
+    if refresh:
+        catalog.refresh(directory_path, store or XattrTagStore(), discovery)
+
+    index = TagIndex(catalog)
+    index.ensure_current()
+
+    start = time.perf_counter()
+    # The index covers the whole catalog, which may hold other directories and files outside the scope
+    root = os.path.abspath(directory_path)
+    paths = [path for path in index.search(query) if discovery.in_scope(root, path)]
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    logging.info(f"Query {query!r} matched {len(paths)} images in {elapsed_ms:.3f} ms")
+    return paths
+
+
+def main(query, catalog, store=None, refresh=True, limit=None, directory_path=".", discovery=None):
+    # $IMAGE_DIRECTORY only supplies the command line default, so an explicit --directory wins
+    try:
+        paths = search_images(directory_path, query, catalog, store, refresh, discovery)
+    except ValueError as e:
+        print(f"Invalid query: {e}")
+        return 1
+
+    for path in paths[:limit]:
+        print(path)
+    return 0
@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+
+CACHE_NAME = "tag-cache.sqlite3"
+
+DEFAULT_MAX_SIZE_MB = 256
+DEFAULT_TTL_DAYS = 180
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    tags TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);
+"""
+
+
+def default_cache_path():
+    """$XDG_CACHE_HOME/imgtagman/tag-cache.sqlite3 (~/.cache by default), shared by every directory"""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "imgtagman", CACHE_NAME)
+
+
+def cache_key(content_hash, model, prompt_version, detail_level):
+    return hashlib.sha256(f"{content_hash}\0{model}\0{prompt_version}\0{detail_level}".encode()).hexdigest()
+
+
+class TagCache:
+    """Content-addressed cache of vision responses, so identical images are only paid for once.
+
+    Entries map (content hash, model, prompt version, detail level) to the
+    parsed tag list. Entries older than ttl seconds count as misses, and the
+    least recently used ones are evicted once the cache outgrows max_bytes.
+    """
+
+    def __init__(self, db_path, max_bytes=DEFAULT_MAX_SIZE_MB * 1024 * 1024, ttl=DEFAULT_TTL_DAYS * 86400):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.executescript(SCHEMA)
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, content_hash, model, prompt_version, detail_level):
+        """The cached tags, or None on a miss"""
+        key = cache_key(content_hash, model, prompt_version, detail_level)
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT tags, size, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl and now - row[2] > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._size -= row[1]
+                self.evictions += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, content_hash, model, prompt_version, detail_level, tags):
+        key = cache_key(content_hash, model, prompt_version, detail_level)
+        value = json.dumps(list(tags), ensure_ascii=False)
+        size = len(key) + len(value.encode("utf-8"))
+        now = time.time()
+        with self._lock, self._conn:
+            old = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, tags, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            self._size += size - (old[0] if old else 0)
+            self.stores += 1
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Drop least recently used entries until the cache is back under 90% of its cap"""
+        target = self.max_bytes * 0.9
+        rows = self._conn.execute("SELECT key, size FROM responses ORDER BY accessed_at")
+        evicted = []
+        for key, size in rows:
+            if self._size <= target:
+                break
+            evicted.append((key,))
+            self._size -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+
+    def summary(self):
+        with self._lock:
+            return (
+                f"{self.hits} hits, {self.misses} misses, {self.stores} stored, {self.evictions} evicted, "
+                f"{self._size / 2 ** 20:.1f} MB of {self.max_bytes / 2 ** 20:.0f} MB"
+            )
+
+    def close(self):
+        self._conn.close()
+
+
+def open_cache(cache_path=None, enabled=True, max_size_mb=DEFAULT_MAX_SIZE_MB, ttl_days=DEFAULT_TTL_DAYS):
+    """Open the response cache, or return None when disabled or it cannot be opened"""
+    if not enabled:
+        return None
+    cache_path = cache_path or default_cache_path()
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        return TagCache(cache_path, int(max_size_mb * 1024 * 1024), ttl_days * 86400)
+    except (OSError, sqlite3.Error) as e:
+        logging.warning(f"Cannot open the response cache at {cache_path} ({e}), continuing without it")
+        return None
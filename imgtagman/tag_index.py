@@ -0,0 +1,417 @@
+import re
+import json
+import fnmatch
+import logging
+import sqlite3
+from imgtagman.tagstore import SQLITE_CHUNK_SIZE
+
+# Changes logged for the index before it is dropped (and rebuilt by the next
+# search) rather than caught up, so tagging without searching cannot grow
+# the log without bound
+MAX_LOG_ROWS = 100_000
+
+# While the index is built, the log records every change to the catalog's
+# files since the posting lists were last brought up to date, with the tags
+# the row had before. The triggers are recreated on open so their
+# definitions follow the code.
+INDEX_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS tag_postings (
+    tag TEXT PRIMARY KEY,
+    encoding TEXT NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tag_index_log (
+    seq INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL,
+    old_tags TEXT
+);
+DROP TRIGGER IF EXISTS tag_index_insert;
+DROP TRIGGER IF EXISTS tag_index_update;
+DROP TRIGGER IF EXISTS tag_index_delete;
+DROP TRIGGER IF EXISTS tag_index_cap;
+CREATE TRIGGER tag_index_insert AFTER INSERT ON files
+WHEN EXISTS (SELECT 1 FROM meta WHERE key = 'index_logged') BEGIN
+    INSERT INTO tag_index_log (file_id, old_tags) VALUES (NEW.id, NULL);
+END;
+CREATE TRIGGER tag_index_update AFTER UPDATE OF tags ON files
+WHEN OLD.tags IS NOT NEW.tags AND EXISTS (SELECT 1 FROM meta WHERE key = 'index_logged') BEGIN
+    INSERT INTO tag_index_log (file_id, old_tags) VALUES (NEW.id, OLD.tags);
+END;
+CREATE TRIGGER tag_index_delete AFTER DELETE ON files
+WHEN EXISTS (SELECT 1 FROM meta WHERE key = 'index_logged') BEGIN
+    INSERT INTO tag_index_log (file_id, old_tags) VALUES (OLD.id, OLD.tags);
+END;
+CREATE TRIGGER tag_index_cap AFTER INSERT ON tag_index_log
+WHEN NEW.seq - (SELECT MIN(seq) FROM tag_index_log) >= {MAX_LOG_ROWS} BEGIN
+    DELETE FROM meta WHERE key = 'index_logged';
+    DELETE FROM tag_postings;
+    DELETE FROM tag_index_log;
+END;
+"""
+
+# Posting row holding every indexed image id, used to evaluate NOT
+UNIVERSE = ""
+
+BITMAP = "bitmap"
+DELTA_VARINT = "varint"
+
+# Bitmaps decode in one C call while varints decode byte by byte in Python, so
+# prefer a bitmap unless it is this many times larger than the varint list.
+BITMAP_BIAS = 8
+
+
+def normalize_tag(tag):
+    """Tags are matched case-insensitively and without surrounding whitespace"""
+    return tag.strip().casefold()
+
+
+def encode_postings(ids):
+    """Encode a sorted list of ids as a bitmap (dense tags) or delta-varints (sparse tags)"""
+    if not ids:
+        return DELTA_VARINT, b""
+    varint = bytearray()
+    previous = 0
+    for value in ids:
+        delta = value - previous
+        previous = value
+        while delta >= 0x80:
+            varint.append((delta & 0x7F) | 0x80)
+            delta >>= 7
+        varint.append(delta)
+    bitmap_size = ids[-1] // 8 + 1
+    if bitmap_size <= len(varint) * BITMAP_BIAS:
+        bitmap = bytearray(bitmap_size)
+        for value in ids:
+            bitmap[value >> 3] |= 1 << (value & 7)
+        return BITMAP, bytes(bitmap)
+    return DELTA_VARINT, bytes(varint)
+
+
+def decode_postings(encoding, data):
+    """Decode a posting list into an int bitmap, where bit n is set if id n is present"""
+    if encoding == BITMAP:
+        return int.from_bytes(data, "little")
+    ids = []
+    value = shift = delta = 0
+    for byte in data:
+        delta |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            value += delta
+            ids.append(value)
+            delta = shift = 0
+    return to_bitmap(ids)
+
+
+def to_bitmap(ids):
+    """Build an int bitmap from ids in any order"""
+    if not ids:
+        return 0
+    bitmap = bytearray(max(ids) // 8 + 1)
+    for value in ids:
+        bitmap[value >> 3] |= 1 << (value & 7)
+    return int.from_bytes(bitmap, "little")
+
+
+def iter_ids(bitmap):
+    """Yield the ids set in an int bitmap in ascending order"""
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    for byte_index, byte in enumerate(data):
+        while byte:
+            low_bit = byte & -byte
+            yield byte_index * 8 + low_bit.bit_length() - 1
+            byte ^= low_bit
+
+
+_TOKEN = re.compile(r'\s*(?:(\()|(\))|"([^"]*)"|([^\s()"]+))')
+
+
+def tokenize(query):
+    tokens = []
+    position = 0
+    query = query.rstrip()
+    while position < len(query):
+        match = _TOKEN.match(query, position)
+        if not match:
+            raise ValueError(f"Cannot parse search query near: {query[position:]!r}")
+        position = match.end()
+        open_paren, close_paren, quoted, word = match.groups()
+        if open_paren:
+            tokens.append(("(", None))
+        elif close_paren:
+            tokens.append((")", None))
+        elif quoted is not None:
+            tokens.append(("TAG", quoted))
+        elif word.upper() in ("AND", "OR", "NOT"):
+            tokens.append((word.upper(), None))
+        else:
+            tokens.append(("TAG", word))
+    return tokens
+
+
+def parse_query(query):
+    """Parse a boolean tag query into a nested tuple tree.
+
+    Grammar (NOT binds tightest, then AND, then OR; adjacent terms are ANDed):
+        or_expr  := and_expr ("OR" and_expr)*
+        and_expr := not_expr (["AND"] not_expr)*
+        not_expr := "NOT" not_expr | "(" or_expr ")" | TAG
+    Tags may be quoted to include spaces and may use * and ? wildcards.
+    """
+    tokens = tokenize(query)
+    position = 0
+
+    def peek():
+        return tokens[position][0] if position < len(tokens) else None
+
+    def take(kind):
+        nonlocal position
+        if peek() != kind:
+            found = peek() or "end of query"
+            raise ValueError(f"Expected {kind} in search query, found {found}")
+        position += 1
+        return tokens[position - 1][1]
+
+    def or_expr():
+        node = and_expr()
+        while peek() == "OR":
+            take("OR")
+            node = ("OR", node, and_expr())
+        return node
+
+    def and_expr():
+        node = not_expr()
+        while peek() in ("AND", "NOT", "(", "TAG"):
+            if peek() == "AND":
+                take("AND")
+            node = ("AND", node, not_expr())
+        return node
+
+    def not_expr():
+        if peek() == "NOT":
+            take("NOT")
+            return ("NOT", not_expr())
+        if peek() == "(":
+            take("(")
+            node = or_expr()
+            take(")")
+            return node
+        return ("TAG", normalize_tag(take("TAG")))
+
+    if not tokens:
+        raise ValueError("Empty search query")
+    tree = or_expr()
+    if position != len(tokens):
+        raise ValueError(f"Unexpected {peek()} in search query")
+    return tree
+
+
+def query_tags(tree):
+    """Return the tag patterns a parsed query refers to"""
+    if tree[0] == "TAG":
+        return {tree[1]}
+    return set().union(*(query_tags(child) for child in tree[1:]))
+
+
+def matches(tree, tags):
+    """Evaluate a parsed query against the tags of a single image"""
+    normalized = {normalize_tag(tag) for tag in tags}
+
+    def walk(node):
+        kind = node[0]
+        if kind == "TAG":
+            if _is_wildcard(node[1]):
+                return any(fnmatch.fnmatchcase(tag, node[1]) for tag in normalized)
+            return node[1] in normalized
+        if kind == "NOT":
+            return not walk(node[1])
+        if kind == "AND":
+            return walk(node[1]) and walk(node[2])
+        return walk(node[1]) or walk(node[2])
+
+    return walk(tree)
+
+
+class TagIndex:
+    """Inverted index from normalized tag to the catalog ids of the images carrying it.
+
+    Posting lists live next to the catalog in the same SQLite file. Triggers
+    on the catalog's files log every row that changes, so when the catalog
+    generation moves only the posting lists of the tags those rows carried
+    or now carry are rewritten. The index is only rebuilt from scratch when
+    it is missing or unreadable, or when more than MAX_LOG_ROWS changes
+    piled up since the last search. A query only loads the posting lists of the
+    tags it mentions and combines them as int bitmaps, so AND/OR/NOT are
+    single big-integer operations.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        with catalog.transaction() as conn:
+            conn.executescript(INDEX_SCHEMA)
+
+    def is_current(self):
+        generation = self.catalog.generation()
+        with self.catalog.transaction() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'index_generation'").fetchone()
+        return row is not None and row[0] == generation
+
+    def is_built(self):
+        """Whether the posting lists exist and the change log covers everything since they were built"""
+        with self.catalog.transaction() as conn:
+            # Set by rebuild; indexes from before the change log was kept lack it
+            row = conn.execute("SELECT value FROM meta WHERE key = 'index_logged'").fetchone()
+        return row is not None
+
+    def rebuild(self):
+        """Recompute every posting list from the catalog"""
+        generation = self.catalog.generation()
+        postings = {}
+        universe = []
+        with self.catalog.transaction() as conn:
+            for row_id, tags in conn.execute("SELECT id, tags FROM files ORDER BY id"):
+                universe.append(row_id)
+                for tag in {normalize_tag(tag) for tag in json.loads(tags)} - {UNIVERSE}:
+                    postings.setdefault(tag, []).append(row_id)
+            postings[UNIVERSE] = universe
+            conn.execute("DELETE FROM tag_postings")
+            conn.executemany(
+                "INSERT INTO tag_postings (tag, encoding, data) VALUES (?, ?, ?)",
+                ((tag, *encode_postings(ids)) for tag, ids in postings.items()),
+            )
+            conn.execute("DELETE FROM tag_index_log")
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('index_logged', 1)")
+            self._set_generation(conn, generation)
+        logging.info(f"Rebuilt tag index: {len(postings) - 1} tags over {len(universe)} images")
+
+    def update(self):
+        """Apply the rows logged since the index was last brought up to date to the posting lists"""
+        with self.catalog.transaction() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+            generation = row[0] if row else 0
+            # The tags each changed row had when the index last saw it (None if it is new since)
+            old_tags = {}
+            last_seq = None
+            for seq, file_id, tags in conn.execute("SELECT seq, file_id, old_tags FROM tag_index_log ORDER BY seq"):
+                old_tags.setdefault(file_id, tags)
+                last_seq = seq
+            ids = list(old_tags)
+            new_tags = {}
+            for start in range(0, len(ids), SQLITE_CHUNK_SIZE):
+                chunk = ids[start:start + SQLITE_CHUNK_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                for file_id, tags in conn.execute(f"SELECT id, tags FROM files WHERE id IN ({placeholders})", chunk):
+                    new_tags[file_id] = {normalize_tag(tag) for tag in json.loads(tags)} - {UNIVERSE}
+
+            # Clear the changed ids from every list they were or are in, then set them again where they belong
+            added = {UNIVERSE: list(new_tags)}
+            touched = {UNIVERSE}
+            for tags in old_tags.values():
+                if tags is not None:
+                    touched.update({normalize_tag(tag) for tag in json.loads(tags)})
+            for file_id, tags in new_tags.items():
+                touched.update(tags)
+                for tag in tags:
+                    added.setdefault(tag, []).append(file_id)
+            changed = to_bitmap(ids)
+            bitmaps = self._load_exact(conn, touched)
+            for tag in touched:
+                bitmap = (bitmaps.get(tag, 0) & ~changed) | to_bitmap(added.get(tag, []))
+                if bitmap or tag == UNIVERSE:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO tag_postings (tag, encoding, data) VALUES (?, ?, ?)",
+                        (tag, *encode_postings(list(iter_ids(bitmap)))),
+                    )
+                else:
+                    conn.execute("DELETE FROM tag_postings WHERE tag = ?", (tag,))
+            if last_seq is not None:
+                conn.execute("DELETE FROM tag_index_log WHERE seq <= ?", (last_seq,))
+            self._set_generation(conn, generation)
+        logging.info(f"Updated tag index: {len(ids)} images changed, {len(touched) - 1} tags rewritten")
+
+    def ensure_current(self):
+        if not self.is_built():
+            self.rebuild()
+        elif not self.is_current():
+            try:
+                self.update()
+            except (sqlite3.DatabaseError, TypeError, ValueError) as e:
+                logging.warning(f"Cannot update the tag index ({e}), rebuilding it")
+                self.rebuild()
+
+    @staticmethod
+    def _set_generation(conn, generation):
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('index_generation', ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (generation,),
+        )
+
+    @staticmethod
+    def _load_exact(conn, tags):
+        """Decode the posting lists of the given tags"""
+        tags = list(tags)
+        bitmaps = {}
+        for start in range(0, len(tags), SQLITE_CHUNK_SIZE):
+            chunk = tags[start:start + SQLITE_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            for tag, encoding, data in conn.execute(
+                f"SELECT tag, encoding, data FROM tag_postings WHERE tag IN ({placeholders})", chunk
+            ):
+                bitmaps[tag] = decode_postings(encoding, data)
+        return bitmaps
+
+    def _load(self, patterns, need_universe):
+        """Load the bitmaps of the tags matching each pattern"""
+        with self.catalog.transaction() as conn:
+            exact = [pattern for pattern in patterns if not _is_wildcard(pattern)]
+            wanted = set(exact)
+            if len(wanted) != len(patterns):
+                vocabulary = [tag for (tag,) in conn.execute("SELECT tag FROM tag_postings WHERE tag != ''")]
+                for pattern in patterns - wanted:
+                    wanted.update(fnmatch.filter(vocabulary, pattern))
+            if need_universe:
+                wanted.add(UNIVERSE)
+            return self._load_exact(conn, wanted)
+
+    def evaluate(self, tree):
+        """Evaluate a parsed query, returning an int bitmap of matching ids"""
+        patterns = query_tags(tree)
+        bitmaps = self._load(patterns, need_universe=_uses_not(tree))
+        universe = bitmaps.get(UNIVERSE, 0)
+
+        def match(pattern):
+            if not _is_wildcard(pattern):
+                return bitmaps.get(pattern, 0)
+            result = 0
+            for tag, bitmap in bitmaps.items():
+                if tag != UNIVERSE and fnmatch.fnmatchcase(tag, pattern):
+                    result |= bitmap
+            return result
+
+        def walk(node):
+            kind = node[0]
+            if kind == "TAG":
+                return match(node[1])
+            if kind == "NOT":
+                return universe & ~walk(node[1])
+            if kind == "AND":
+                return walk(node[1]) & walk(node[2])
+            return walk(node[1]) | walk(node[2])
+
+        return walk(tree)
+
+    def search(self, query):
+        """Return the paths of the images matching a boolean tag query"""
+        return self.catalog.paths_for_ids(iter_ids(self.evaluate(parse_query(query))))
+
+
+def _is_wildcard(pattern):
+    return any(c in pattern for c in "*?[")
+
+
+def _uses_not(tree):
+    if tree[0] == "NOT":
+        return True
+    return tree[0] != "TAG" and any(_uses_not(child) for child in tree[1:])
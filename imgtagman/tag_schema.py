@@ -0,0 +1,182 @@
+import json
+import logging
+import threading
+from functools import lru_cache
+
+MAX_TAGS = 10
+MAX_TAG_LENGTH = 60
+
+# What strict structured outputs accept: every property required, nothing else allowed.
+# Strict mode has no string length keywords, so tag length is enforced when parsing.
+TAG_ARRAY_SCHEMA = {
+    "type": "array",
+    "items": {"type": "string"},
+    "maxItems": MAX_TAGS,
+}
+
+
+def _clean_tags(value):
+    """Drop what cannot be a tag and cut the rest to size, so one bad tag does not cost the whole answer"""
+    if not isinstance(value, list):
+        # Left for validation to reject
+        return value
+    tags = []
+    for tag in value:
+        if not isinstance(tag, str):
+            continue
+        tag = tag.strip()[:MAX_TAG_LENGTH].rstrip()
+        if tag:
+            tags.append(tag)
+    if tags != value:
+        logging.warning(f"Dropped or shortened invalid tags in {value!r}")
+    return tags[:MAX_TAGS]
+
+
+@lru_cache(maxsize=None)
+def _validators():
+    """(TagResponse model, tag list adapter), built on first use: answers on the fast path never load pydantic"""
+    from typing import Annotated
+    from pydantic import BaseModel, BeforeValidator, Field, StringConstraints, TypeAdapter
+
+    Tag = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1, max_length=MAX_TAG_LENGTH)]
+    TagList = Annotated[list[Tag], BeforeValidator(_clean_tags), Field(max_length=MAX_TAGS)]
+
+    class TagResponse(BaseModel):
+        """The answer to a single-image request; other keys are ignored"""
+
+        tags: TagList
+
+    return TagResponse, TypeAdapter(TagList)
+
+
+def _object_schema(properties):
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+def _response_format(name, schema):
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+
+def tag_response_format():
+    """response_format for a single image: {"tags": [...]}"""
+    return _response_format("image_tags", _object_schema({"tags": TAG_ARRAY_SCHEMA}))
+
+
+def packed_response_format(count):
+    """response_format for count images: {"0": [...], "1": [...], ...}"""
+    return _response_format(
+        "image_tags_by_index", _object_schema({str(index): TAG_ARRAY_SCHEMA for index in range(count)})
+    )
+
+
+class ParseStats:
+    """How many answers parsed on the fast path, needed full validation, or could not be used"""
+
+    def __init__(self):
+        self.fast = 0
+        self.validated = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def record(self, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    @property
+    def total(self):
+        return self.fast + self.validated + self.failed
+
+    def summary(self):
+        with self._lock:
+            total = self.total
+            rate = self.failed / total if total else 0.0
+            return (
+                f"{self.fast + self.validated} parsed ({self.fast} on the fast path), "
+                f"{self.failed} unparseable ({rate:.1%})"
+            )
+
+
+# Shared by every engine in the process
+PARSE_STATS = ParseStats()
+
+
+def _is_clean(tags):
+    """Whether tags is already what TagList validation would produce"""
+    return (
+        type(tags) is list
+        and len(tags) <= MAX_TAGS
+        and all(type(tag) is str and 0 < len(tag) <= MAX_TAG_LENGTH and tag == tag.strip() for tag in tags)
+    )
+
+
+def _loads(content):
+    """json.loads, also accepting the answer wrapped in a markdown code block"""
+    content = content.strip()
+    if content.startswith("```"):
+        content = content.split("\n", 1)[1].rsplit("```", 1)[0]
+    return json.loads(content)
+
+
+def parse_tags(content):
+    """The tag list in a single-image answer, or None when it cannot be used.
+
+    A well-formed {"tags": [...]} (all that strict structured output can
+    return) is taken straight from json.loads. Anything else goes through
+    pydantic validation, which also accepts the bare array older prompts
+    asked for.
+    """
+    try:
+        parsed = json.loads(content)
+        if type(parsed) is dict and len(parsed) == 1 and _is_clean(parsed.get("tags")):
+            PARSE_STATS.record("fast")
+            return parsed["tags"]
+    except (TypeError, ValueError):
+        pass
+    try:
+        parsed = _loads(content)
+        tag_response, tag_list = _validators()
+        if isinstance(parsed, dict):
+            tags = tag_response.model_validate(parsed).tags
+        else:
+            tags = tag_list.validate_python(parsed)
+    except (AttributeError, IndexError, TypeError, ValueError) as e:  # pydantic's ValidationError is a ValueError
+        PARSE_STATS.record("failed")
+        logging.error(f"Cannot parse tags from OpenAI response {content!r}: {e}")
+        return None
+    PARSE_STATS.record("validated")
+    return tags
+
+
+def parse_packed_tags(content, count):
+    """{image index: tags} from a multi-image answer; indices missing or invalid are left out"""
+    try:
+        parsed = _loads(content)
+    except (AttributeError, IndexError, TypeError, ValueError) as e:
+        PARSE_STATS.record("failed")
+        logging.error(f"Cannot parse packed OpenAI response {content!r}: {e}")
+        return {}
+    if not isinstance(parsed, dict):
+        PARSE_STATS.record("failed")
+        logging.error(f"Packed response is not a JSON object keyed by image: {content!r}")
+        return {}
+    tags = {}
+    outcome = "fast"
+    for index in range(count):
+        value = parsed.get(str(index))
+        if _is_clean(value):
+            tags[index] = value
+            continue
+        if value is None:
+            continue
+        outcome = "validated"
+        try:
+            tags[index] = _validators()[1].validate_python(value)
+        except ValueError as e:
+            logging.warning(f"Invalid tags for image {index} of a packed response: {e}")
+    PARSE_STATS.record(outcome)
+    return tags
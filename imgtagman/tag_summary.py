@@ -1,59 +1,83 @@
+import io
 import os
+import csv
+import json
 from collections import Counter, defaultdict
-from pathlib import Path
-from imgtagman.imgtag import get_file_tags
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import threading
+from imgtagman.catalog import SAMPLE_SIZE
+from imgtagman.discovery import Discovery
+from imgtagman.tagstore import XattrTagStore
 
+FORMATS = ("table", "json", "csv")
 
-def summarize_tags(directory_path):
-    """Summarize tags from all images in a directory."""
-    image_extensions = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff", ".webp"}
-    dir_path = Path(directory_path)
 
+def collect_tag_stats(directory_path, store=None, catalog=None, refresh=True, top=None, discovery=None):
+    """Return [(tag, count, sample_files)] ordered by count, for the images the Discovery finds.
+
+    With a catalog the directory is refreshed first, which only goes back to
+    the tag store for files that changed (see Catalog.iter_refresh), and the
+    tags are counted as the refresh yields them. Without refresh the
+    catalog's materialized statistics are returned instead: they cost
+    O(number of tags) but cover every image in the catalog, whatever the
+    discovery scope. Without a catalog every file's tags are read.
+    """
+    store = store or XattrTagStore()
+    discovery = discovery or Discovery()
+    if catalog is None:
+        return count_tags(store.iter_many(discovery.iter_paths(directory_path)), top)
+    if not refresh and catalog.generation():
+        return catalog.tag_stats(top)
+    return count_tags(catalog.iter_refresh(directory_path, store, discovery), top)
+
+
+def count_tags(tags_by_path, top=None):
+    """Return [(tag, count, sample_files)] ordered by count from (path, tags) pairs"""
     tag_counter = Counter()
     tag_to_files = defaultdict(list)
-    lock = threading.Lock()
-
-    def process_file(file_path):
-        tags = get_file_tags(file_path)
-        with lock:
-            tag_counter.update(tags)
-            for tag in tags:
-                tag_to_files[tag].append(str(file_path))
-
-    # Iterate through all files in the directory using multi-threading
-    with ThreadPoolExecutor(max_workers=50) as executor:
-        futures = [
-            executor.submit(process_file, file_path)
-            for file_path in dir_path.glob("*")
-            if file_path.suffix.lower() in image_extensions
-        ]
-
-        for future in as_completed(futures):
-            try:
-                future.result()
-            except Exception as e:
-                print(f"Error processing file: {e}")
-
-    # Sort tags by count in descending order
-    sorted_tags = tag_counter.most_common()
-
-    # Print the table header
-    print(f"{'Tag':<20} {'Count':<5} {'Files'}")
-    print("-" * 60)
-
-    # Print each tag and its count with up to five files
-    for tag, count in sorted_tags:
-        files = tag_to_files[tag][:5]
+    for file_path, tags in tags_by_path:
+        tags = {tag.strip() for tag in tags if tag.strip()}
+        tag_counter.update(tags)
+        for tag in tags:
+            if len(tag_to_files[tag]) < SAMPLE_SIZE:
+                tag_to_files[tag].append(file_path)
+    return [(tag, count, tag_to_files[tag]) for tag, count in tag_counter.most_common(top)]
+
+
+def format_tag_stats(stats, output_format="table"):
+    """Render tag statistics as a table, JSON or CSV"""
+    if output_format == "json":
+        return json.dumps(
+            [{"tag": tag, "count": count, "files": files} for tag, count, files in stats],
+            ensure_ascii=False,
+            indent=2,
+        )
+
+    if output_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["tag", "count", "files"])
+        for tag, count, files in stats:
+            writer.writerow([tag, count, ";".join(files)])
+        return buffer.getvalue().rstrip("\n")
+
+    # Print the table header, then each tag and its count with up to five files
+    lines = [f"{'Tag':<20} {'Count':<5} {'Files'}", "-" * 60]
+    for tag, count, files in stats:
         files_str = ", ".join(files)
-        print(f"{tag.strip():<20} {count:<5} {files_str}")
+        lines.append(f"{tag:<20} {count:<5} {files_str}")
+    return "\n".join(lines)
+
+
+def summarize_tags(directory_path, store=None, catalog=None, output_format="table", top=None, refresh=True,
+                   discovery=None):
+    """Summarize tags from all images in a directory."""
+    stats = collect_tag_stats(directory_path, store, catalog, refresh, top, discovery)
+    print(format_tag_stats(stats, output_format))
 
 
-def main():
-    # Get directory path from environment variable or use current directory
-    directory = os.getenv("IMAGE_DIRECTORY", ".")
-    summarize_tags(directory)
+def main(store=None, catalog=None, directory=None, output_format="table", top=None, refresh=True, discovery=None):
+    # Get directory path from the command line, the environment or use the current directory
+    directory = directory or os.getenv("IMAGE_DIRECTORY", ".")
+    summarize_tags(directory, store, catalog, output_format, top, refresh, discovery)
 
 
 if __name__ == "__main__":
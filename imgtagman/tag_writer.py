@@ -0,0 +1,117 @@
+import atexit
+import logging
+import threading
+
+
+class WriteBehindWriter:
+    """Queue of tag writes persisted in batches by a dedicated writer thread.
+
+    Workers call submit() and return immediately, so a slow tag store (e.g. a
+    network filesystem) never stalls API calls. Repeated writes to the same
+    path before a flush are coalesced into the latest one. Batches go to the
+    store's set_many and, when a catalog is given, to record_many in one
+    transaction. close() (also run at interpreter exit) drains the queue.
+    """
+
+    def __init__(self, store, catalog=None, batch_size=256, flush_interval=1.0):
+        self.store = store
+        self.catalog = catalog
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.batches = 0
+        self._pending = {}
+        self._writing = False
+        self._closing = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="imgtagman-tag-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, file_path, tags, provenance=None, content_hash=None):
+        """Queue a tag write; a later write to the same path replaces this one"""
+        with self._cond:
+            if self._closing:
+                raise RuntimeError("Tag writer is closed")
+            if file_path in self._pending:
+                self.coalesced += 1
+            self._pending[file_path] = (list(tags), provenance, content_hash)
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._pending) < self.batch_size and not self._closing:
+                    self._cond.wait(self.flush_interval)
+                if not self._pending:
+                    if self._closing:
+                        return
+                    continue
+                batch, self._pending = self._pending, {}
+                self._writing = True
+            try:
+                self._write_batch(batch)
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+
+    def _write_batch(self, batch):
+        try:
+            self.store.set_many({path: tags for path, (tags, _, _) in batch.items()})
+            written = batch
+        except Exception as e:
+            # Retry one by one so a single bad file does not sink the whole batch
+            logging.warning(f"Batch tag write failed ({e}), retrying {len(batch)} files individually")
+            written = {}
+            for path, record in batch.items():
+                try:
+                    self.store.set(path, record[0])
+                    written[path] = record
+                except Exception as e:
+                    self.failed += 1
+                    logging.error(f"Error setting tags for {path}: {e}")
+
+        if self.catalog is not None and written:
+            try:
+                self.catalog.record_many(
+                    (path, tags, provenance, content_hash)
+                    for path, (tags, provenance, content_hash) in written.items()
+                )
+            except Exception as e:
+                logging.error(f"Error recording {len(written)} tag writes in the catalog: {e}")
+        self.written += len(written)
+        self.batches += 1
+        logging.info(f"Flushed {len(written)} tag writes")
+
+    def flush(self):
+        """Block until every write submitted so far has been persisted"""
+        with self._cond:
+            self._cond.notify_all()
+            while (self._pending or self._writing) and self._thread.is_alive():
+                self._cond.wait(0.1)
+
+    def close(self):
+        """Flush the queue and stop the writer thread"""
+        with self._cond:
+            if self._closing:
+                return
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+        atexit.unregister(self.close)
+
+    def summary(self):
+        return (
+            f"{self.written} tag writes in {self.batches} batches, "
+            f"{self.coalesced} coalesced, {self.failed} failed"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
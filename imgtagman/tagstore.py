@@ -0,0 +1,285 @@
+import os
+import json
+import sqlite3
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from imgtagman.pipeline import iter_batches
+from imgtagman.xattr_tags import clear_tags, read_tags_bulk, write_tags
+
+SIDECAR_NAME = ".imgtagman-tags.json"
+SQLITE_NAME = ".imgtagman-tags.sqlite3"
+
+# Keep IN (...) lists below SQLite's default host parameter limit
+SQLITE_CHUNK_SIZE = 500
+
+
+def normalize_tags(tags):
+    """Strip tags, drop empty ones and remove duplicates, keeping the first occurrence"""
+    seen = set()
+    normalized = []
+    for tag in tags:
+        tag = tag.strip()
+        if tag and tag not in seen:
+            seen.add(tag)
+            normalized.append(tag)
+    return normalized
+
+
+class TagStore(ABC):
+    """Where image tags are persisted.
+
+    Backends implement the batch methods so they can group reads and writes;
+    the single-path helpers are thin wrappers around them. Paths are returned
+    as strings, exactly as they were passed in.
+
+    Writes are diff-based: set_many compares the target tags with what is
+    stored and only hands paths whose tag set actually changes to the
+    backend's _write_many, so no-op writes never touch the file (and never
+    bump its ctime). The counters record how many writes were made and skipped.
+
+    spec names where the tags live (the catalog remembers which store it
+    mirrors). tags_in_file says whether writing tags changes the image's own
+    stat, so that an unchanged stat means unchanged tags.
+    """
+
+    spec = None
+    tags_in_file = False
+
+    def __init__(self):
+        self.writes = 0
+        self.skipped_writes = 0
+        self._stats_lock = threading.Lock()
+
+    @abstractmethod
+    def get_many(self, paths):
+        """Return a path -> tags map for the given paths"""
+
+    def iter_many(self, paths, batch_size=256):
+        """Yield (path, tags) for an iterable of paths, reading them batch_size at a time"""
+        for batch in iter_batches(paths, batch_size):
+            yield from self.get_many(batch).items()
+
+    @abstractmethod
+    def _write_many(self, tags_by_path):
+        """Unconditionally replace the tags of every path in a path -> tags map"""
+
+    def set_many(self, tags_by_path):
+        """Replace the tags of every path in a path -> tags map, skipping unchanged ones"""
+        targets = {str(path): normalize_tags(tags) for path, tags in tags_by_path.items()}
+        current = self.get_many(targets)
+        changed = {
+            path: tags for path, tags in targets.items() if set(tags) != set(normalize_tags(current[path]))
+        }
+        cleared = [path for path, tags in changed.items() if not tags]
+        if cleared:
+            self.delete_many(cleared)
+        if len(cleared) < len(changed):
+            self._write_many({path: tags for path, tags in changed.items() if tags})
+        with self._stats_lock:
+            self.writes += len(changed)
+            self.skipped_writes += len(targets) - len(changed)
+        return list(changed)
+
+    def update_many(self, deltas):
+        """Apply {path: (tags_to_add, tags_to_remove)} deltas instead of replacing tags"""
+        current = self.get_many(deltas)
+        targets = {}
+        for path, (add, remove) in deltas.items():
+            remove = set(remove)
+            tags = [tag for tag in current[str(path)] if tag not in remove]
+            targets[str(path)] = tags + [tag for tag in add if tag not in tags]
+        return self.set_many(targets)
+
+    @abstractmethod
+    def delete_many(self, paths):
+        """Remove all tags from the given paths, returning the paths that had any"""
+
+    def get(self, path):
+        return self.get_many([path])[str(path)]
+
+    def set(self, path, tags):
+        return bool(self.set_many({str(path): tags}))
+
+    def update(self, path, add=(), remove=()):
+        return bool(self.update_many({str(path): (add, remove)}))
+
+    def delete(self, path):
+        return bool(self.delete_many([path]))
+
+    def summary(self):
+        return f"{self.writes} written, {self.skipped_writes} skipped as unchanged"
+
+    def close(self):
+        pass
+
+
+class XattrTagStore(TagStore):
+    """Tags kept in each file's extended attributes (Finder tags on macOS)"""
+
+    spec = "xattr"
+    # Writing an extended attribute bumps the file's ctime
+    tags_in_file = True
+
+    def get_many(self, paths):
+        return read_tags_bulk(paths)
+
+    def _write_many(self, tags_by_path):
+        for path, tags in tags_by_path.items():
+            write_tags(path, tags)
+
+    def delete_many(self, paths):
+        return [str(path) for path in paths if clear_tags(path)]
+
+
+class SidecarTagStore(TagStore):
+    """Tags kept in one JSON file per directory, for filesystems without xattr"""
+
+    spec = "sidecar"
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _group_by_directory(paths):
+        groups = defaultdict(list)
+        for path in paths:
+            directory, name = os.path.split(os.path.abspath(path))
+            groups[directory].append((str(path), name))
+        return groups
+
+    @staticmethod
+    def _load(directory):
+        try:
+            with open(os.path.join(directory, SIDECAR_NAME), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    @staticmethod
+    def _save(directory, sidecar):
+        # Write a temporary file and rename it so a crash never leaves a torn sidecar
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=SIDECAR_NAME, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(sidecar, f, ensure_ascii=False, indent=1, sort_keys=True)
+            os.replace(tmp_path, os.path.join(directory, SIDECAR_NAME))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def get_many(self, paths):
+        tags_by_path = {}
+        for directory, entries in self._group_by_directory(paths).items():
+            sidecar = self._load(directory)
+            for path, name in entries:
+                tags_by_path[path] = list(sidecar.get(name, []))
+        return tags_by_path
+
+    def _write_many(self, tags_by_path):
+        with self._lock:
+            for directory, entries in self._group_by_directory(tags_by_path).items():
+                sidecar = self._load(directory)
+                for path, name in entries:
+                    sidecar[name] = list(tags_by_path[path])
+                self._save(directory, sidecar)
+
+    def delete_many(self, paths):
+        removed = []
+        with self._lock:
+            for directory, entries in self._group_by_directory(paths).items():
+                sidecar = self._load(directory)
+                removed_here = [path for path, name in entries if sidecar.pop(name, None)]
+                if removed_here:
+                    self._save(directory, sidecar)
+                    removed.extend(removed_here)
+        return removed
+
+
+class SQLiteTagStore(TagStore):
+    """Tags kept in a SQLite database, for read-only media or shared libraries"""
+
+    def __init__(self, db_path):
+        super().__init__()
+        self.db_path = db_path
+        self.spec = f"sqlite:{os.path.abspath(db_path)}"
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tags (path TEXT PRIMARY KEY, tags TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get_many(self, paths):
+        paths = [str(path) for path in paths]
+        found = {}
+        with self._lock:
+            for start in range(0, len(paths), SQLITE_CHUNK_SIZE):
+                chunk = [os.path.abspath(path) for path in paths[start:start + SQLITE_CHUNK_SIZE]]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT path, tags FROM tags WHERE path IN ({placeholders})", chunk
+                )
+                found.update((path, json.loads(tags)) for path, tags in rows)
+        return {path: found.get(os.path.abspath(path), []) for path in paths}
+
+    def _write_many(self, tags_by_path):
+        rows = [
+            (os.path.abspath(path), json.dumps(list(tags), ensure_ascii=False))
+            for path, tags in tags_by_path.items()
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO tags (path, tags) VALUES (?, ?)", rows)
+
+    def delete_many(self, paths):
+        existing = self.get_many(paths)
+        removed = [path for path, tags in existing.items() if tags]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM tags WHERE path = ?", [(os.path.abspath(path),) for path in removed]
+            )
+        return removed
+
+    def close(self):
+        self._conn.close()
+
+
+class MemoryTagStore(TagStore):
+    """Tags kept in a dict, for tests; not offered by open_store, since tags written there are lost on exit"""
+
+    spec = "memory"
+
+    def __init__(self, tags_by_path=None):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._tags = {os.path.abspath(path): list(tags) for path, tags in (tags_by_path or {}).items()}
+
+    def get_many(self, paths):
+        with self._lock:
+            return {str(path): list(self._tags.get(os.path.abspath(path), [])) for path in paths}
+
+    def _write_many(self, tags_by_path):
+        with self._lock:
+            for path, tags in tags_by_path.items():
+                self._tags[os.path.abspath(path)] = list(tags)
+
+    def delete_many(self, paths):
+        with self._lock:
+            return [str(path) for path in paths if self._tags.pop(os.path.abspath(path), None)]
+
+
+STORE_CHOICES = "xattr, sidecar or sqlite[:PATH]"
+
+
+def open_store(spec="xattr", directory="."):
+    """Create a tag store from a command line spec such as "sqlite:/path/to/tags.db"."""
+    name, _, argument = spec.partition(":")
+    if name == "xattr":
+        return XattrTagStore()
+    if name == "sidecar":
+        return SidecarTagStore()
+    if name == "sqlite":
+        return SQLiteTagStore(argument or os.path.join(directory, SQLITE_NAME))
+    raise ValueError(f"Unknown tag store '{spec}'. Expected {STORE_CHOICES}.")
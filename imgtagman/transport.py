@@ -0,0 +1,201 @@
+import os
+import logging
+import threading
+from functools import lru_cache
+from imgtagman.preprocess import iter_streamed, streamed_length, streamed_parts
+
+# httpx and the SDK are imported where they are used, so that importing this module stays cheap
+
+# The SDK keeps only 100 idle connections, for 5 seconds; beyond that every
+# request in a burst (--engine async keeps 256 in flight) opens a new one.
+# Keeping as many idle connections as may be open stops that churn.
+DEFAULT_MAX_CONNECTIONS = 256
+DEFAULT_KEEPALIVE_EXPIRY = 30.0
+DEFAULT_CONNECT_TIMEOUT = 10.0
+# A vision completion rarely takes more than a few seconds; the SDK waits 10 minutes
+DEFAULT_READ_TIMEOUT = 120.0
+
+# Environment variables read by Transport.from_env for settings not given explicitly
+ENVIRONMENT = {
+    "max_connections": "IMGTAGMAN_MAX_CONNECTIONS",
+    "keepalive_expiry": "IMGTAGMAN_KEEPALIVE_EXPIRY",
+    "http2": "IMGTAGMAN_HTTP2",
+    "connect_timeout": "IMGTAGMAN_CONNECT_TIMEOUT",
+    "read_timeout": "IMGTAGMAN_READ_TIMEOUT",
+}
+
+# httpcore trace events marking a new connection and a request sent on any connection
+CONNECTION_EVENT = "connection.connect_tcp.complete"
+REQUEST_EVENTS = ("http11.send_request_headers.started", "http2.send_request_headers.started")
+
+
+def http2_available():
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class Transport:
+    """Connection pool settings for the OpenAI clients, and how well their connections are reused.
+
+    Up to max_connections connections are opened and all of them are kept
+    for reuse until idle for keepalive_expiry seconds. With http2, requests
+    to the same host are multiplexed over few connections instead (needs the
+    h2 package; without it HTTP/1.1 is used). Every client made from one
+    Transport feeds the same counters through httpx's trace extension:
+    requests sent and connections opened, so summary() shows the share of
+    requests that went out on an existing connection.
+    """
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, keepalive_expiry=DEFAULT_KEEPALIVE_EXPIRY,
+                 http2=False, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT):
+        if http2 and not http2_available():
+            logging.warning("HTTP/2 needs the h2 package (pip install imgtagman[http2]); using HTTP/1.1")
+            http2 = False
+        self.max_connections = max_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.requests = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, **settings):
+        """A Transport from the given settings; those left None come from $IMGTAGMAN_* or the defaults"""
+        for name, variable in ENVIRONMENT.items():
+            if settings.get(name) is not None or not os.environ.get(variable):
+                continue
+            value = os.environ[variable]
+            if name == "http2":
+                settings[name] = value.lower() in ("1", "true", "yes", "on")
+            elif name == "max_connections":
+                settings[name] = int(value)
+            else:
+                settings[name] = float(value)
+        return cls(**{name: value for name, value in settings.items() if value is not None})
+
+    def limits(self):
+        import httpx
+
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    def timeout(self):
+        import httpx
+
+        return httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+
+    def _trace(self, event_name, info):
+        if event_name == CONNECTION_EVENT:
+            with self._lock:
+                self.connections += 1
+        elif event_name in REQUEST_EVENTS:
+            with self._lock:
+                self.requests += 1
+
+    async def _trace_async(self, event_name, info):
+        self._trace(event_name, info)
+
+    def _on_request(self, request):
+        request.extensions["trace"] = self._trace
+        _stream_files(request)
+
+    async def _on_request_async(self, request):
+        request.extensions["trace"] = self._trace_async
+        _stream_files(request)
+
+    def client_options(self):
+        """Keyword arguments for OpenAI(...) that route its requests through this transport"""
+        from openai import DefaultHttpxClient
+
+        http_client = DefaultHttpxClient(
+            limits=self.limits(), http2=self.http2, event_hooks={"request": [self._on_request]}
+        )
+        return {"timeout": self.timeout(), "http_client": http_client}
+
+    def async_client_options(self):
+        """Keyword arguments for AsyncOpenAI(...) that route its requests through this transport"""
+        from openai import DefaultAsyncHttpxClient
+
+        http_client = DefaultAsyncHttpxClient(
+            limits=self.limits(), http2=self.http2, event_hooks={"request": [self._on_request_async]}
+        )
+        return {"timeout": self.timeout(), "http_client": http_client}
+
+    def summary(self):
+        with self._lock:
+            requests, connections = self.requests, self.connections
+        reused = 1 - connections / requests if requests else 0.0
+        return (
+            f"{requests} requests over {connections} new connections ({reused:.0%} reused), "
+            f"pool of {self.max_connections} kept {self.keepalive_expiry:g}s, HTTP/2 {'on' if self.http2 else 'off'}"
+        )
+
+
+@lru_cache(maxsize=None)
+def _streamed_body():
+    """The httpx stream class for bodies with streamed files, defined on first use"""
+    import httpx
+
+    class StreamedBody(httpx.SyncByteStream, httpx.AsyncByteStream):
+        """Sends the pieces of a body, base64-encoding its files a chunk at a time"""
+
+        def __init__(self, parts):
+            self.parts = parts
+
+        def __iter__(self):
+            yield from iter_streamed(self.parts)
+
+        async def __aiter__(self):
+            import asyncio
+
+            # Files are read and encoded off the event loop
+            chunks = iter_streamed(self.parts)
+            while True:
+                chunk = await asyncio.to_thread(next, chunks, None)
+                if chunk is None:
+                    return
+                yield chunk
+
+    return StreamedBody
+
+
+def _stream_files(request):
+    """Have a request whose body names streamed files (see streamed_data_url) send their base64 instead"""
+    import httpx
+
+    if not isinstance(request.stream, httpx.ByteStream):
+        # Multipart uploads and bodies that are already streams
+        return
+    parts = streamed_parts(request.content)
+    if parts is None:
+        return
+    request.stream = _streamed_body()(parts)
+    request.headers["Content-Length"] = str(streamed_length(parts))
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def configure_transport(transport):
+    """Use transport for the OpenAI clients created from now on"""
+    global _transport
+    with _transport_lock:
+        _transport = transport
+
+
+def get_transport():
+    """The configured Transport, or one from the environment if none was configured"""
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = Transport.from_env()
+        return _transport
@@ -0,0 +1,255 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from imgtagman.discovery import Discovery
+from imgtagman.imgtag import THREAD_WORKERS, process_file, upload_extensions
+from imgtagman.preprocess import open_preprocessor
+from imgtagman.rate_limit import RateLimiter
+from imgtagman.retry import RetryPolicy
+from imgtagman.tag_schema import PARSE_STATS
+from imgtagman.tag_writer import WriteBehindWriter
+from imgtagman.tagstore import XattrTagStore
+from imgtagman.transport import get_transport
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")
+
+# How long an empty file may sit unchanged before the Debouncer stops checking it
+MAX_EMPTY_WAIT = 300.0
+
+
+def _is_visible_directory(entry):
+    return not entry.name.startswith(".") and entry.is_dir(follow_symlinks=False)
+
+
+class InotifyWatcher:
+    """Reports files written or moved into a directory tree using Linux inotify"""
+
+    def __init__(self, root, recursive=True):
+        import ctypes
+        import ctypes.util
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._ctypes = ctypes
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        self.root = root
+        self.recursive = recursive
+        self._directories = {}
+        self._add_tree(root)
+
+    def _add_watch(self, directory):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            code = self._ctypes.get_errno()
+            raise OSError(code, os.strerror(code), directory)
+        self._directories[wd] = directory
+
+    def _add_tree(self, directory):
+        """Watch a directory (and its subdirectories), returning the files already inside it"""
+        self._add_watch(directory)
+        found = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if self.recursive and _is_visible_directory(entry):
+                    found.extend(self._add_tree(entry.path))
+                elif entry.is_file():
+                    found.append(entry.path)
+        return found
+
+    def read(self, timeout):
+        """Wait up to timeout seconds and return the paths that changed"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_length].rstrip(b"\0"))
+            offset += name_length
+
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("inotify queue overflowed, rescanning the tree")
+                paths.extend(Discovery(max_depth=None if self.recursive else 0).iter_paths(self.root))
+                continue
+            if mask & IN_IGNORED:
+                self._directories.pop(wd, None)
+                continue
+            directory = self._directories.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                # A directory appeared (possibly already full, e.g. moved in): watch it and take its files
+                if self.recursive and not name.startswith(".") and mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        paths.extend(self._add_tree(path))
+                    except OSError as e:
+                        logging.error(f"Cannot watch {path}: {e}")
+            else:
+                paths.append(path)
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Reports new or changed files by comparing periodic scandir snapshots"""
+
+    def __init__(self, root, recursive=True, interval=5.0):
+        self.root = root
+        self.recursive = recursive
+        self.interval = interval
+        self._snapshot = self._scan()
+        self._next_scan = time.monotonic() + interval
+
+    def _scan(self):
+        snapshot = {}
+        for entry in Discovery(max_depth=None if self.recursive else 0).iter_entries(self.root):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            snapshot[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def read(self, timeout):
+        delay = self._next_scan - time.monotonic()
+        if delay > 0:
+            time.sleep(min(delay, timeout))
+            if time.monotonic() < self._next_scan:
+                return []
+        self._next_scan = time.monotonic() + self.interval
+        snapshot = self._scan()
+        changed = [path for path, key in snapshot.items() if self._snapshot.get(path) != key]
+        self._snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+def open_watcher(directory, recursive=True, poll=False, poll_interval=5.0):
+    """Use inotify where available, falling back to polling"""
+    if not poll and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(directory, recursive)
+        except OSError as e:
+            if e.errno not in (errno.EMFILE, errno.ENOSPC, errno.ENOSYS, errno.EPERM, errno.EACCES):
+                raise
+            logging.warning(f"inotify unavailable ({e}), falling back to polling")
+    return PollingWatcher(directory, recursive, poll_interval)
+
+
+class Debouncer:
+    """Holds back files until they have stopped changing for settle seconds.
+
+    Scanners and phone sync tools often write a file in several bursts, so a
+    file is only released once no event arrived for it during the settle
+    window and its size and mtime are the same on two consecutive checks.
+    Empty files (a touched placeholder, a failed copy) are held until they
+    get content, and dropped once they have not changed for max_wait seconds;
+    a later write brings them back.
+    """
+
+    def __init__(self, settle=2.0, max_wait=MAX_EMPTY_WAIT):
+        self.settle = settle
+        self.max_wait = max_wait
+        self._pending = {}
+
+    def touch(self, path):
+        self._pending[path] = (time.monotonic(), None)
+
+    def ready(self):
+        now = time.monotonic()
+        released = []
+        for path, (last_change, last_stat) in list(self._pending.items()):
+            if now - last_change < self.settle:
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                del self._pending[path]
+                continue
+            key = (stat.st_size, stat.st_mtime_ns)
+            if key != last_stat:
+                self._pending[path] = (now, key)
+            elif stat.st_size > 0:
+                del self._pending[path]
+                released.append(path)
+            elif now - last_change >= self.max_wait:
+                logging.info(f"Giving up on {path}: still empty after {self.max_wait:.0f}s")
+                del self._pending[path]
+        return released
+
+
+def watch_directory(directory_path, detail_level="low", store=None, catalog=None, settle=2.0,
+                    recursive=True, poll=False, poll_interval=5.0, extensions=None, preprocess=True,
+                    upload_format="jpeg", cache=None):
+    """Tag images as they land in a directory tree until interrupted."""
+    store = store or XattrTagStore()
+    directory = os.path.abspath(directory_path)
+    if not os.path.isdir(directory):
+        raise FileNotFoundError(f"Directory does not exist: {directory_path}")
+    preprocessor = open_preprocessor(detail_level, upload_format, preprocess)
+    extensions = extensions or upload_extensions(preprocessor)
+
+    watcher = open_watcher(directory, recursive, poll, poll_interval)
+    debouncer = Debouncer(settle)
+    limiter = RateLimiter(None, None, THREAD_WORKERS, THREAD_WORKERS)
+    retry = RetryPolicy()
+    logging.info(f"Watching {directory} with {type(watcher).__name__}")
+
+    with WriteBehindWriter(store, catalog, flush_interval=settle) as writer:
+        executor = ThreadPoolExecutor(THREAD_WORKERS)
+        try:
+            while True:
+                for path in watcher.read(min(settle, 1.0)):
+                    if os.path.splitext(path)[1].lower() in extensions:
+                        debouncer.touch(path)
+                for path in debouncer.ready():
+                    logging.info(f"New image: {path}")
+                    executor.submit(
+                        process_file, path, detail_level, None, store, catalog, writer, limiter, retry,
+                        preprocessor, cache,
+                    )
+        except KeyboardInterrupt:
+            logging.info("Stopping watch, flushing queued tag writes")
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            watcher.close()
+            if preprocessor is not None:
+                preprocessor.close()
+    logging.info(f"Tag writes: {writer.summary()}; store: {store.summary()}")
+    logging.info(f"Rate limiter: {limiter.summary()}; retries: {retry.summary()}")
+    if cache is not None:
+        logging.info(f"Response cache: {cache.summary()}")
+    if PARSE_STATS.total:
+        logging.info(f"Responses: {PARSE_STATS.summary()}")
+    logging.info(f"Connections: {get_transport().summary()}")
@@ -0,0 +1,156 @@
+import os
+import sys
+import errno
+import logging
+import plistlib
+from imgtagman.discovery import IMAGE_EXTENSIONS, iter_image_paths
+
+# macOS keeps Finder tags in a binary plist under this attribute; on Linux we
+# follow the freedesktop.org convention of a comma separated user attribute.
+if sys.platform == "darwin":
+    TAG_ATTRIBUTE = "com.apple.metadata:_kMDItemUserTags"
+else:
+    TAG_ATTRIBUTE = "user.xdg.tags"
+
+# errno values meaning "the attribute is not set" (ENODATA on Linux, ENOATTR on macOS)
+_MISSING_ATTRIBUTE = {
+    code for code in (getattr(errno, "ENODATA", None), getattr(errno, "ENOATTR", None)) if code
+}
+
+
+if hasattr(os, "getxattr"):
+    _getxattr = os.getxattr
+    _setxattr = os.setxattr
+    _removexattr = os.removexattr
+else:
+    # CPython only exposes the xattr calls on Linux, so call libc directly on macOS.
+    import ctypes
+    import ctypes.util
+
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.getxattr.argtypes = [
+        ctypes.c_char_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint32, ctypes.c_int
+    ]
+    _libc.getxattr.restype = ctypes.c_ssize_t
+    _libc.setxattr.argtypes = [
+        ctypes.c_char_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint32, ctypes.c_int
+    ]
+    _libc.setxattr.restype = ctypes.c_int
+    _libc.removexattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int]
+    _libc.removexattr.restype = ctypes.c_int
+
+    def _raise_oserror(path):
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code), str(path))
+
+    def _getxattr(path, attribute):
+        path_bytes = os.fsencode(path)
+        name = attribute.encode("utf-8")
+        size = _libc.getxattr(path_bytes, name, None, 0, 0, 0)
+        if size < 0:
+            _raise_oserror(path)
+        buffer = ctypes.create_string_buffer(size)
+        size = _libc.getxattr(path_bytes, name, buffer, size, 0, 0)
+        if size < 0:
+            _raise_oserror(path)
+        return buffer.raw[:size]
+
+    def _setxattr(path, attribute, value):
+        if _libc.setxattr(os.fsencode(path), attribute.encode("utf-8"), value, len(value), 0, 0) != 0:
+            _raise_oserror(path)
+
+    def _removexattr(path, attribute):
+        if _libc.removexattr(os.fsencode(path), attribute.encode("utf-8"), 0) != 0:
+            _raise_oserror(path)
+
+
+def encode_tags(tags):
+    """Encode a list of tags into the platform's attribute payload"""
+    if sys.platform == "darwin":
+        return plistlib.dumps(list(tags), fmt=plistlib.FMT_BINARY)
+    return ",".join(tag.replace(",", " ").strip() for tag in tags).encode("utf-8")
+
+
+def decode_tags(value):
+    """Decode the platform's attribute payload into a list of tags"""
+    if sys.platform == "darwin":
+        tags = plistlib.loads(value)
+        # Finder appends the label colour as "\n<index>"; keep only the name.
+        return [tag.split("\n", 1)[0].strip() for tag in tags if tag.strip()]
+    return [tag.strip() for tag in value.decode("utf-8").split(",") if tag.strip()]
+
+
+def read_tags(file_path):
+    """Read the tags of a file straight from its extended attributes"""
+    try:
+        value = _getxattr(str(file_path), TAG_ATTRIBUTE)
+    except OSError as e:
+        if e.errno in _MISSING_ATTRIBUTE:
+            return []
+        raise
+    return decode_tags(value)
+
+
+def write_tags(file_path, tags):
+    """Replace the tags of a file"""
+    _setxattr(str(file_path), TAG_ATTRIBUTE, encode_tags(tags))
+
+
+def clear_tags(file_path):
+    """Remove the tag attribute from a file, returning False if it had none"""
+    try:
+        _removexattr(str(file_path), TAG_ATTRIBUTE)
+    except OSError as e:
+        if e.errno in _MISSING_ATTRIBUTE:
+            return False
+        raise
+    return True
+
+
+def get_file_tags(file_path):
+    """Get existing tags from a file's extended attributes"""
+    try:
+        logging.info(f"Getting existing tags for: {file_path}")
+        tags_list = read_tags(file_path)
+        if not tags_list:
+            logging.info(f"No existing tags found for: {file_path}")
+            return []
+
+        logging.info(f"Found existing tags for {file_path}: {tags_list}")
+        return tags_list
+    except Exception as e:
+        logging.error(f"Error getting tags for {file_path}: {e}")
+        return []
+
+
+def set_file_tags(file_path, tags):
+    """Set tags for a file's extended attributes"""
+    try:
+        logging.info(f"Setting tags for {file_path}: {tags}")
+        write_tags(file_path, tags)
+        logging.info(f"Successfully set tags for: {file_path}")
+    except Exception as e:
+        logging.error(f"Error setting tags for {file_path}: {e}")
+        raise
+
+
+def read_tags_bulk(paths_or_dir, extensions=IMAGE_EXTENSIONS):
+    """Read the tags of many files at once, returning a path -> tags map.
+
+    Accepts either a directory, which is scanned once for image files, or an
+    iterable of paths. Files whose tags cannot be read (including an
+    attribute that does not decode) are logged and map to an empty list.
+    """
+    if isinstance(paths_or_dir, (str, os.PathLike)):
+        paths = iter_image_paths(paths_or_dir, extensions)
+    else:
+        paths = (str(path) for path in paths_or_dir)
+
+    tags_by_path = {}
+    for path in paths:
+        try:
+            tags_by_path[path] = read_tags(path)
+        except (OSError, ValueError) as e:  # UnicodeDecodeError and plistlib.InvalidFileException are ValueErrors
+            logging.error(f"Error getting tags for {path}: {e}")
+            tags_by_path[path] = []
+    return tags_by_path
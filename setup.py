@@ -9,8 +9,20 @@ setup(
     packages=find_packages(include=["imgtagman"]),
     install_requires=[
         "openai",
+        # Validates the model's structured answers
+        "pydantic>=2",
         # Add other dependencies here
     ],
+    extras_require={
+        # Downscale and re-encode images before upload
+        "preprocess": ["Pillow"],
+        # Find near-duplicate images and tag each group once
+        "dedupe": ["Pillow", "numpy"],
+        # Multiplex API requests over HTTP/2 (--http2)
+        "http2": ["httpx[http2]"],
+        # Run the test suite (python -m pytest)
+        "test": ["pytest"],
+    },
     entry_points={
         "console_scripts": [
             "imgtagman=imgtagman.imgtagman:main",
@@ -0,0 +1,145 @@
+import os
+import pytest
+from imgtagman.catalog import Catalog
+from imgtagman.discovery import Discovery
+from imgtagman.tag_index import TagIndex
+from imgtagman.tagstore import MemoryTagStore
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    return Catalog(str(tmp_path / "catalog.sqlite3"))
+
+
+def make_images(directory, *names):
+    paths = []
+    for name in names:
+        path = directory / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"")
+        paths.append(str(path))
+    return paths
+
+
+def tag_counts(catalog):
+    return {tag: count for tag, count, _ in catalog.tag_stats()}
+
+
+def test_refresh_reads_tags_from_the_store(tmp_path, catalog):
+    first, second = make_images(tmp_path, "a.jpg", "b.png")
+    store = MemoryTagStore({first: ["sky", "sea"]})
+    assert catalog.refresh(str(tmp_path), store) == {first: ["sky", "sea"], second: []}
+    assert tag_counts(catalog) == {"sky": 1, "sea": 1}
+
+
+def test_refresh_rereads_stores_kept_outside_the_file(tmp_path, catalog):
+    (image,) = make_images(tmp_path, "a.jpg")
+    store = MemoryTagStore()
+    catalog.refresh(str(tmp_path), store)
+    generation = catalog.generation()
+    catalog.refresh(str(tmp_path), store)
+    assert catalog.generation() == generation
+
+    # The image's stat does not move when a memory store's tags change
+    store.set(image, ["sky"])
+    assert catalog.refresh(str(tmp_path), store) == {image: ["sky"]}
+    assert catalog.generation() > generation
+
+
+def test_refresh_prunes_deleted_files(tmp_path, catalog):
+    kept, deleted = make_images(tmp_path, "a.jpg", "b.jpg")
+    store = MemoryTagStore({kept: ["sky"], deleted: ["sky", "sea"]})
+    catalog.refresh(str(tmp_path), store)
+    (tmp_path / "b.jpg").unlink()
+    assert catalog.refresh(str(tmp_path), store) == {kept: ["sky"]}
+    assert tag_counts(catalog) == {"sky": 1}
+
+
+def test_files_deleted_during_a_refresh_are_pruned(tmp_path, catalog):
+    kept, deleted = make_images(tmp_path, "a.jpg", "b.jpg")
+    store = MemoryTagStore({deleted: ["sea"]})
+    catalog.refresh(str(tmp_path), store)
+
+    class Entry:
+        def __init__(self, path):
+            self.path = path
+
+        def stat(self):
+            return os.stat(self.path)
+
+    class Racing(Discovery):
+        def iter_entries(self, directory):
+            entries = [Entry(entry.path) for entry in super().iter_entries(directory)]
+            os.unlink(deleted)
+            return iter(entries)
+
+    assert catalog.refresh(str(tmp_path), store, Racing()) == {kept: []}
+    assert tag_counts(catalog) == {}
+
+
+def test_recording_a_deleted_file_drops_its_row(tmp_path, catalog):
+    kept, deleted = make_images(tmp_path, "a.jpg", "b.jpg")
+    catalog.record_many([(kept, ["sky"], None, None), (deleted, ["sea"], None, None)])
+    os.unlink(deleted)
+    catalog.record_many([(kept, ["sky"], None, None), (deleted, ["tree"], None, None)])
+    assert catalog.get(deleted) is None
+    assert tag_counts(catalog) == {"sky": 1}
+
+
+def test_refresh_keeps_rows_outside_the_discovery_scope(tmp_path, catalog):
+    top, nested = make_images(tmp_path, "a.jpg", "sub/b.jpg")
+    store = MemoryTagStore({nested: ["sea"]})
+    catalog.refresh(str(tmp_path), store, Discovery(max_depth=None))
+    assert catalog.refresh(str(tmp_path), store, Discovery(max_depth=0)) == {top: []}
+    assert tag_counts(catalog) == {"sea": 1}
+
+
+def test_refresh_pages_through_more_files_than_a_batch(tmp_path, catalog):
+    paths = make_images(tmp_path, *(f"{n}.jpg" for n in range(10)))
+    store = MemoryTagStore({path: ["sky"] for path in paths})
+    assert len(dict(catalog.iter_refresh(str(tmp_path), store, batch_size=3))) == 10
+    for path in paths[::2]:
+        (tmp_path / path).unlink()
+    assert len(dict(catalog.iter_refresh(str(tmp_path), store, batch_size=3))) == 5
+    assert tag_counts(catalog) == {"sky": 5}
+
+
+def test_abandoned_refresh_leaves_no_temporary_table(tmp_path, catalog):
+    make_images(tmp_path, "a.jpg", "b.jpg")
+    refresh = catalog.iter_refresh(str(tmp_path), MemoryTagStore(), batch_size=1)
+    next(refresh)
+    refresh.close()
+    with catalog.transaction() as conn:
+        assert conn.execute("SELECT name FROM sqlite_temp_master").fetchall() == []
+
+
+def test_catalog_built_from_another_store_is_cleared(tmp_path):
+    (image,) = make_images(tmp_path, "a.jpg")
+    catalog_path = str(tmp_path / "catalog.sqlite3")
+    Catalog(catalog_path, MemoryTagStore()).refresh(str(tmp_path), MemoryTagStore({image: ["sky"]}))
+
+    class OtherStore(MemoryTagStore):
+        spec = "other"
+
+    catalog = Catalog(catalog_path, OtherStore())
+    assert catalog.tag_stats() == []
+    assert catalog.refresh(str(tmp_path), OtherStore()) == {image: []}
+
+
+def test_tag_index_follows_catalog_changes(tmp_path, catalog):
+    first, second, third = make_images(tmp_path, "a.jpg", "b.jpg", "c.jpg")
+    store = MemoryTagStore({first: ["Sky"], second: ["sky", "sea"]})
+    catalog.refresh(str(tmp_path), store)
+    index = TagIndex(catalog)
+    index.ensure_current()
+    assert sorted(index.search("sky")) == [first, second]
+
+    store.set_many({first: [], third: ["sky"]})
+    (tmp_path / "b.jpg").unlink()
+    catalog.refresh(str(tmp_path), store)
+    index.ensure_current()
+    results = {query: sorted(index.search(query)) for query in ("sky", "sea", "NOT sky")}
+    assert results == {"sky": [third], "sea": [], "NOT sky": [first]}
+
+    index.rebuild()
+    assert {query: sorted(index.search(query)) for query in results} == results
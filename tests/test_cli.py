@@ -0,0 +1,62 @@
+import os
+import sys
+import subprocess
+import importlib.util
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Startup budget of the commands that make no API calls, as in benchmarks/bench_startup.py
+STARTUP_BUDGET_MS = 100
+
+# Runs the CLI in a fresh interpreter and prints the modules it ended up importing
+RUN_AND_LIST_MODULES = (
+    "import sys\n"
+    "from imgtagman import imgtagman\n"
+    "sys.argv = ['imgtagman', *sys.argv[1:]]\n"
+    "imgtagman.main()\n"
+    "print(' '.join(sys.modules))\n"
+)
+
+
+def imported_modules(*arguments):
+    environment = dict(os.environ, PYTHONPATH=ROOT)
+    environment.pop("OPENAI_API_KEY", None)
+    result = subprocess.run(
+        [sys.executable, "-c", RUN_AND_LIST_MODULES, *arguments],
+        capture_output=True, text=True, env=environment, check=True,
+    )
+    # The summary itself comes first; the module list is the last line
+    return set(result.stdout.splitlines()[-1].split())
+
+
+def test_summary_never_imports_the_sdk(tmp_path):
+    modules = imported_modules("summary", "--no-catalog", "--directory", str(tmp_path))
+    assert "openai" not in modules
+    assert "imgtagman.imgtag" not in modules
+
+
+def test_remove_tags_dry_run_never_imports_the_sdk(tmp_path):
+    modules = imported_modules("remove-tags", "--dry-run", "--no-catalog", "--directory", str(tmp_path))
+    assert "openai" not in modules
+    assert "imgtagman.imgtag" not in modules
+
+
+def load_startup_benchmark():
+    spec = importlib.util.spec_from_file_location("bench_startup", os.path.join(ROOT, "benchmarks", "bench_startup.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.mark.parametrize("command", ["summary", "remove-tags"])
+def test_import_time_stays_within_budget(tmp_path, command):
+    bench = load_startup_benchmark()
+    arguments = bench.COMMANDS[command]
+    # The first run writes the bytecode cache; the best of the rest evens out a busy machine
+    bench.import_times(arguments, str(tmp_path))
+    best, modules, imported = min((bench.import_times(arguments, str(tmp_path)) for _ in range(3)),
+                                  key=lambda run: run[0])
+    assert not {name.split(".")[0] for name in imported} & set(bench.HEAVY_PACKAGES)
+    slowest = sorted(modules, key=modules.get, reverse=True)[:5]
+    assert best / 1000 < STARTUP_BUDGET_MS, f"{best / 1000:.1f} ms of imports, slowest: {', '.join(slowest)}"
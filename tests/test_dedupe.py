@@ -0,0 +1,33 @@
+import random
+import pytest
+
+pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+
+from imgtagman import dedupe  # noqa: E402
+
+
+def pattern(path, size, seed=0):
+    """A coarse random pattern, scaled to size; the same seed gives the same picture"""
+    rng = random.Random(seed)
+    image = Image.new("L", (8, 8))
+    image.putdata([rng.randrange(256) for _ in range(64)])
+    image.resize(size, Image.BILINEAR).save(path)
+    return str(path)
+
+
+@pytest.mark.parametrize("method", ["dhash", "phash"])
+def test_near_duplicates_cluster_under_the_largest(tmp_path, monkeypatch, method):
+    # Several chunks and hash batches, to go through the bounded window
+    monkeypatch.setattr(dedupe, "HASH_CHUNK_SIZE", 2)
+    monkeypatch.setattr(dedupe, "HASH_BATCH_SIZE", 3)
+    large = pattern(tmp_path / "large.png", (256, 256))
+    copies = [pattern(tmp_path / f"copy{n}.png", (64 + n, 64 + n)) for n in range(4)]
+    other = pattern(tmp_path / "other.png", (128, 128), seed=1)
+    broken = tmp_path / "broken.png"
+    broken.write_bytes(b"not an image")
+
+    clusters = dedupe.cluster_images([*copies, large, other, str(broken)], method, workers=2)
+    assert sorted(clusters.representatives) == sorted([large, other, str(broken)])
+    assert sorted(clusters.members[large]) == sorted(copies)
+    assert clusters.members[other] == clusters.members[str(broken)] == []
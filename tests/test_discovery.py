@@ -0,0 +1,71 @@
+import os
+import errno
+import pytest
+from imgtagman.discovery import Discovery
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for name in ("a.jpg", "b.TIF", "notes.txt", ".hidden.jpg", "sub/c.png", "sub/deeper/d.webp", "skip/e.jpg"):
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"")
+    return tmp_path
+
+
+def found(discovery, root):
+    return sorted(os.path.relpath(path, root) for path in discovery.iter_paths(root))
+
+
+def test_finds_images_case_insensitively_including_tif(tree):
+    assert found(Discovery(), tree) == ["a.jpg", "b.TIF", "skip/e.jpg", "sub/c.png", "sub/deeper/d.webp"]
+
+
+def test_filters(tree):
+    assert found(Discovery(max_depth=1, exclude=["skip"]), tree) == ["a.jpg", "b.TIF", "sub/c.png"]
+    assert ".hidden.jpg" in found(Discovery(include_hidden=True, max_depth=0), tree)
+
+
+def test_in_scope_agrees_with_the_walk(tree):
+    discovery = Discovery(max_depth=1, exclude=["skip"])
+    assert discovery.in_scope(str(tree), str(tree / "sub/c.png"))
+    assert not discovery.in_scope(str(tree), str(tree / "sub/deeper/d.webp"))
+    assert not discovery.in_scope(str(tree), str(tree / "skip/e.jpg"))
+    assert not discovery.in_scope(str(tree), str(tree / "notes.txt"))
+
+
+@pytest.mark.parametrize("code", [errno.EIO, errno.ESTALE, errno.ELOOP, errno.EACCES])
+def test_unreadable_directories_and_files_are_skipped(tree, monkeypatch, code):
+    scandir = os.scandir
+
+    class FailingEntry:
+        def __init__(self, entry):
+            self._entry = entry
+            self.name = entry.name
+            self.path = entry.path
+
+        def is_dir(self, follow_symlinks=True):
+            return self._entry.is_dir(follow_symlinks=follow_symlinks)
+
+        def is_file(self, follow_symlinks=True):
+            return self._entry.is_file(follow_symlinks=follow_symlinks)
+
+        def stat(self, follow_symlinks=True):
+            if self.name == "a.jpg":
+                raise OSError(code, os.strerror(code), self.path)
+            return self._entry.stat(follow_symlinks=follow_symlinks)
+
+    class Listing:
+        def __init__(self, directory):
+            if os.path.basename(directory) == "sub":
+                raise OSError(code, os.strerror(code), directory)
+            self._entries = scandir(directory)
+
+        def __enter__(self):
+            return (FailingEntry(entry) for entry in self._entries)
+
+        def __exit__(self, *exc_info):
+            self._entries.close()
+
+    monkeypatch.setattr(os, "scandir", Listing)
+    assert found(Discovery(), tree) == ["b.TIF", "skip/e.jpg"]
@@ -0,0 +1,62 @@
+from imgtagman.remove_tags import apply_removals, plan_removals
+from imgtagman.tagstore import MemoryTagStore
+
+TAGS = {
+    "a.jpg": ["Texto", "texto livre", "sky"],
+    "b.jpg": ["sky", "sea"],
+    "c.jpg": [],
+}
+
+
+def test_without_patterns_every_tag_goes():
+    assert plan_removals(TAGS) == {
+        "a.jpg": (TAGS["a.jpg"], []),
+        "b.jpg": (TAGS["b.jpg"], []),
+    }
+
+
+def test_patterns_are_case_insensitive_wildcards():
+    assert plan_removals(TAGS, patterns=["TEXTO*"]) == {"a.jpg": (TAGS["a.jpg"], ["sky"])}
+
+
+def test_query_selects_the_files():
+    assert plan_removals(TAGS, patterns=["sky"], query="sea") == {"b.jpg": (TAGS["b.jpg"], ["sea"])}
+
+
+def test_files_left_unchanged_are_not_planned():
+    assert plan_removals(TAGS, patterns=["tree"]) == {}
+
+
+class FlakyStore(MemoryTagStore):
+    """Fails every batch, and every single write to the paths in broken"""
+
+    def __init__(self, tags_by_path, broken):
+        super().__init__(tags_by_path)
+        self.broken = broken
+
+    def _write_many(self, tags_by_path):
+        if len(tags_by_path) > 1 or set(tags_by_path) & self.broken:
+            raise OSError("read-only file")
+        super()._write_many(tags_by_path)
+
+    def delete_many(self, paths):
+        if len(paths) > 1 or set(paths) & self.broken:
+            raise OSError("read-only file")
+        return super().delete_many(paths)
+
+
+def test_one_failing_file_does_not_stop_the_others(tmp_path):
+    paths = {name: str(tmp_path / name) for name in ("a.jpg", "b.jpg", "c.jpg", "d.jpg")}
+    tags = {paths["a.jpg"]: ["sky"], paths["b.jpg"]: ["sky"], paths["c.jpg"]: ["sky", "sea"],
+            paths["d.jpg"]: ["sky", "sea"]}
+    store = FlakyStore(tags, {paths["b.jpg"], paths["d.jpg"]})
+
+    failed = apply_removals(store, plan_removals(tags, patterns=["sky"]))
+
+    assert set(failed) == {paths["b.jpg"], paths["d.jpg"]}
+    assert store.get_many(tags) == {
+        paths["a.jpg"]: [],
+        paths["b.jpg"]: ["sky"],
+        paths["c.jpg"]: ["sea"],
+        paths["d.jpg"]: ["sky", "sea"],
+    }
@@ -0,0 +1,117 @@
+import pytest
+from imgtagman.retry import FATAL, THROTTLED, TRANSIENT, CircuitBreaker, RetryPolicy, classify, retry_after
+
+openai = pytest.importorskip("openai")
+httpx = pytest.importorskip("httpx")
+
+
+def status_error(status_code, headers=None, code=None):
+    request = httpx.Request("POST", "http://localhost/v1/chat/completions")
+    response = httpx.Response(status_code, headers=headers, request=request)
+    return openai.APIStatusError("error", response=response, body={"code": code} if code else None)
+
+
+def connection_error():
+    return openai.APIConnectionError(request=httpx.Request("POST", "http://localhost/v1/chat/completions"))
+
+
+@pytest.mark.parametrize("error, kind", [
+    (status_error(429), THROTTLED),
+    (status_error(429, code="insufficient_quota"), FATAL),
+    (status_error(503), TRANSIENT),
+    (status_error(408), TRANSIENT),
+    (status_error(400), FATAL),
+    (status_error(401), FATAL),
+    (connection_error(), TRANSIENT),
+    (ValueError("bug"), FATAL),
+])
+def test_classify(error, kind):
+    assert classify(error) == kind
+
+
+def test_retry_after_prefers_milliseconds():
+    assert retry_after({"retry-after-ms": "1500", "retry-after": "9"}) == 1.5
+    assert retry_after({"retry-after": "2"}) == 2.0
+    assert retry_after({}) is None
+
+
+def open_breaker(reset_timeout=0.0):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=reset_timeout)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    return breaker
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = open_breaker(reset_timeout=60.0)
+    assert breaker.wait_time() > 0
+    assert breaker.opened == 1
+
+
+def test_success_resets_the_failure_count():
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+def test_half_open_breaker_lets_one_probe_through():
+    breaker = open_breaker()
+    assert breaker.wait_time() == 0.0
+    assert breaker.state == "half-open"
+    assert breaker.wait_time() > 0
+
+
+def test_successful_probe_closes_the_breaker():
+    breaker = open_breaker()
+    breaker.wait_time()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.wait_time() == 0.0
+
+
+def test_failed_probe_reopens_with_a_longer_timeout():
+    breaker = open_breaker(reset_timeout=1.0)
+    breaker._opened_at -= 1.0
+    breaker.wait_time()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker._timeout == 2.0
+    assert breaker.opened == 2
+
+
+def test_neutral_probe_lets_another_probe_through():
+    breaker = open_breaker()
+    breaker.wait_time()
+    breaker.record_neutral()
+    assert breaker.state == "half-open"
+    assert breaker.wait_time() == 0.0
+
+
+def test_fatal_errors_are_raised_at_once():
+    policy = RetryPolicy()
+    error = status_error(400)
+    with pytest.raises(openai.APIStatusError):
+        policy.on_failure(error, 1)
+    assert policy.breaker.state == "closed"
+
+
+def test_transient_errors_back_off_until_max_attempts():
+    policy = RetryPolicy(max_attempts=3, base_delay=0.1, breaker=CircuitBreaker(failure_threshold=10))
+    assert 0 <= policy.on_failure(connection_error(), 1) <= 0.2
+    assert 0 <= policy.on_failure(connection_error(), 2) <= 0.4
+    with pytest.raises(openai.APIConnectionError):
+        policy.on_failure(connection_error(), 3)
+    assert policy.retries[TRANSIENT] == 2
+    assert policy.gave_up == 1
+
+
+def test_throttling_follows_retry_after_and_skips_backoff_when_paced():
+    policy = RetryPolicy()
+    assert policy.on_failure(status_error(429, {"retry-after": "3"}), 1) == 3.0
+    assert policy.on_failure(status_error(429), 1, paced=True) == 0.0
+    assert policy.retries[THROTTLED] == 2
+    assert policy.breaker.state == "closed"
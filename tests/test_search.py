@@ -0,0 +1,95 @@
+import pytest
+from imgtagman.catalog import Catalog
+from imgtagman.discovery import Discovery
+from imgtagman.search import search_images
+from imgtagman.tag_index import MAX_LOG_ROWS, TagIndex, decode_postings, encode_postings, iter_ids, matches, parse_query
+from imgtagman.tagstore import MemoryTagStore
+
+
+def test_not_binds_tighter_than_and_tighter_than_or():
+    assert parse_query("a OR b AND NOT c") == (
+        "OR", ("TAG", "a"), ("AND", ("TAG", "b"), ("NOT", ("TAG", "c")))
+    )
+
+
+def test_adjacent_terms_are_anded():
+    assert parse_query("a b") == parse_query("a AND b")
+
+
+def test_parentheses_group():
+    assert parse_query("(a OR b) c") == ("AND", ("OR", ("TAG", "a"), ("TAG", "b")), ("TAG", "c"))
+
+
+def test_quoted_tags_keep_spaces_and_are_normalized():
+    assert parse_query('" Blue Sky "') == ("TAG", "blue sky")
+
+
+def test_operators_are_case_insensitive():
+    assert parse_query("a or not b") == ("OR", ("TAG", "a"), ("NOT", ("TAG", "b")))
+
+
+@pytest.mark.parametrize("query", ["", "   ", "(a", "a)", "a OR", "NOT", '"unclosed'])
+def test_invalid_queries_are_rejected(query):
+    with pytest.raises(ValueError):
+        parse_query(query)
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("sky", True),
+    ("SKY AND sea", True),
+    ("sky NOT sea", False),
+    ("tree OR sea", True),
+    ("s*", True),
+    ("tr?e", False),
+    ('"blue sky"', False),
+])
+def test_matches(query, expected):
+    assert matches(parse_query(query), ["Sky", " sea "]) is expected
+
+
+@pytest.mark.parametrize("ids", [[], [0], [3, 5, 8], [0, 1000000], list(range(0, 4000, 3))])
+def test_posting_lists_round_trip(ids):
+    assert list(iter_ids(decode_postings(*encode_postings(ids)))) == ids
+
+
+@pytest.fixture
+def tree(tmp_path):
+    paths = {}
+    for name, tags in (("a.jpg", ["top"]), ("sub/b.jpg", ["deep"]), ("skip/c.jpg", ["top"])):
+        path = tmp_path / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(b"")
+        paths[name] = (str(path), tags)
+    store = MemoryTagStore(dict(paths.values()))
+    catalog = Catalog(str(tmp_path / "catalog.sqlite3"))
+    catalog.refresh(str(tmp_path), store)
+    return tmp_path, catalog, store, {name: path for name, (path, _) in paths.items()}
+
+
+def test_search_keeps_to_the_discovery_scope(tree):
+    directory, catalog, store, paths = tree
+    assert search_images(str(directory), "top OR deep", catalog, store, discovery=Discovery(max_depth=0)) == [
+        paths["a.jpg"]
+    ]
+    found = search_images(str(directory / "sub"), "NOT top", catalog, store, refresh=False)
+    assert found == [paths["sub/b.jpg"]]
+    found = search_images(str(directory), "top", catalog, store, discovery=Discovery(exclude=["skip"]))
+    assert found == [paths["a.jpg"]]
+
+
+def test_index_is_dropped_once_its_log_passes_the_cap(tree):
+    directory, catalog, store, paths = tree
+    index = TagIndex(catalog)
+    index.ensure_current()
+    with catalog.transaction() as conn:
+        # Jump the log close to the cap instead of writing MAX_LOG_ROWS rows
+        conn.executemany("INSERT INTO tag_index_log (seq, file_id) VALUES (?, 0)", [(1,), (MAX_LOG_ROWS,)])
+    catalog.record_tags(paths["a.jpg"], ["moved"])
+    assert not index.is_built()
+    with catalog.transaction() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM tag_index_log").fetchone() == (0,)
+    catalog.record_tags(paths["a.jpg"], ["again"])
+    with catalog.transaction() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM tag_index_log").fetchone() == (0,)
+    index.ensure_current()
+    assert index.search("again") == [paths["a.jpg"]]
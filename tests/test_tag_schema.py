@@ -0,0 +1,15 @@
+import json
+import pytest
+from imgtagman.tag_schema import MAX_TAG_LENGTH, packed_response_format, parse_tags, tag_response_format
+
+
+def test_schemas_use_only_what_strict_mode_supports():
+    for response_format in (tag_response_format(), packed_response_format(3)):
+        schema = json.dumps(response_format)
+        assert "minLength" not in schema and "maxLength" not in schema
+
+
+def test_parsing_drops_blank_tags_and_shortens_long_ones():
+    pytest.importorskip("pydantic")
+    content = json.dumps({"tags": ["sky", " ", "x" * (MAX_TAG_LENGTH + 5)]})
+    assert parse_tags(content) == ["sky", "x" * MAX_TAG_LENGTH]
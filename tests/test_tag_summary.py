@@ -0,0 +1,48 @@
+import pytest
+from imgtagman.catalog import Catalog
+from imgtagman.discovery import Discovery
+from imgtagman.tag_summary import collect_tag_stats
+from imgtagman.tagstore import MemoryTagStore
+
+
+@pytest.fixture
+def tree(tmp_path):
+    paths = {}
+    for name in ("a.jpg", "sub/b.jpg"):
+        path = tmp_path / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(b"")
+        paths[name] = str(path)
+    store = MemoryTagStore({paths["a.jpg"]: ["top"], paths["sub/b.jpg"]: ["top", "deep"]})
+    return tmp_path, store, paths
+
+
+def counts(stats):
+    return {tag: count for tag, count, _ in stats}
+
+
+@pytest.mark.parametrize("with_catalog", [False, True])
+def test_stats_keep_to_the_discovery_scope(tree, with_catalog):
+    directory, store, _ = tree
+    catalog = Catalog(str(directory / "catalog.sqlite3")) if with_catalog else None
+    assert counts(collect_tag_stats(str(directory), store, catalog)) == {"top": 2, "deep": 1}
+    stats = collect_tag_stats(str(directory), store, catalog, discovery=Discovery(max_depth=0))
+    assert stats == [("top", 1, [str(directory / "a.jpg")])]
+    assert counts(collect_tag_stats(str(directory / "sub"), store, catalog)) == {"top": 1, "deep": 1}
+
+
+def test_tags_changed_outside_imgtagman_are_counted(tree):
+    directory, store, paths = tree
+    catalog = Catalog(str(directory / "catalog.sqlite3"))
+    collect_tag_stats(str(directory), store, catalog)
+    store.set(paths["a.jpg"], ["edited"])
+    assert counts(collect_tag_stats(str(directory), store, catalog)) == {"top": 1, "deep": 1, "edited": 1}
+
+
+def test_without_refresh_the_catalog_statistics_are_used(tree):
+    directory, store, paths = tree
+    catalog = Catalog(str(directory / "catalog.sqlite3"))
+    # An empty catalog is filled in even without refresh
+    assert counts(collect_tag_stats(str(directory), store, catalog, refresh=False)) == {"top": 2, "deep": 1}
+    store.set(paths["a.jpg"], ["edited"])
+    assert counts(collect_tag_stats(str(directory), store, catalog, refresh=False)) == {"top": 2, "deep": 1}
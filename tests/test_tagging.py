@@ -0,0 +1,151 @@
+"""Tag and batch runs against a local stand-in for the OpenAI API"""
+import os
+import sys
+import json
+import email
+import base64
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+pytest.importorskip("openai")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A 1x1 PNG; uploaded as is with --no-preprocess
+PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8DwHwAFBQIAX8jx0gAAAABJRU5ErkJggg=="
+)
+
+
+def completion(content, model="gpt-4o-mini"):
+    return {
+        "id": "chatcmpl-test",
+        "object": "chat.completion",
+        "created": 0,
+        "model": model,
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+        "usage": {"prompt_tokens": 100, "completion_tokens": 10, "total_tokens": 110},
+    }
+
+
+class FakeOpenAI(BaseHTTPRequestHandler):
+    """Answers chat completions with {"tags": ["fake"]}, and runs batches at once.
+
+    Batch requests whose custom_id ends in 1 come back as 400s.
+    """
+
+    protocol_version = "HTTP/1.1"
+    files = {}
+    batches = {}
+    lock = threading.Lock()
+
+    def log_message(self, *arguments):
+        pass
+
+    def reply(self, body):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        with self.lock:
+            if self.path == "/v1/chat/completions":
+                return self.reply(completion(json.dumps({"tags": ["fake"]})))
+            if self.path == "/v1/files":
+                message = email.message_from_bytes(
+                    b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + body
+                )
+                data = next(
+                    part.get_payload(decode=True) for part in message.get_payload()
+                    if part.get_param("name", header="content-disposition") == "file"
+                )
+                file_id = f"file-{len(self.files)}"
+                self.files[file_id] = data
+                return self.reply({"id": file_id, "object": "file", "bytes": len(data), "created_at": 0,
+                                   "filename": "requests.jsonl", "purpose": "batch", "status": "processed"})
+            if self.path == "/v1/batches":
+                request = json.loads(body)
+                batch_id = f"batch_{len(self.batches)}"
+                self.batches[batch_id] = self.run_batch(batch_id, request)
+                return self.reply(self.batches[batch_id])
+        self.send_error(404)
+
+    def do_GET(self):
+        with self.lock:
+            if self.path.startswith("/v1/batches/"):
+                return self.reply(self.batches[self.path.rsplit("/", 1)[1]])
+            if self.path.endswith("/content"):
+                return self.reply(self.files[self.path.split("/")[3]])
+        self.send_error(404)
+
+    def run_batch(self, batch_id, request):
+        lines = []
+        for line in self.files[request["input_file_id"]].splitlines():
+            item = json.loads(line)
+            if item["custom_id"].endswith("1"):
+                response = {"status_code": 400, "body": {"error": {"message": "invalid image"}}}
+            else:
+                response = {"status_code": 200, "body": completion(json.dumps({"tags": ["batched"]}))}
+            lines.append(json.dumps({"id": "response", "custom_id": item["custom_id"], "response": response,
+                                     "error": None}))
+        output_file_id = f"file-{len(self.files)}"
+        self.files[output_file_id] = ("\n".join(lines) + "\n").encode()
+        return {
+            "id": batch_id, "object": "batch", "endpoint": request["endpoint"], "completion_window": "24h",
+            "created_at": 0, "input_file_id": request["input_file_id"], "status": "completed",
+            "output_file_id": output_file_id, "error_file_id": None,
+            "request_counts": {"total": len(lines), "completed": len(lines), "failed": 0},
+        }
+
+
+@pytest.fixture
+def api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAI)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1"
+    server.shutdown()
+    server.server_close()
+    FakeOpenAI.files.clear()
+    FakeOpenAI.batches.clear()
+
+
+@pytest.fixture
+def images(tmp_path):
+    for n in range(3):
+        (tmp_path / f"image{n}.png").write_bytes(PNG)
+    return tmp_path
+
+
+def tag(api, directory, *arguments):
+    environment = dict(os.environ, PYTHONPATH=ROOT, OPENAI_API_KEY="test", OPENAI_BASE_URL=api)
+    subprocess.run(
+        [sys.executable, "-m", "imgtagman.imgtagman", "tag", "--directory", str(directory), "--store", "sidecar",
+         "--no-preprocess", "--no-cache", *arguments],
+        capture_output=True, text=True, env=environment, check=True, timeout=60,
+    )
+    with open(directory / ".imgtagman-tags.json", encoding="utf-8") as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize("engine", ["threads", "async"])
+def test_tag_writes_the_answers(api, images, engine):
+    assert tag(api, images, "--engine", engine) == {f"image{n}.png": ["fake"] for n in range(3)}
+
+
+def test_tag_skips_tagged_images(api, images):
+    (images / ".imgtagman-tags.json").write_text(json.dumps({"image0.png": ["mine"]}), encoding="utf-8")
+    assert tag(api, images)["image0.png"] == ["mine"]
+
+
+def test_batch_applies_results_and_leaves_failed_requests_untagged(api, images):
+    tags = tag(api, images, "--batch", "--poll-interval", "0")
+    assert len(tags) == 2
+    assert all(value == ["batched"] for value in tags.values())
+    assert not (images / ".imgtagman-batch").exists()
@@ -0,0 +1,75 @@
+import pytest
+from imgtagman.tagstore import MemoryTagStore, SidecarTagStore, SQLiteTagStore, normalize_tags, open_store
+
+
+@pytest.fixture(params=["memory", "sidecar", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        store = MemoryTagStore()
+    elif request.param == "sidecar":
+        store = SidecarTagStore()
+    else:
+        store = SQLiteTagStore(str(tmp_path / "tags.sqlite3"))
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def images(tmp_path):
+    paths = []
+    for name in ("a.jpg", "b.jpg", "c.jpg"):
+        (tmp_path / name).write_bytes(b"")
+        paths.append(str(tmp_path / name))
+    return paths
+
+
+def test_normalize_tags_strips_and_deduplicates():
+    assert normalize_tags([" sky ", "", "sea", "sky", "  "]) == ["sky", "sea"]
+
+
+def test_untagged_files_read_as_empty(store, images):
+    assert store.get_many(images) == dict.fromkeys(images, [])
+
+
+def test_set_and_get_keep_tag_order(store, images):
+    store.set_many({images[0]: ["sky", "sea"], images[1]: ["tree"]})
+    assert store.get_many(images) == {images[0]: ["sky", "sea"], images[1]: ["tree"], images[2]: []}
+
+
+def test_unchanged_writes_are_skipped(store, images):
+    assert store.set_many({images[0]: ["sky", "sea"]}) == [images[0]]
+    assert store.set_many({images[0]: ["sea", "sky"], images[1]: []}) == []
+    assert (store.writes, store.skipped_writes) == (1, 2)
+
+
+def test_setting_no_tags_deletes(store, images):
+    store.set(images[0], ["sky"])
+    assert store.set(images[0], [])
+    assert store.get(images[0]) == []
+
+
+def test_update_adds_and_removes(store, images):
+    store.set(images[0], ["sky", "sea"])
+    assert store.update(images[0], add=["tree", "sky"], remove=["sea"])
+    assert store.get(images[0]) == ["sky", "tree"]
+
+
+def test_delete_many_returns_the_paths_that_had_tags(store, images):
+    store.set_many({images[0]: ["sky"], images[2]: ["sea"]})
+    assert sorted(store.delete_many(images)) == [images[0], images[2]]
+    assert not store.delete(images[0])
+
+
+def test_open_store_does_not_offer_memory(tmp_path):
+    with pytest.raises(ValueError):
+        open_store("memory", str(tmp_path))
+
+
+def test_stores_name_where_their_tags_live(tmp_path):
+    store = open_store("sqlite", str(tmp_path))
+    try:
+        assert store.spec == f"sqlite:{tmp_path / '.imgtagman-tags.sqlite3'}"
+        assert not store.tags_in_file
+    finally:
+        store.close()
+    assert open_store("xattr").tags_in_file
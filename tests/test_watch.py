@@ -0,0 +1,41 @@
+import time
+from imgtagman.watch import Debouncer
+
+
+def test_files_are_released_once_they_stop_changing(tmp_path):
+    path = tmp_path / "a.jpg"
+    path.write_bytes(b"x")
+    debouncer = Debouncer(settle=0)
+    debouncer.touch(str(path))
+    assert debouncer.ready() == []
+    assert debouncer.ready() == [str(path)]
+    assert debouncer.ready() == []
+
+
+def test_growing_files_are_held_back(tmp_path):
+    path = tmp_path / "a.jpg"
+    path.write_bytes(b"x")
+    debouncer = Debouncer(settle=0)
+    debouncer.touch(str(path))
+    debouncer.ready()
+    path.write_bytes(b"xy")
+    assert debouncer.ready() == []
+    assert debouncer.ready() == [str(path)]
+
+
+def test_empty_files_expire(tmp_path):
+    path = tmp_path / "placeholder.jpg"
+    path.touch()
+    debouncer = Debouncer(settle=0, max_wait=0.05)
+    debouncer.touch(str(path))
+    assert debouncer.ready() == []
+    assert debouncer.ready() == []
+    time.sleep(0.06)
+    assert debouncer.ready() == []
+    assert debouncer._pending == {}
+
+    # Written later, it is picked up again
+    path.write_bytes(b"x")
+    debouncer.touch(str(path))
+    debouncer.ready()
+    assert debouncer.ready() == [str(path)]
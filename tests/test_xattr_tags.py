@@ -0,0 +1,28 @@
+import os
+import sys
+import pytest
+from imgtagman.xattr_tags import TAG_ATTRIBUTE, _setxattr, read_tags_bulk, write_tags
+
+
+@pytest.fixture
+def images(tmp_path):
+    paths = []
+    for name in ("a.jpg", "b.jpg"):
+        (tmp_path / name).write_bytes(b"")
+        paths.append(str(tmp_path / name))
+    try:
+        write_tags(paths[0], ["sky"])
+    except OSError as e:
+        pytest.skip(f"No extended attributes here: {e}")
+    return paths
+
+
+def test_read_tags_bulk(images):
+    assert read_tags_bulk(images) == {images[0]: ["sky"], images[1]: []}
+
+
+def test_undecodable_tags_do_not_stop_the_bulk_read(images):
+    # Not UTF-8 on Linux, not a plist on macOS
+    _setxattr(images[1], TAG_ATTRIBUTE, b"\xff\xfe" if sys.platform != "darwin" else b"bplist00\xff")
+    assert read_tags_bulk(images) == {images[0]: ["sky"], images[1]: []}
+    assert read_tags_bulk(os.path.dirname(images[0])) == {images[0]: ["sky"], images[1]: []}